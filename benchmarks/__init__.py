@@ -0,0 +1,5 @@
+"""Benchmarks for measuring the performance of Hairball.
+
+Run `python -m benchmarks --help` from the root of the repository for usage.
+
+"""
@@ -0,0 +1,7 @@
+"""Entrypoint for `python -m benchmarks`."""
+
+import sys
+from .run import main
+
+
+sys.exit(main())
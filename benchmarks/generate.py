@@ -0,0 +1,160 @@
+"""This module generates synthetic Scratch projects for benchmarking.
+
+Projects are generated from a seed, thus the same parameters and seed always
+produce the same project. The shape of a project is controlled by the number
+of sprites, the number of scripts per sprite, the number of blocks per script,
+the depth that control blocks are nested to, and the number of scripts that
+receive each broadcast message (the fan-out).
+
+"""
+
+import kurt
+import os
+import random
+
+
+# Parameters used when not otherwise specified
+DEFAULTS = {'sprites': 5, 'scripts': 10, 'length': 12, 'depth': 2,
+            'fanout': 3}
+
+
+class ProjectGenerator(object):
+
+    """Generates a synthetic project from a seed and shape parameters.
+
+    Besides reachable scripts, the generated projects contain scripts without
+    a hat block, receivers of messages that are never broadcast, scripts that
+    duplicate another sprite's script, and sprites with default names, thus
+    every bundled plugin has something to report.
+
+    """
+
+    BOOLEANS = [('touching:', 'edge'), ('keyPressed:', 'space'),
+                ('mousePressed',)]
+    CONTROL = ['doForever', 'doIf', 'doIfElse', 'doRepeat', 'doUntil']
+    HATS = [('whenGreenFlag',), ('whenClicked',),
+            ('whenKeyPressed', 'space')]
+    STACK = [('forward:', 10), ('turnRight:', 15), ('turnLeft:', 15),
+             ('heading:', 90), ('gotoX:y:', 0, 0), ('changeXposBy:', 5),
+             ('changeYposBy:', 5), ('glideSecs:toX:y:elapsed:from:', 1, 0, 0),
+             ('lookLike:', 'costume1'), ('nextCostume',),
+             ('changeSizeBy:', 10), ('setSizeTo:', 100), ('say:', 'Hello!'),
+             ('say:duration:elapsed:from:', 'Hello!', 2),
+             ('playSound:', 'pop'), ('doPlaySoundAndWait', 'pop'),
+             ('wait:elapsed:from:', 1), ('show',), ('hide',),
+             ('setGraphicEffect:to:', 'color', 0),
+             ('changeGraphicEffect:by:', 'color', 25)]
+
+    def __init__(self, seed=0, sprites=DEFAULTS['sprites'],
+                 scripts=DEFAULTS['scripts'], length=DEFAULTS['length'],
+                 depth=DEFAULTS['depth'], fanout=DEFAULTS['fanout']):
+        """Initialize a generator for projects of the given shape."""
+        self.random = random.Random(seed)
+        self.sprites = sprites
+        self.scripts = scripts
+        self.length = max(1, length)
+        self.depth = depth
+        self.fanout = max(1, fanout)
+        # Each message is received by fanout scripts
+        self.messages = ['message{}'.format(i) for i in
+                         range(max(1, sprites * scripts // (4 * self.fanout)))]
+
+    def block(self, variables, depth):
+        """Return a random stack block, nesting up to depth control blocks."""
+        choice = self.random.random()
+        if depth > 0 and choice < 0.2:
+            command = self.random.choice(self.CONTROL)
+            body = self.blocks(max(1, self.length // 3), variables, depth - 1)
+            if command == 'doForever':
+                return kurt.Block(command, body)
+            elif command == 'doRepeat':
+                return kurt.Block(command, self.random.randint(2, 10), body)
+            condition = kurt.Block(*self.random.choice(self.BOOLEANS))
+            if command == 'doIfElse':
+                other = self.blocks(max(1, self.length // 3), variables,
+                                    depth - 1)
+                return kurt.Block(command, condition, body, other)
+            return kurt.Block(command, condition, body)
+        elif choice < 0.3:
+            command = self.random.choice(['broadcast:', 'doBroadcastAndWait'])
+            return kurt.Block(command, self.random.choice(self.messages))
+        elif choice < 0.4 and variables:
+            variable = self.random.choice(variables)
+            if self.random.random() < 0.5:
+                return kurt.Block('setVar:to:', variable, 0)
+            return kurt.Block('changeVar:by:', variable, 1)
+        return kurt.Block(*self.random.choice(self.STACK))
+
+    def blocks(self, count, variables, depth):
+        """Return a list of count random stack blocks."""
+        blocks = []
+        for _ in range(count):
+            blocks.append(self.block(variables, depth))
+            if blocks[-1].type.shape == 'cap':  # Nothing may follow forever
+                break
+        return blocks
+
+    def project(self):
+        """Return a newly generated kurt Project."""
+        project = kurt.Project()
+        project.variables['score'] = kurt.Variable(0)
+        for i in range(self.sprites):
+            if self.random.random() < 0.25:
+                name = 'Sprite{}'.format(i + 1)  # A default name
+            else:
+                name = 'Actor{}'.format(i + 1)
+            sprite = kurt.Sprite(project, name)
+            sprite.variables['speed'] = kurt.Variable(0)
+            project.sprites.append(sprite)
+
+        # Distribute the receivers of each message across the sprites, and
+        # add one message that is never broadcast
+        receivers = []
+        for message in self.messages + ['unused']:
+            receivers.extend([message] * self.fanout)
+        self.random.shuffle(receivers)
+
+        scriptables = [project.stage] + project.sprites
+        count = len(scriptables) * self.scripts
+        for i in range(count):
+            scriptable = scriptables[i % len(scriptables)]
+            variables = sorted(set(project.variables) |
+                               set(scriptable.variables))
+            if i < len(receivers):
+                hat = [kurt.Block('whenIReceive', receivers[i])]
+            elif self.random.random() < 0.1:
+                hat = []  # Unreachable
+            else:
+                hat = [kurt.Block(*self.random.choice(self.HATS))]
+            blocks = self.blocks(self.length, variables, self.depth)
+            if i >= max(len(receivers), len(scriptables)) and \
+                    self.random.random() < 0.1:
+                other = scriptables[(i - 1) % len(scriptables)]
+                if other.scripts:  # Duplicate the previous script
+                    blocks = [x.copy() for x in other.scripts[-1].blocks]
+                    hat = []
+            scriptable.scripts.append(kurt.Script(hat + blocks))
+        return project
+
+
+def generate_project(seed=0, **parameters):
+    """Return a project generated from seed with the given parameters."""
+    return ProjectGenerator(seed, **parameters).project()
+
+
+def generate_corpus(directory, count, extension='.sb2', seed=0,
+                    **parameters):
+    """Save count generated projects within directory.
+
+    The i-th project is generated from seed + i. Returns the list of paths to
+    the saved projects.
+
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    paths = []
+    for i in range(count):
+        path = os.path.join(directory, 'project{:05}{}'.format(i, extension))
+        generate_project(seed + i, **parameters).save(path)
+        paths.append(path)
+    return paths
@@ -0,0 +1,423 @@
+"""This module runs the benchmarks and compares their results.
+
+Each benchmark is a function registered with the `benchmark` decorator. It
+receives the `Context`, performs any setup, and returns the function to time.
+Results are written as JSON, and can be compared to those of a previous run
+to detect regressions.
+
+"""
+
+from __future__ import print_function
+import json
+import kurt
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import timeit
+from optparse import OptionParser
+import hairball
+from hairball import Hairball, parse_arguments
+from hairball.cache import KurtCache
+from hairball.plugins import HairballPlugin
+from hairball.registry import PluginRegistry
+from .generate import DEFAULTS, generate_corpus, generate_project
+
+
+# The (name, function) pairs of the benchmarks in order of registration
+BENCHMARKS = []
+
+
+def benchmark(name):
+    """Decorator that registers a benchmark function under name."""
+    def register(function):
+        BENCHMARKS.append((name, function))
+        return function
+    return register
+
+
+def bundled_plugins():
+    """Return the import names (e.g., blocks.DeadCode) of bundled plugins."""
+    return [x['name'] for x in PluginRegistry(cache_path=None).plugins]
+
+
+def clear_memos(scratch):
+    """Remove the state that plugins memoize on a project."""
+    for attribute in ('hairball_events', 'hairball_stream'):
+        scratch.__dict__.pop(attribute, None)
+
+
+class Context(object):
+
+    """The projects and files shared by the benchmarks."""
+
+    def __init__(self, options):
+        """Generate the project and the corpus described by options."""
+        self.options = options
+        self.parameters = dict((key, getattr(options, key))
+                               for key in sorted(DEFAULTS))
+        self.directory = tempfile.mkdtemp(prefix='hairball-benchmark-')
+        self.project = generate_project(options.seed, **self.parameters)
+        self.corpus = os.path.join(self.directory, 'corpus')
+        self.paths = generate_corpus(self.corpus, options.files,
+                                     options.extension, options.seed,
+                                     **self.parameters)
+        self._working = None
+
+    def cache(self, mode='full'):
+        """Return a new KurtCache stored in the temporary directory."""
+        return KurtCache(os.path.join(self.directory, 'cache-' + mode),
+                         mode=mode)
+
+    def working_plugins(self):
+        """Return the bundled plugins that can analyze the project.
+
+        Plugins that fail are excluded from the macro benchmarks such that
+        those measure the same plugins as the other benchmarks that succeed.
+
+        """
+        if self._working is None:
+            self._working = []
+            for name in bundled_plugins():
+                clear_memos(self.project)
+                try:
+                    load_plugin(name)._process(self.project, filename='')
+                except Exception:  # The plugin benchmark reports the error
+                    continue
+                self._working.append(name)
+        return self._working
+
+    def cleanup(self):
+        """Remove the temporary directory."""
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def hairball(self, *argv):
+        """Return a Hairball for the corpus running every working plugin."""
+        args = ['-q', '-S'] + list(argv)
+        for name in self.working_plugins():
+            args.extend(['-p', name])
+        options, paths = parse_arguments(args + [self.corpus])
+        cache = False
+        if not options.no_cache:
+            cache = KurtCache(os.path.join(self.directory, 'cache-macro'),
+                              mode=options.cache_mode)
+        instance = Hairball(options, paths, cache=cache)
+        instance.initialize_plugins()
+        return instance
+
+
+@benchmark('micro.iter_blocks')
+def bench_iter_blocks(context):
+    """Iterate over every block of the project."""
+    scripts = list(HairballPlugin.iter_scripts(context.project))
+
+    def run():
+        for script in scripts:
+            for _ in HairballPlugin.iter_blocks(script.blocks):
+                pass
+    return run
+
+
+@benchmark('micro.block_stream')
+def bench_block_stream(context):
+    """Flatten the project into a BlockStream."""
+    def run():
+        clear_memos(context.project)
+        HairballPlugin.block_stream(context.project)
+    return run
+
+
+@benchmark('micro.tag_reachable_scripts')
+def bench_tag_reachable_scripts(context):
+    """Find the reachable scripts of the project given its BlockStream."""
+    def run():
+        context.project.__dict__.pop('hairball_events', None)
+        HairballPlugin.block_stream(context.project).reachable = None
+        HairballPlugin.tag_reachable_scripts(context.project)
+    return run
+
+
+@benchmark('micro.find_blocks')
+def bench_find_blocks(context):
+    """Build the opcode index and find the broadcast blocks with it."""
+    def run():
+        stream = HairballPlugin.block_stream(context.project)
+        stream._opcode_index = None  # pylint: disable=W0212
+        for _ in HairballPlugin.find_blocks(
+                context.project, ('broadcast %s', 'broadcast %s and wait')):
+            pass
+    return run
+
+
+def load_plugin(name):
+    """Return a silent instance of the named bundled plugin."""
+    module, class_name = name.rsplit('.', 1)
+    plugin = getattr(__import__('hairball.plugins.' + module,
+                                fromlist=['hairball.plugins']), class_name)()
+    plugin.verbose = False
+    return plugin
+
+
+def plugin_benchmark(name):
+    """Return a benchmark of the analyze method of the named plugin.
+
+    The BlockStream and reachability that plugins share are prepared
+    beforehand as they are measured by the micro benchmarks.
+
+    """
+    def bench_plugin(context):
+        plugin = load_plugin(name)
+        HairballPlugin.tag_reachable_scripts(context.project)
+        return lambda: plugin.analyze(context.project, filename='benchmark')
+    bench_plugin.__doc__ = 'Analyze the project with {}.'.format(name)
+    return bench_plugin
+
+
+for _name in bundled_plugins():
+    benchmark('plugin.' + _name)(plugin_benchmark(_name))
+
+
+@benchmark('cache.kurt_load')
+def bench_kurt_load(context):
+    """Load a project with kurt without the cache."""
+    path = context.paths[0]
+    return lambda: kurt.Project.load(path)
+
+
+def cache_benchmark(mode, hit):
+    """Return a benchmark of KurtCache.load for mode upon a hit or miss."""
+    def bench_cache(context):
+        cache = context.cache(mode)
+        path = context.paths[0]
+        cache.load(path)
+        key = cache.file_key(path) + KurtCache.MODES[mode]
+
+        def run():
+            if not hit:
+                cache.discard(key)
+            cache.load(path)
+        return run
+    bench_cache.__doc__ = 'Load a project through a {} cache upon a {}.' \
+        .format(mode, 'hit' if hit else 'miss')
+    return bench_cache
+
+
+for _mode in sorted(KurtCache.MODES):
+    benchmark('cache.{}_miss'.format(_mode))(cache_benchmark(_mode, False))
+    benchmark('cache.{}_hit'.format(_mode))(cache_benchmark(_mode, True))
+
+
+@benchmark('macro.find')
+def bench_find(context):
+    """Find the files of the corpus."""
+    instance = context.hairball('--no-cache')
+    return lambda: list(instance.hairball_files(instance.input_paths(),
+                                                instance.extensions))
+
+
+@benchmark('macro.find_archive')
+def bench_find_archive(context):
+    """Read the files of the corpus from a tar archive of it."""
+    path = os.path.join(context.directory, 'corpus.tar')
+    if not os.path.isfile(path):
+        with tarfile.open(path, 'w') as archive:
+            archive.add(context.corpus, 'corpus')
+    instance = context.hairball('--no-cache')
+    return lambda: list(instance.hairball_files([path], instance.extensions))
+
+
+@benchmark('macro.hairball')
+def bench_hairball(context):
+    """Run the bundled plugins over the corpus without the cache."""
+    return lambda: run_hairball(context.hairball('--no-cache'))
+
+
+@benchmark('macro.hairball_cached')
+def bench_hairball_cached(context):
+    """Run the bundled plugins over the corpus with a warm analysis cache."""
+    run_hairball(context.hairball('--cache-mode', 'analysis'))
+    return lambda: run_hairball(context.hairball('--cache-mode', 'analysis'))
+
+
+def startup_benchmark(*argv):
+    """Return a benchmark of a hairball process run with argv."""
+    def bench_startup(context):
+        args = [sys.executable, '-c', 'import hairball; hairball.main()']
+        args.extend(x.format(path=context.paths[0]) for x in argv)
+
+        def run():
+            with open(os.devnull, 'w') as devnull:
+                subprocess.check_call(args, stdout=devnull)
+        return run
+    bench_startup.__doc__ = 'Run `hairball {}` in a new process.'.format(
+        ' '.join(argv))
+    return bench_startup
+
+
+benchmark('startup.list_plugins')(startup_benchmark('--list-plugins'))
+benchmark('startup.analyze')(startup_benchmark(
+    '-C', '-q', '-p', 'blocks.BlockCounts', '{path}'))
+
+
+def run_hairball(instance):
+    """Process the files and finalize instance discarding all output."""
+    stdout, stderr = sys.stdout, sys.stderr
+    with open(os.devnull, 'w') as devnull:
+        sys.stdout = sys.stderr = devnull
+        try:
+            instance.process()
+            instance.finalize()
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+
+
+def measure(function, repeat, min_time):
+    """Return the timing statistics of function in seconds per call.
+
+    Like timeit, the number of calls per measurement is chosen such that a
+    measurement takes at least min_time seconds.
+
+    """
+    function()  # Warm up
+    number = 1
+    while True:
+        elapsed = timeit.Timer(function).timeit(number)
+        if elapsed >= min_time or number >= 1 << 20:
+            break
+        number *= 10 if elapsed < min_time / 10 else 2
+    times = sorted(timeit.Timer(function).repeat(repeat, number))
+    times = [x / number for x in times]
+    mean = sum(times) / len(times)
+    stdev = (sum((x - mean) ** 2 for x in times) / len(times)) ** 0.5
+    return {'min': times[0], 'median': times[len(times) // 2],
+            'mean': mean, 'stdev': stdev, 'number': number, 'repeat': repeat}
+
+
+def run_benchmarks(context, names, repeat, min_time):
+    """Return the results of running the named benchmarks."""
+    results = {}
+    for name, function in BENCHMARKS:
+        if name not in names:
+            continue
+        try:
+            results[name] = measure(function(context), repeat, min_time)
+        except Exception as exc:  # Record failures rather than stop
+            error = '{}: {}'.format(type(exc).__name__, exc)
+            results[name] = {'error': error}
+        if 'error' in results[name]:
+            print('{:40} {}'.format(name, results[name]['error']))
+        else:
+            print('{:40} {:12.6f} ms'.format(name,
+                                             results[name]['min'] * 1000))
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Output the change of each result relative to baseline.
+
+    Returns the names of the benchmarks that are slower than the baseline by
+    more than threshold (a fraction).
+
+    """
+    regressions = []
+    print('\n{:40} {:>12} {:>12} {:>8}'.format('benchmark', 'baseline ms',
+                                               'current ms', 'ratio'))
+    for name in sorted(set(results) & set(baseline)):
+        if 'min' not in results[name] or 'min' not in baseline[name]:
+            continue
+        ratio = results[name]['min'] / baseline[name]['min']
+        flag = ''
+        if ratio > 1 + threshold:
+            regressions.append(name)
+            flag = ' REGRESSION'
+        print('{:40} {:12.6f} {:12.6f} {:8.2f}{}'.format(
+            name, baseline[name]['min'] * 1000, results[name]['min'] * 1000,
+            ratio, flag))
+    return regressions
+
+
+def main(argv=None):
+    """Run the benchmarks as specified by argv."""
+    parser = OptionParser(usage='python -m benchmarks [options]',
+                          description=('Benchmark Hairball on synthetic '
+                                       'projects generated from a seed.'))
+    parser.add_option('-b', '--benchmark', action='append', metavar='NAME',
+                      help=('Run the benchmarks whose names start with NAME, '
+                            'e.g., micro or plugin.blocks. This option can '
+                            'be provided multiple times.'))
+    parser.add_option('-l', '--list', action='store_true',
+                      help='List the benchmarks and exit.')
+    parser.add_option('-o', '--output', metavar='FILE',
+                      help='Write the results as JSON to FILE.')
+    parser.add_option('-c', '--compare', metavar='FILE',
+                      help=('Compare the results to those previously written '
+                            'to FILE and exit with status 1 upon any '
+                            'regression.'))
+    parser.add_option('-t', '--threshold', type='float', default=0.1,
+                      help=('The fraction by which a benchmark must be slower '
+                            'than in the --compare results to be considered '
+                            'a regression (default: %default).'))
+    parser.add_option('-r', '--repeat', type='int', default=5,
+                      help=('The number of measurements of each benchmark '
+                            '(default: %default).'))
+    parser.add_option('--min-time', type='float', default=0.2,
+                      help=('The minimum number of seconds per measurement '
+                            '(default: %default).'))
+    parser.add_option('--seed', type='int', default=0,
+                      help='The seed of the generated projects.')
+    parser.add_option('--files', type='int', default=20,
+                      help=('The number of files in the corpus used by the '
+                            'macro benchmarks (default: %default).'))
+    parser.add_option('--extension', choices=['.sb', '.sb2'], default='.sb2',
+                      help=('The format of the files in the corpus (default: '
+                            '%default).'))
+    for key in sorted(DEFAULTS):
+        parser.add_option('--' + key, type='int', default=DEFAULTS[key],
+                          help=('The {} parameter of generated projects '
+                                '(default: %default).'.format(key)))
+    options, args = parser.parse_args(argv)
+    if args:
+        parser.error('No arguments are accepted.')
+    if options.repeat < 1:
+        parser.error('The number of repeats must be at least 1.')
+
+    names = [name for name, _ in BENCHMARKS
+             if not options.benchmark or
+             any(name.startswith(x) for x in options.benchmark)]
+    if options.list:
+        for name, function in BENCHMARKS:
+            print('{:40} {}'.format(name, function.__doc__))
+        return 0
+    baseline = None
+    if options.compare:
+        with open(options.compare) as fp:
+            baseline = json.load(fp)
+
+    context = Context(options)
+    try:
+        results = run_benchmarks(context, names, options.repeat,
+                                 options.min_time)
+    finally:
+        context.cleanup()
+
+    data = {'hairball': hairball.__version__, 'kurt': kurt.__version__,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'parameters': dict(context.parameters, seed=options.seed,
+                               files=options.files,
+                               extension=options.extension),
+            'results': results}
+    if options.output:
+        with open(options.output, 'w') as fp:
+            json.dump(data, fp, indent=2, separators=(',', ': '),
+                      sort_keys=True)
+            fp.write('\n')
+    if baseline:
+        if baseline['parameters'] != data['parameters']:
+            print('\nWarning: the parameters of the runs differ.')
+        if compare(results, baseline['results'], options.threshold):
+            return 1
+    return 0
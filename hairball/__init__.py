@@ -1,96 +1,37 @@
-"""A plugin-able framework for the static analysis of Scratch projects."""
+"""A plugin-able framework for the static analysis of Scratch projects.
+
+Importing kurt takes most of the time Hairball needs to start, thus kurt, and
+the modules that import it (e.g., the plugins), are only imported once they
+are needed. Commands that do not analyze projects, such as --list-plugins,
+never import them.
+
+"""
 
 from __future__ import print_function
-import appdirs
-import cPickle
-import errno
 import importlib
-import kurt
+import itertools
 import os
+import signal
 import sys
-import traceback
-from hashlib import sha1
+import threading
+from collections import deque
+from StringIO import StringIO
 from imp import load_source
 from optparse import OptionParser
-from .plugins import HairballPlugin
+from .archives import (ARCHIVE_ERRORS, MemoryFile, archive_members,
+                       is_archive)
+from .cache import KurtCache, cache_main, file_digest, parse_size
+from .output import SINKS, jsonable
+from .paths import read_paths, walk_files
+from .prefetch import Prefetcher
+from .profiling import NULL_PROFILER, Profiler
+from .registry import PluginRegistry
+from .state import StateWriter, merge_main, parse_shard
 
 
 __version__ = '0.3'
 
 
-class KurtCache(object):
-
-    """Interface to an on-disk cache of processed Kurt objects."""
-
-    DEFAULT_CACHE_DIR = appdirs.user_cache_dir(
-        appname='Hairball', appauthor='bboe')
-
-    @staticmethod
-    def path_to_key(filepath):
-        """Return the sha1sum (key) belonging to the file at filepath."""
-        tmp, last = os.path.split(filepath)
-        tmp, middle = os.path.split(tmp)
-        return '{}{}{}'.format(os.path.basename(tmp), middle,
-                               os.path.splitext(last)[0])
-
-    def __init__(self, cache_dir=DEFAULT_CACHE_DIR):
-        """Initialize the index of cached files."""
-        # Create the cache directory
-        try:
-            os.makedirs(cache_dir)
-        except OSError as exc:
-            if exc.errno != errno.EEXIST:
-                raise  # Don't continue without cache support
-        self.hashes = set()
-        self.cache_dir = cache_dir
-        # Initialize the index
-        for path, _, filenames in os.walk(cache_dir):
-            for filename in filenames:
-                if filename.endswith('.pkl'):
-                    filepath = os.path.join(path, filename)
-                    self.hashes.add(self.path_to_key(filepath))
-
-    def key_to_path(self, key):
-        """Return the fullpath to the file with sha1sum key."""
-        return os.path.join(self.cache_dir, key[:2], key[2:4],
-                            key[4:] + '.pkl')
-
-    def load(self, filename):
-        """Optimized load and return the parsed version of filename.
-
-        Uses the on-disk parse cache if the file is located in it.
-
-        """
-        # Compute sha1 hash (key)
-        with open(filename) as fp:
-            key = sha1(fp.read()).hexdigest()
-        path = self.key_to_path(key)
-        # Return the cached file if available
-        if key in self.hashes:
-            try:
-                with open(path) as fp:
-                    return cPickle.load(fp)
-            except EOFError:
-                os.unlink(path)
-                self.hashes.remove(key)
-            except IOError:
-                self.hashes.remove(key)
-        # Create the nested cache directory
-        try:
-            os.makedirs(os.path.dirname(path))
-        except OSError as exc:
-            if exc.errno != errno.EEXIST:
-                raise
-        # Process the file and save in the cache
-        scratch = kurt.Project.load(filename)  # can fail
-        with os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT,
-                               0400), 'w') as fp:
-            # open file for writing but make it immediately read-only
-            cPickle.dump(scratch, fp, cPickle.HIGHEST_PROTOCOL)
-        self.hashes.add(key)
-        return scratch
-
-
 class Hairball(object):
 
     """The Hairball exeuction class.
@@ -124,38 +65,117 @@ class Hairball(object):
 
         # Initialization Data
         if cache is True:
-            self.cache = KurtCache()
+            self.cache = KurtCache(max_size=options.cache_size,
+                                   mode=options.cache_mode)
         elif cache:
             self.cache = cache
         else:
             self.cache = False
+        if options.profile:
+            self.profiler = Profiler(options.profile_files)
+        else:
+            self.profiler = NULL_PROFILER
+        if self.cache:
+            self.cache.profiler = self.profiler
         self.plugins = []
-        self.extensions = [x.extension for x in
-                           kurt.plugin.Kurt.plugins.values()]
+        self.sink = None
+        self.state = None
+        self.positions = deque()  # The positions of the files of the shard
+        import kurt
+        self.extensions = frozenset(x.extension for x in
+                                    kurt.plugin.Kurt.plugins.values())
 
     def hairball_files(self, paths, extensions):
-        """Yield filepath to files with the proper extension within paths."""
-        def add_file(filename):
-            return os.path.splitext(filename)[1] in extensions
-
-        while paths:
-            arg_path = paths.pop(0)
-            if os.path.isdir(arg_path):
-                found = False
-                for path, dirs, files in os.walk(arg_path):
-                    dirs.sort()  # Traverse in sorted order
-                    for filename in sorted(files):
-                        if add_file(filename):
-                            yield os.path.join(path, filename)
+        """Yield filepath to files with the proper extension within paths.
+
+        paths can be any iterable, e.g., a generator of the paths read from a
+        --files-from file, and is consumed as files are yielded. The files
+        within the zip and tar archives among paths are yielded as
+        ArchiveMembers in the order they are stored.
+
+        """
+        pool = None
+        if self.options.walk_threads > 1:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(self.options.walk_threads)
+        try:
+            for arg_path in paths:
+                if os.path.isdir(arg_path):
+                    found = False
+                    for filename in walk_files(arg_path, extensions, pool):
+                        yield filename
+                        found = True
+                    if not found:
+                        if not self.options.quiet:
+                            print('No files found in {}'.format(arg_path))
+                elif os.path.splitext(arg_path)[1] in extensions:
+                    yield arg_path
+                elif is_archive(arg_path):
+                    found = False
+                    try:
+                        for member in archive_members(arg_path, extensions):
+                            yield member
                             found = True
-                if not found:
-                    if not self.options.quiet:
-                        print('No files found in {}'.format(arg_path))
-            elif add_file(arg_path):
-                yield arg_path
-            elif not self.options.quiet:
-                print('Invalid file {}'.format(arg_path))
-                print('Did you forget to load a Kurt plugin (-k)?')
+                    except ARCHIVE_ERRORS as exc:
+                        if not self.options.quiet:
+                            print('Cannot read archive {}: {}'
+                                  .format(arg_path, exc))
+                    else:
+                        if not found and not self.options.quiet:
+                            print('No files found in {}'.format(arg_path))
+                elif not self.options.quiet:
+                    print('Invalid file {}'.format(arg_path))
+                    print('Did you forget to load a Kurt plugin (-k)?')
+        finally:
+            if pool:
+                pool.terminate()
+
+    def shard_files(self, files):
+        """Yield the files of the --shard in the order they were found.
+
+        Files are assigned to a shard by the checksum of their contents, thus
+        every run over the same files assigns them alike. The position of each
+        file among every file found is appended to `positions` as the file
+        is yielded. Files that cannot be read belong to the first shard, which
+        reports them.
+
+        """
+        index, count = self.options.shard or (1, 1)
+        for position, filename in enumerate(files):
+            if count > 1:
+                try:
+                    if self.cache:
+                        key = self.cache.file_key(filename)
+                    else:
+                        key = file_digest(filename)
+                    shard = int(key[:8], 16) % count + 1
+                except (IOError, OSError):
+                    shard = 1
+                if shard != index:
+                    continue
+            self.positions.append(position)
+            yield filename
+
+    def input_paths(self):
+        """Return an iterator over the PATH arguments and --files-from paths.
+
+        The paths of the --files-from file are read as they are needed.
+
+        """
+        if not self.options.files_from:
+            return iter(self.paths)
+        separator = '\0' if self.options.null else '\n'
+        if self.options.files_from == '-':
+            files_from = read_paths(sys.stdin, separator)
+        else:
+            files_from = self._read_files_from(separator)
+        return itertools.chain(self.paths, files_from)
+
+    def _read_files_from(self, separator):
+        """Yield the paths of the --files-from file."""
+        with open(self.options.files_from, 'rb') as fp:
+            for path in read_paths(fp, separator):
+                yield path
 
     def finalize(self):
         """Indicate that analysis is complete.
@@ -164,84 +184,338 @@ class Hairball(object):
         allowing them to output any aggregate results or perform any clean-up.
 
         """
-        for plugin in self.plugins:
-            plugin.finalize()
+        if self.sink:
+            self.sink.close()
+        if self.state:
+            self.state.close()
+        if not self.options.watch:  # Watch mode finalizes after each poll
+            for plugin in self.plugins:
+                plugin.finalize()
+        if self.profiler.enabled:
+            self.profiler.report()
 
     def initialize_plugins(self):
         """Attempt to Load and initialize all the plugins.
 
-        Any issues loading plugins will be output to stderr.
+        Plugins are found via the PluginRegistry, which prefers the plugins of
+        --plugin-dir over similarly named plugins included with Hairball. Any
+        issues loading plugins will be output to stderr.
 
         """
+        from .plugins import HairballPlugin
+        registry = PluginRegistry(self.options.plugin_dir)
         for plugin_name in self.options.plugin:
-            parts = plugin_name.split('.')
-            if len(parts) > 1:
-                module_name = '.'.join(parts[:-1])
-                class_name = parts[-1]
-            else:
-                # Use the titlecase format of the module name as the class name
-                module_name = parts[0]
-                class_name = parts[0].title()
-
-            # First try to load plugins from the passed in plugins_dir and then
-            # from the hairball.plugins package.
-            plugin = None
-            for package in (None, 'hairball.plugins'):
-                if package:
-                    module_name = '{}.{}'.format(package, module_name)
-                try:
-                    module = __import__(module_name, fromlist=[class_name])
-                    # Initializes the plugin by calling its constructor
-                    plugin = getattr(module, class_name)()
-
-                    # Verify plugin is of the correct class
-                    if not isinstance(plugin, HairballPlugin):
-                        sys.stderr.write('Invalid type for plugin {}: {}\n'
-                                         .format(plugin_name, type(plugin)))
-                        plugin = None
-                    else:
-                        break
-                except (ImportError, AttributeError):
-                    pass
-            if plugin:
-                self.plugins.append(plugin)
-            else:
+            entry = registry.find(plugin_name)
+            if entry is None:
                 sys.stderr.write('Cannot find plugin {}\n'.format(plugin_name))
+                continue
+            try:
+                module = importlib.import_module(entry['module'])
+                # Initializes the plugin by calling its constructor
+                plugin = getattr(module, entry['class'])()
+            except (ImportError, AttributeError) as exc:
+                sys.stderr.write('Cannot load plugin {}: {}\n'
+                                 .format(plugin_name, exc))
+                continue
+            # Verify plugin is of the correct class
+            if not isinstance(plugin, HairballPlugin):
+                sys.stderr.write('Invalid type for plugin {}: {}\n'
+                                 .format(plugin_name, type(plugin)))
+                continue
+            plugin.verbose = not self.options.silent_plugins
+            plugin.profiler = self.profiler
+            plugin.settings = self.options.plugin_option
+            self.plugins.append(plugin)
         if not self.plugins:
             sys.stderr.write('No plugins loaded. Goodbye!\n')
             sys.exit(1)
 
+    def fresh_plugins(self):
+        """Return new instances of the loaded plugins."""
+        plugins = []
+        for plugin in self.plugins:
+            plugins.append(plugin.__class__())
+            plugins[-1].verbose = plugin.verbose
+            plugins[-1].profiler = self.profiler
+            plugins[-1].settings = plugin.settings
+        return plugins
+
+    def load(self, filename):
+        """Return the kurt Project for filename making use of the cache."""
+        if self.cache:
+            return self.cache.load(filename)
+        from .loader import load_analysis_project, load_project
+        with self.profiler.section('parse'):
+            if self.options.cache_mode == 'analysis':
+                return load_analysis_project(filename)
+            return load_project(filename)
+
     def process(self):
         """Run the analysis across all files found in the given paths.
 
         Each file is loaded once and all plugins are run against it before
-        loading the next file.
+        loading the next file. When more than one job is requested the files
+        are distributed across a pool of worker processes.
 
         """
-        for filename in self.hairball_files(self.paths, self.extensions):
+        if self.options.output:
+            self.sink = SINKS[self.options.output_format](self.options.output)
+        if self.options.watch:
+            return self.watch()
+        if self.options.save_state:
+            self.state = StateWriter(self.options.save_state,
+                                     self.fresh_plugins(),
+                                     self.options.shard or (1, 1))
+        if self.options.jobs > 1:
+            return self.process_parallel()
+        files = self.profiler.iterate(self.shard_files(
+            self.hairball_files(self.input_paths(), self.extensions)), 'find')
+        if self.options.prefetch:
+            files = Prefetcher(self.load, files, self.options.prefetch,
+                               self.profiler)
+        else:
+            files = ((filename, None) for filename in files)
+        for filename, load in files:
             if not self.options.quiet:
                 print(filename)
-            try:
-                if self.cache:
-                    scratch = self.cache.load(filename)
-                else:
-                    scratch = kurt.Project.load(filename)
-            except Exception:  # pylint: disable=W0703
-                traceback.print_exc()
-                continue
-            for plugin in self.plugins:
-                # pylint: disable=W0212
-                plugin._process(scratch, filename=filename)
-                # pylint: enable=W0212
+            position = self.positions.popleft()
+            if self.state:  # Keep the partial state of each file
+                partials = self.fresh_plugins()
+                with self.profiler.file(filename):
+                    results = self.analyze(filename, partials, load)
+                if results is not None:
+                    self.save_partials(position, filename, partials)
+            else:
+                with self.profiler.file(filename):
+                    results = self.analyze(filename, self.plugins, load)
+            if self.sink and results is not None:
+                self.write_results(filename, [jsonable(x) for x in results])
 
+    def save_partials(self, position, filename, partials):
+        """Write partials to the state file and merge them into the plugins.
 
-def main():
-    """The entrypoint for the hairball command installed via setup.py."""
-    description = ('PATH can be either the path to a scratch file, or a '
-                   'directory containing scratch files. Multiple PATH '
-                   'arguments can be provided.')
-    parser = OptionParser(usage='%prog -p PLUGIN_NAME [options] PATH...',
-                          description=description,
+        partials are the plugin instances that analyzed only the file at
+        position.
+
+        """
+        if self.state:
+            self.state.write(position, filename, partials)
+        for plugin, partial in zip(self.plugins, partials):
+            plugin.merge(partial)
+
+    def write_results(self, filename, results):
+        """Write the JSON serializable result of each plugin to the sink."""
+        for plugin, result in zip(self.plugins, results):
+            self.sink.write(filename, plugin.import_name, result)
+
+    def analyze(self, filename, plugins, load=None):
+        """Run each plugin against filename and return the list of results.
+
+        When the result cache is enabled, plugins whose results for the file's
+        contents are cached restore them rather than analyzing the file, and
+        the file is only loaded if at least one plugin has to analyze it.
+
+        The file is loaded by calling load when provided, e.g., to obtain a
+        prefetched project, or otherwise by `Hairball.load`.
+
+        Returns None, after outputting the traceback, if the file could not be
+        loaded. The contents of a MemoryFile are released once analyzed.
+
+        """
+        try:
+            results = [None] * len(plugins)
+            pending = range(len(plugins))
+            key = None
+            if self.options.result_cache and self.cache:
+                with self.profiler.section('cache key'):
+                    key = self.cache.file_key(filename)
+                pending = []
+                for i, plugin in enumerate(plugins):
+                    with self.profiler.section('result cache'):
+                        found, result = self.cache.load_result(
+                            key, plugin.import_name, plugin.result_version())
+                    if found:
+                        plugin.restore(result, filename=filename)
+                        results[i] = result
+                    else:
+                        pending.append(i)
+            if pending:
+                try:
+                    with self.profiler.section('load'):
+                        scratch = load() if load else self.load(filename)
+                except Exception:  # pylint: disable=W0703
+                    import traceback
+                    traceback.print_exc()
+                    return None
+                if self.profiler.enabled:  # Separate the work plugins share
+                    from .plugins import HairballPlugin
+                    with self.profiler.section('stream'):
+                        HairballPlugin.block_stream(scratch)
+                    with self.profiler.section('events'):
+                        HairballPlugin.event_graph(scratch)
+                    with self.profiler.section('reachable'):
+                        HairballPlugin.tag_reachable_scripts(scratch)
+                for i in pending:
+                    with self.profiler.section(plugins[i].import_name):
+                        # pylint: disable=W0212
+                        results[i] = plugins[i]._process(scratch,
+                                                         filename=filename)
+                        # pylint: enable=W0212
+                    if key:
+                        with self.profiler.section('result cache'):
+                            self.cache.save_result(key, plugins[i].import_name,
+                                                   plugins[i].result_version(),
+                                                   results[i])
+            return results
+        finally:
+            if isinstance(filename, MemoryFile):
+                filename.release()  # Its contents are no longer needed
+
+    def create_pool(self):
+        """Return a pool of `options.jobs` worker processes."""
+        import multiprocessing
+        return multiprocessing.Pool(self.options.jobs, _worker_initialize,
+                                    (self.options, self.cache))
+
+    def watch(self):
+        """Analyze the files that are added or changed until interrupted.
+
+        See `hairball.watch.Watcher`.
+
+        """
+        from .watch import Watcher
+        watcher = Watcher(self, self.options.manifest,
+                          self.options.watch_interval)
+        if self.options.jobs == 1:
+            return watcher.run()
+        pool = self.create_pool()
+        try:
+            watcher.run(pool)
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def process_parallel(self):
+        """Run the analysis across a pool of `options.jobs` processes.
+
+        Each worker runs a fresh instance of every plugin against a single
+        file. Those instances are sent back and merged into this instance's
+        plugins in the same order the files were found, thus the aggregate
+        results match those of a serial run.
+
+        The pool consumes the files as fast as they are found, thus at most
+        a few files per job are found ahead of those analyzed, which bounds
+        the memory held by the contents of archive members.
+
+        """
+        window = threading.Semaphore(self.options.jobs * 2)
+        stopped = []
+
+        def throttle(files):
+            for filename in files:
+                window.acquire()
+                if stopped:
+                    return
+                yield filename
+
+        pool = self.create_pool()
+        try:
+            files = self.shard_files(
+                self.hairball_files(self.input_paths(), self.extensions))
+            results = pool.imap(_worker_process, throttle(
+                self.profiler.iterate(files, 'find')))
+            for (filename, output, errors, partials, records,
+                 profiler) in results:
+                window.release()
+                if not self.options.quiet:
+                    print(filename)
+                sys.stdout.write(output)
+                sys.stderr.write(errors)
+                if profiler:
+                    self.profiler.merge(profiler)
+                position = self.positions.popleft()
+                if partials is None:
+                    continue
+                self.save_partials(position, filename, partials)
+                if self.sink:
+                    self.write_results(filename, records)
+        finally:
+            stopped.append(True)
+            window.release()  # Let the pool stop consuming the files
+            pool.close()
+            pool.join()
+
+
+# The Hairball instance used within each worker process of a parallel run
+_WORKER = None
+
+
+def _worker_initialize(options, cache):
+    """Load the kurt plugins and hairball plugins in a worker."""
+    global _WORKER  # pylint: disable=W0603
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # The parent handles it
+    _WORKER = Hairball(options, [], cache=cache)
+    _WORKER.initialize_plugins()
+
+
+def _worker_process(filename):
+    """Run fresh instances of the worker's plugins against filename.
+
+    Returns a tuple containing the filename, the output and error output
+    produced while analyzing the file, the list of plugin instances (None if
+    the file could not be loaded), and the JSON serializable results of the
+    plugins when results are output, and the Profiler of the file when
+    profiling. Output is captured so that the parent can emit it in file
+    order.
+
+    """
+    profiler = None
+    if _WORKER.options.profile:
+        profiler = _WORKER.profiler = Profiler(_WORKER.options.profile_files)
+        if _WORKER.cache:
+            _WORKER.cache.profiler = profiler
+    plugins = _WORKER.fresh_plugins()
+    records = None
+    stdout, sys.stdout = sys.stdout, StringIO()
+    stderr, sys.stderr = sys.stderr, StringIO()
+    try:
+        with _WORKER.profiler.file(filename):
+            results = _WORKER.analyze(filename, plugins)
+        if results is None:
+            plugins = None
+        elif _WORKER.options.output:
+            records = [jsonable(x) for x in results]
+        output, errors = sys.stdout.getvalue(), sys.stderr.getvalue()
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+    return filename, output, errors, plugins, records, profiler
+
+
+def parse_arguments(argv, server=False):
+    """Return the options and PATH arguments parsed from argv.
+
+    When server is True, the options of `hairball serve` are parsed instead
+    and no PATH arguments are accepted.
+
+    The parser exits with an error message when the arguments are invalid.
+
+    """
+    if server:
+        description = ('Run a server that keeps the plugins loaded and '
+                       'analyzes the projects submitted to it. See the '
+                       'README for the API.')
+        usage = '%prog serve -p PLUGIN_NAME [options]'
+    else:
+        description = ('PATH can be either the path to a scratch file, a '
+                       'directory containing scratch files, or a zip or tar '
+                       'archive (optionally compressed) containing scratch '
+                       'files. Multiple PATH arguments can be provided. '
+                       'Run `%prog cache --help` for the commands that '
+                       'maintain the cache, `%prog serve --help` to run '
+                       'Hairball as a server, and `%prog merge --help` to '
+                       'combine the results of the shards of a run.')
+        usage = '%prog -p PLUGIN_NAME [options] [PATH...]'
+    parser = OptionParser(usage=usage, description=description,
                           version='%prog {}'.format(__version__))
     parser.add_option('-d', '--plugin-dir', metavar='DIR',
                       help=('Specify the path to a directory containing '
@@ -251,29 +525,223 @@ def main():
     parser.add_option('-p', '--plugin', action='append',
                       help=('Use the named plugin to perform analysis. '
                             'This option can be provided multiple times.'))
+    if not server:
+        parser.add_option('-l', '--list-plugins', action='store_true',
+                          help=('Output the name and summary of each '
+                                'available plugin, including those of '
+                                '--plugin-dir, and exit.'))
     parser.add_option('-k', '--kurt-plugin', action='append',
                       help=('Provide either a python import path (e.g, '
                             'kelp.octopi) to a package/module, or the path'
                             ' to a python file, which will be loaded as a '
                             'Kurt plugin. This option can be provided '
                             'multiple times.'))
+    if not server:
+        parser.add_option('-i', '--files-from', metavar='FILE',
+                          help=('Also analyze the paths listed in FILE (`-` '
+                                'for stdin), one per line. The paths are read '
+                                'as they are needed, thus they can be piped '
+                                'from a program that is still finding them.'))
+        parser.add_option('-0', '--null', action='store_true',
+                          help=('The paths in the --files-from file are '
+                                'separated by NUL characters rather than '
+                                'newlines, e.g., the output of `find '
+                                '-print0`.'))
+        parser.add_option('--walk-threads', metavar='N', type='int',
+                          default=1,
+                          help=('List the subdirectories of each directory '
+                                'using N threads, which helps on network file '
+                                'systems. Files are found in the same order '
+                                'regardless (default: %default).'))
+        parser.add_option('--shard', metavar='i/N',
+                          help=('Only analyze the i-th of N shards of the '
+                                'files found, which are assigned to shards by '
+                                'the checksum of their contents. Run each '
+                                'shard with --save-state to combine their '
+                                'results via `hairball merge`.'))
+        parser.add_option('--save-state', metavar='FILE',
+                          help=('Write the partial state of the plugins for '
+                                'each file to FILE, which `hairball merge` '
+                                'combines with the states of the other '
+                                'shards. FILE is complete once the run is.'))
+    parser.add_option('-O', '--plugin-option', metavar='NAME=VALUE',
+                      action='append', default=[],
+                      help=('Provide a setting to the plugins, e.g., '
+                            '`memory=256M`. Prefix NAME with the class name '
+                            'of a plugin followed by a dot to only provide '
+                            'it to that plugin. This option can be provided '
+                            'multiple times.'))
     parser.add_option('-q', '--quiet', action='store_true',
                       help=('Prevent output from Hairball. Plugins may still '
                             'produce output.'))
     parser.add_option('-C', '--no-cache', action='store_true',
                       help='Do not use Hairball\'s cache.', default=False)
-    options, args = parser.parse_args(sys.argv[1:])
-
+    parser.add_option('-s', '--cache-size', metavar='SIZE',
+                      help=('Evict the least recently used entries from the '
+                            'cache to keep it within SIZE, e.g., 500M or '
+                            '10G. By default the cache is unbounded.'))
+    parser.add_option('-m', '--cache-mode', metavar='MODE',
+                      choices=sorted(KurtCache.MODES), default='full',
+                      help=('Either `full` to load and cache entire '
+                            'projects, or `analysis` to load and cache only '
+                            'what is needed for analysis (no costumes, sounds '
+                            'or thumbnails), in which case only the scripts '
+                            'of Scratch 2.0 files are read. Media are loaded '
+                            'from the original file when a plugin accesses '
+                            'them (default: %default).'))
+    parser.add_option('-R', '--result-cache', action='store_true',
+                      help=('Store the results of each plugin in the cache. '
+                            'Files whose results are cached for every plugin '
+                            'are not loaded again until either the file or a '
+                            'plugin\'s code changes.'))
+    parser.add_option('-o', '--output', metavar='FILE',
+                      help=('Write the results of each plugin for each file '
+                            'to FILE (`-` for stdout) as they are produced.'))
+    parser.add_option('-f', '--output-format', metavar='FORMAT',
+                      choices=sorted(SINKS), default='ndjson',
+                      help=('The format of the --output file: `ndjson` for '
+                            'one JSON object per line, or `csv` (default: '
+                            '%default).'))
+    parser.add_option('-S', '--silent-plugins', action='store_true',
+                      help=('Prevent plugins from producing output while '
+                            'analyzing files. Output produced upon completion '
+                            'is unaffected.'))
+    parser.add_option('--prefetch', metavar='K', type='int', default=0,
+                      help=('Load the projects of the next K files on '
+                            'background threads while a file is analyzed '
+                            'to overlap I/O with analysis, which helps when '
+                            'files are on slow or network storage. Only '
+                            'applies to single process runs (default: '
+                            '%default).'))
+    parser.add_option('-P', '--profile', action='store_true',
+                      help=('Output a report of the time and memory spent in '
+                            'each phase of the run and each plugin, as well '
+                            'as the slowest files, to stderr upon '
+                            'completion.'))
+    parser.add_option('--profile-files', metavar='N', type='int', default=10,
+                      help=('The number of slowest files to include in the '
+                            '--profile report (default: %default).'))
+    if server:
+        parser.add_option('-b', '--bind', metavar='ADDRESS',
+                          default='127.0.0.1:8000',
+                          help=('The HOST:PORT to listen on (default: '
+                                '%default).'))
+        parser.add_option('-u', '--socket', metavar='PATH',
+                          help=('Listen on the Unix socket at PATH rather '
+                                'than on --bind.'))
+        parser.add_option('--allow-paths', action='store_true',
+                          help=('Accept the projects of a batch given by '
+                                'their path on the server, which lets any '
+                                'client analyze the files the server can '
+                                'read.'))
+    parser.add_option('-w', '--watch', action='store_true',
+                      help=('Keep running, and analyze the files within PATH '
+                            'that are added or changed. The aggregate '
+                            'results are output after each change. Files are '
+                            'tracked via a manifest such that unchanged files '
+                            'are not analyzed again after a restart.'))
+    parser.add_option('--watch-interval', metavar='SECONDS', type='float',
+                      default=2.0,
+                      help=('The number of seconds between checks for '
+                            'changes (default: %default).'))
+    parser.add_option('--manifest', metavar='FILE',
+                      help=('The file that tracks the watched files '
+                            '(default: a file in the cache directory '
+                            'specific to the PATH arguments).'))
+    parser.add_option('-j', '--jobs', metavar='N', type='int', default=1,
+                      help=('Analyze the files using N worker processes '
+                            '(default: %default).'))
+    options, args = parser.parse_args(argv)
+
+    if options.plugin_dir and not os.path.isdir(options.plugin_dir):
+        parser.error('{} is not a directory'.format(options.plugin_dir))
+    if not server and options.list_plugins:
+        return options, args
     if not options.plugin:
         parser.error('At least one plugin must be specified via -p.')
-    if not args:
-        parser.error('At least one PATH must be provided.')
+    if server:
+        if args:
+            parser.error('No PATH arguments are accepted.')
+        if options.watch or options.output or options.jobs != 1:
+            parser.error('The server does not support --watch, --output or '
+                         '--jobs.')
+        host, _, port = options.bind.rpartition(':')
+        if not port.isdigit():
+            parser.error('Invalid address: {}'.format(options.bind))
+        options.bind = (host or '127.0.0.1', int(port))
+    elif not args and not options.files_from:
+        parser.error('At least one PATH or --files-from must be provided.')
+    elif options.files_from and options.watch:
+        parser.error('--files-from cannot be used with --watch.')
+    elif options.watch and any(is_archive(x) for x in args):
+        parser.error('Archives cannot be used with --watch.')
+    elif (options.shard or options.save_state) and options.watch:
+        parser.error('--shard and --save-state cannot be used with --watch.')
+    elif options.walk_threads < 1:
+        parser.error('The number of walk threads must be at least 1.')
+    if not server and options.shard:
+        try:
+            options.shard = parse_shard(options.shard)
+        except ValueError as exc:
+            parser.error(str(exc))
+    if options.jobs < 1:
+        parser.error('The number of jobs must be at least 1.')
+    if options.prefetch < 0:
+        parser.error('The number of files to prefetch cannot be negative.')
+    if options.no_cache and options.result_cache:
+        parser.error('The result cache cannot be used with --no-cache.')
+    if options.cache_size:
+        try:
+            options.cache_size = parse_size(options.cache_size)
+        except ValueError as exc:
+            parser.error(str(exc))
+
+    settings = {}
+    for setting in options.plugin_option:
+        name, equals, value = setting.partition('=')
+        if not name or not equals:
+            parser.error('Invalid plugin option: {}'.format(setting))
+        settings[name] = value
+    options.plugin_option = settings
+    return options, args
+
+
+def serve_main(argv):
+    """The entrypoint for the `hairball serve` command."""
+    from .server import AnalysisServer
+    options, _ = parse_arguments(argv, server=True)
+    if options.plugin_dir:
+        sys.path.append(options.plugin_dir)
+    hairball = Hairball(options, [], cache=not options.no_cache)
+    hairball.initialize_plugins()
+    server = AnalysisServer.create(hairball, address=options.bind,
+                                   socket_path=options.socket)
+    if not options.quiet:
+        print('Serving on {}'.format(options.socket or
+                                     '{}:{}'.format(*server.server_address)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    if hairball.profiler.enabled:
+        hairball.profiler.report()
+
 
+def main():
+    """The entrypoint for the hairball command installed via setup.py."""
+    if sys.argv[1:2] == ['cache']:
+        return cache_main(sys.argv[2:])
+    elif sys.argv[1:2] == ['merge']:
+        return merge_main(sys.argv[2:])
+    elif sys.argv[1:2] == ['serve']:
+        return serve_main(sys.argv[2:])
+    options, args = parse_arguments(sys.argv[1:])
+    if options.list_plugins:
+        return PluginRegistry(options.plugin_dir).output()
     if options.plugin_dir:
-        if os.path.isdir(options.plugin_dir):
-            sys.path.append(options.plugin_dir)
-        else:
-            parser.error('{} is not a directory'.format(options.plugin_dir))
+        sys.path.append(options.plugin_dir)
 
     hairball = Hairball(options, args, cache=not options.no_cache)
     hairball.initialize_plugins()
@@ -0,0 +1,170 @@
+"""This module provides the projects within zip and tar archives.
+
+Archives given as PATH are read sequentially, in the order of their members,
+and each member with the extension of a Kurt plugin is yielded along with
+its contents, thus a corpus need not be extracted to be analyzed. The name of
+a member is the path of the archive joined with its path within the archive,
+e.g., `corpus.tar.gz/alice/game.sb2`, and members are keyed in the cache by
+the sha1sum of their contents like any other file.
+
+"""
+
+import os
+import tarfile
+import zipfile
+import zlib
+from hashlib import sha1
+from io import BytesIO
+
+
+# The extensions of the archives that are read (compared in lowercase)
+ARCHIVE_EXTENSIONS = ('.tar', '.tar.bz2', '.tar.gz', '.tbz', '.tbz2', '.tgz',
+                      '.zip')
+
+# The exceptions raised by reading a corrupt or truncated archive
+ARCHIVE_ERRORS = (EnvironmentError, EOFError, NotImplementedError,
+                  tarfile.TarError, zipfile.BadZipfile, zlib.error)
+
+
+def is_archive(path):
+    """Return whether path has the extension of an archive."""
+    return path.lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+class MemoryFile(str):
+
+    """The name of a file whose contents are held in memory.
+
+    As a str, the name is used wherever the name of a file is, and its
+    extension determines the format of the file. The file is keyed in the
+    cache by `digest`, the sha1sum of its contents, rather than by the stat
+    of a path. The contents are released via `release` once the file has
+    been analyzed.
+
+    """
+
+    def __new__(cls, name, data, digest=None):
+        """Return the file named name containing data.
+
+        :param digest: The sha1sum of data, which is computed when None.
+
+        """
+        self = str.__new__(cls, name)
+        self.data = data
+        self.digest = digest or sha1(data).hexdigest()
+        return self
+
+    def __reduce__(self):
+        """Return the arguments that recreate the file when unpickled."""
+        return MemoryFile, (str(self), self.data, self.digest)
+
+    def open(self):
+        """Return a file object of the contents of the file."""
+        if self.data is None:
+            raise IOError('The contents of {} were released'.format(self))
+        return BytesIO(self.data)
+
+    def release(self):
+        """Release the contents held by the file."""
+        self.data = None
+
+
+class ArchiveMember(MemoryFile):
+
+    """The name of a member of an archive that holds the member's contents.
+
+    Once the contents are released, `open` reads the member from the archive
+    again.
+
+    """
+
+    def __new__(cls, archive, member, data, digest=None):
+        """Return the member named member of the archive at path archive."""
+        self = MemoryFile.__new__(cls, os.path.join(archive, member), data,
+                                  digest)
+        self.archive = archive
+        self.member = member
+        return self
+
+    def __reduce__(self):
+        """Return the arguments that recreate the member when unpickled."""
+        return ArchiveMember, (self.archive, self.member, self.data,
+                               self.digest)
+
+    def open(self):
+        """Return a file object of the contents of the member."""
+        if self.data is None:
+            return BytesIO(read_member(self.archive, self.member))
+        return BytesIO(self.data)
+
+
+def archive_members(path, extensions):
+    """Yield an ArchiveMember for each file of the archive with extensions.
+
+    Members are yielded in the order they are stored within the archive, and
+    tar archives (compressed or not) are read as a stream.
+
+    """
+    if path.lower().endswith('.zip'):
+        archive = zipfile.ZipFile(path)
+        try:
+            for info in archive.infolist():
+                if not info.filename.endswith('/') and \
+                        os.path.splitext(info.filename)[1] in extensions:
+                    yield ArchiveMember(path, info.filename,
+                                        archive.read(info))
+        finally:
+            archive.close()
+        return
+    archive = tarfile.open(path, 'r|*')
+    try:
+        for info in archive:
+            if info.isfile() and \
+                    os.path.splitext(info.name)[1] in extensions:
+                yield ArchiveMember(path, info.name,
+                                    archive.extractfile(info).read())
+    finally:
+        archive.close()
+
+
+def read_member(archive, member):
+    """Return the contents of member within the archive at path archive.
+
+    Raise KeyError when the archive has no such member.
+
+    """
+    if archive.lower().endswith('.zip'):
+        with zipfile.ZipFile(archive) as fp:
+            return fp.read(member)
+    with tarfile.open(archive) as fp:
+        return fp.extractfile(member).read()
+
+
+def split_archive_path(path):
+    """Return the (archive, member) a path within an archive refers to.
+
+    Return None unless a leading part of path is an existing archive.
+
+    """
+    for index, char in enumerate(path):
+        if char in ('/', os.sep) and is_archive(path[:index]) and \
+                os.path.isfile(path[:index]):
+            return path[:index], path[index + 1:]
+    return None
+
+
+def open_file(filename):
+    """Return a file object for reading filename.
+
+    filename is either a MemoryFile, the name of a member within an
+    archive (e.g., the path of a project loaded from an archive), or the path
+    to a file.
+
+    """
+    if isinstance(filename, MemoryFile):
+        return filename.open()
+    if not os.path.exists(filename):
+        location = split_archive_path(filename)
+        if location:
+            return BytesIO(read_member(*location))
+    return open(filename, 'rb')
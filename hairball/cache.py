@@ -0,0 +1,504 @@
+"""This module provides Hairball's on-disk cache of processed Kurt objects.
+
+The modules only needed once the cache is used (e.g., appdirs, cPickle and
+sqlite3) are imported upon first use, as every run of Hairball imports this
+module.
+
+"""
+
+from __future__ import print_function
+import errno
+import os
+import re
+import thread
+import threading
+import time
+from hashlib import sha1
+from optparse import OptionParser
+from .archives import MemoryFile
+from .profiling import NULL_PROFILER
+
+
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3,
+              'T': 1024 ** 4}
+
+
+def default_cache_dir():
+    """Return the path of the default cache directory of the user."""
+    import appdirs
+    return appdirs.user_cache_dir(appname='Hairball', appauthor='bboe')
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """Return the sha1sum of the contents of the file at path."""
+    if isinstance(path, MemoryFile):
+        return path.digest
+    checksum = sha1()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), ''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def parse_size(text):
+    """Return the number of bytes represented by text, e.g., 512M or 2G."""
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*$', text, re.I)
+    if not match:
+        raise ValueError('Invalid size: {}'.format(text))
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).upper()])
+
+
+def format_size(size):
+    """Return a human readable representation of size bytes."""
+    for unit in ('', 'K', 'M', 'G'):
+        if size < 1024:
+            break
+        size /= 1024.
+    else:
+        unit = 'T'
+    return '{:.1f}{}B'.format(size, unit) if unit else '{}B'.format(size)
+
+
+class KurtCache(object):
+
+    """Interface to an on-disk cache of processed Kurt objects.
+
+    The cached files are tracked by an index file within the cache directory
+    that records the size and last access time of every entry, as well as
+    the key of every previously loaded file by its stat information. The
+    cached results of plugins are stored within the index itself, and count
+    toward its size like the cached files. The index is only opened when
+    first needed, so creating a cache costs the same regardless of the
+    number of entries. When a byte budget (max_size) is provided the least
+    recently used entries and results are evicted to stay within it.
+
+    """
+
+    CHUNK_SIZE = 1 << 20
+    INDEX_FILENAME = 'index.sqlite'
+    # Incremented when the schema of the index changes
+    INDEX_VERSION = 1
+    # The number of least recently used entries prune reads at a time
+    PRUNE_BATCH = 256
+    # The suffix appended to the key of the entries stored by each mode
+    MODES = {'full': '', 'analysis': '-analysis'}
+    # Records the time spent in each phase of loading, see hairball.profiling
+    profiler = NULL_PROFILER
+
+    @staticmethod
+    def path_to_key(filepath):
+        """Return the sha1sum (key) belonging to the file at filepath."""
+        tmp, last = os.path.split(filepath)
+        tmp, middle = os.path.split(tmp)
+        return '{}{}{}'.format(os.path.basename(tmp), middle,
+                               os.path.splitext(last)[0])
+
+    def __init__(self, cache_dir=None, max_size=None, mode='full'):
+        """Initialize the cache located at cache_dir.
+
+        :param cache_dir: The directory of the cache (default: the directory
+          returned by `default_cache_dir`).
+        :param max_size: The maximum number of bytes the cached files may
+          occupy. The cache is unbounded when None.
+        :param mode: Either `full` to cache entire projects, or `analysis` to
+          cache and return projects that omit the costumes, sounds and
+          thumbnail (see `load_analysis_project`). Their media are loaded
+          from the original file upon access.
+
+        """
+        if mode not in self.MODES:
+            raise ValueError('Invalid cache mode: {}'.format(mode))
+        if cache_dir is None:
+            cache_dir = default_cache_dir()
+        # Create the cache directory
+        try:
+            os.makedirs(cache_dir)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise  # Don't continue without cache support
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.mode = mode
+        self._local = threading.local()
+
+    def __getstate__(self):
+        """Return the state of the cache excluding the index connections."""
+        state = self.__dict__.copy()
+        del state['_local']
+        return state
+
+    def __setstate__(self, state):
+        """Restore the state of the cache."""
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    @property
+    def index(self):
+        """Return the connection to the index opening it if necessary.
+
+        Each process and thread has its own connection.
+
+        """
+        local = self._local
+        if getattr(local, 'db', None) is None or local.pid != os.getpid():
+            import sqlite3
+            path = os.path.join(self.cache_dir, self.INDEX_FILENAME)
+            exists = os.path.isfile(path)
+            local.db = sqlite3.connect(path, timeout=60)
+            local.pid = os.getpid()
+            # The index can always be rebuilt by `verify`, so trade its
+            # durability for speed.
+            local.db.execute('PRAGMA synchronous = OFF')
+            version = local.db.execute('PRAGMA user_version').fetchone()[0]
+            if version < self.INDEX_VERSION:
+                # Results stored without their size and access time are
+                # simply recomputed.
+                local.db.executescript("""
+DROP TABLE IF EXISTS results;
+PRAGMA user_version = {};""".format(self.INDEX_VERSION))
+            with local.db:
+                local.db.executescript("""
+CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY,
+                                    size INTEGER NOT NULL,
+                                    atime REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS entries_atime ON entries (atime);
+CREATE TABLE IF NOT EXISTS totals (id INTEGER PRIMARY KEY,
+                                   size INTEGER NOT NULL);
+INSERT OR IGNORE INTO totals VALUES (0, 0);
+CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries BEGIN
+    UPDATE totals SET size = size + NEW.size; END;
+CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries BEGIN
+    UPDATE totals SET size = size - OLD.size; END;
+CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY,
+                                  size INTEGER NOT NULL,
+                                  mtime_ns INTEGER NOT NULL,
+                                  inode INTEGER NOT NULL,
+                                  key TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS results (key TEXT NOT NULL,
+                                    plugin TEXT NOT NULL,
+                                    version TEXT NOT NULL,
+                                    result BLOB NOT NULL,
+                                    size INTEGER NOT NULL,
+                                    atime REAL NOT NULL,
+                                    PRIMARY KEY (key, plugin));
+CREATE INDEX IF NOT EXISTS results_atime ON results (atime);
+CREATE TRIGGER IF NOT EXISTS results_insert AFTER INSERT ON results BEGIN
+    UPDATE totals SET size = size + NEW.size; END;
+CREATE TRIGGER IF NOT EXISTS results_delete AFTER DELETE ON results BEGIN
+    UPDATE totals SET size = size - OLD.size; END;""")
+            if not exists:  # Index the entries of an index-less cache once
+                self.verify()
+        return local.db
+
+    @property
+    def size(self):
+        """Return the number of bytes occupied by the cached files and results.
+
+        """
+        return self.index.execute('SELECT size FROM totals').fetchone()[0]
+
+    def file_key(self, filename):
+        """Return the sha1sum (key) of the contents of filename.
+
+        The key of a file is remembered along with its size, modification time
+        and inode. Thus the key of an unchanged file is determined by a single
+        stat rather than reading the file. The key of a MemoryFile (e.g., an
+        archive member) is the sha1sum of its contents.
+
+        """
+        if isinstance(filename, MemoryFile):
+            return filename.digest
+        path = os.path.abspath(filename)
+        stat = os.stat(path)
+        file_stat = (stat.st_size,
+                     getattr(stat, 'st_mtime_ns', int(stat.st_mtime * 1e9)),
+                     stat.st_ino)
+        row = self.index.execute('SELECT size, mtime_ns, inode, key '
+                                 'FROM files WHERE path = ?',
+                                 (path,)).fetchone()
+        if row and tuple(row[:3]) == file_stat:
+            return str(row[3])
+        key = file_digest(path, self.CHUNK_SIZE)
+        with self.index:
+            self.index.execute('INSERT OR REPLACE INTO files VALUES '
+                               '(?, ?, ?, ?, ?)', (path,) + file_stat + (key,))
+        return key
+
+    def key_to_path(self, key):
+        """Return the fullpath to the file with sha1sum key."""
+        return os.path.join(self.cache_dir, key[:2], key[2:4],
+                            key[4:] + '.pkl')
+
+    def add(self, key, size):
+        """Add the entry for key to the index and enforce the byte budget."""
+        with self.index:  # Delete first so the totals trigger fires
+            self.index.execute('DELETE FROM entries WHERE key = ?', (key,))
+            self.index.execute('INSERT INTO entries VALUES (?, ?, ?)',
+                               (key, size, time.time()))
+        if self.max_size is not None:
+            self.prune(self.max_size)
+
+    def discard(self, key):
+        """Remove the entry for key from the cache if it exists."""
+        try:
+            os.unlink(self.key_to_path(key))
+        except OSError as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+        with self.index:
+            self.index.execute('DELETE FROM entries WHERE key = ?', (key,))
+
+    def discard_result(self, key, plugin):
+        """Remove the cached result of plugin for the file with key."""
+        with self.index:
+            self.index.execute('DELETE FROM results WHERE key = ? AND '
+                               'plugin = ?', (key, plugin))
+
+    def prune(self, max_size):
+        """Evict the least recently used entries until within max_size bytes.
+
+        Cached files and results are evicted alike. The total size is kept
+        by the index, thus a cache within max_size is checked by a single
+        query. Otherwise the least recently used entries are read in batches
+        of PRUNE_BATCH until the excess is cleared, and are removed from the
+        index in one transaction. Returns the number of evicted entries.
+
+        """
+        excess = self.size - max_size
+        if excess <= 0:
+            return 0
+        evicted = 0
+        keys = []
+        with self.index:
+            while excess > 0:
+                rows = self.index.execute(
+                    'SELECT key, NULL, size, atime FROM entries UNION ALL '
+                    'SELECT key, plugin, size, atime FROM results '
+                    'ORDER BY atime LIMIT ?', (self.PRUNE_BATCH,)).fetchall()
+                if not rows:
+                    break
+                entries, results = [], []
+                for key, plugin, size, _ in rows:
+                    if excess <= 0:
+                        break
+                    if plugin is None:
+                        entries.append((key,))
+                    else:
+                        results.append((key, plugin))
+                    excess -= size
+                # The next batch no longer sees the deleted rows
+                self.index.executemany('DELETE FROM entries WHERE key = ?',
+                                       entries)
+                self.index.executemany('DELETE FROM results WHERE key = ? '
+                                       'AND plugin = ?', results)
+                evicted += len(entries) + len(results)
+                keys.extend(x[0] for x in entries)
+        for key in keys:  # Remove the files once the index no longer has them
+            try:
+                os.unlink(self.key_to_path(key))
+            except OSError as exc:
+                if exc.errno != errno.ENOENT:
+                    raise
+        return evicted
+
+    def stats(self):
+        """Return a dictionary of statistics about the cache."""
+        count, oldest, newest = self.index.execute(
+            'SELECT COUNT(*), MIN(atime), MAX(atime) FROM entries').fetchone()
+        results, results_size, oldest_result, newest_result = \
+            self.index.execute('SELECT COUNT(*), TOTAL(size), MIN(atime), '
+                               'MAX(atime) FROM results').fetchone()
+        if results:
+            oldest = min(x for x in (oldest, oldest_result) if x is not None)
+            newest = max(x for x in (newest, newest_result) if x is not None)
+        return {'cache_dir': self.cache_dir, 'entries': count,
+                'max_size': self.max_size, 'newest_access': newest,
+                'oldest_access': oldest, 'results': results,
+                'results_size': int(results_size), 'size': self.size}
+
+    def verify(self):
+        """Reconcile the index with the files in the cache directory.
+
+        Index entries without a corresponding file of the same size are
+        removed, and cached files missing from the index are added to it.
+        Returns a tuple containing the number of removed and added entries.
+
+        """
+        removed = added = 0
+        indexed = {}
+        for key, size in self.index.execute('SELECT key, size FROM entries'):
+            indexed[key] = size
+        for path, _, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                if not filename.endswith('.pkl'):
+                    continue
+                filepath = os.path.join(path, filename)
+                key = self.path_to_key(filepath)
+                size = os.path.getsize(filepath)
+                if key not in indexed:
+                    with self.index:
+                        self.index.execute(
+                            'INSERT INTO entries VALUES (?, ?, ?)',
+                            (key, size, os.path.getatime(filepath)))
+                    added += 1
+                elif indexed.pop(key) != size:
+                    self.discard(key)
+                    removed += 1
+        for key in indexed:  # Entries whose file no longer exists
+            self.discard(key)
+            removed += 1
+        return removed, added
+
+    def load_result(self, key, plugin, version):
+        """Return the cached result of a plugin for the file with key.
+
+        Returns a tuple whose first item indicates if the result was found.
+        Results cached by a different version of the plugin are not returned.
+
+        """
+        import cPickle
+        row = self.index.execute('SELECT result FROM results WHERE key = ? '
+                                 'AND plugin = ? AND version = ?',
+                                 (key, plugin, version)).fetchone()
+        if row:
+            try:
+                result = cPickle.loads(str(row[0]))
+            except (EOFError, cPickle.UnpicklingError):
+                self.discard_result(key, plugin)
+            else:
+                with self.index:
+                    self.index.execute('UPDATE results SET atime = ? WHERE '
+                                       'key = ? AND plugin = ?',
+                                       (time.time(), key, plugin))
+                return True, result
+        return False, None
+
+    def save_result(self, key, plugin, version, result):
+        """Store the result of a plugin for the file with key.
+
+        The result replaces any result cached by other versions of the
+        plugin. Results that cannot be pickled are not stored. The size of
+        the result counts toward the byte budget.
+
+        """
+        import cPickle
+        import sqlite3
+        try:
+            data = cPickle.dumps(result, cPickle.HIGHEST_PROTOCOL)
+        except (cPickle.PicklingError, TypeError):
+            return
+        with self.index:  # Delete first so the totals trigger fires
+            self.index.execute('DELETE FROM results WHERE key = ? AND '
+                               'plugin = ?', (key, plugin))
+            self.index.execute('INSERT INTO results VALUES (?, ?, ?, ?, ?, ?)',
+                               (key, plugin, version, sqlite3.Binary(data),
+                                len(data), time.time()))
+        if self.max_size is not None:
+            self.prune(self.max_size)
+
+    def load(self, filename):
+        """Optimized load and return the parsed version of filename.
+
+        Uses the on-disk parse cache if the file is located in it.
+
+        """
+        import cPickle
+        with self.profiler.section('cache key'):
+            key = self.file_key(filename) + self.MODES[self.mode]
+        path = self.key_to_path(key)
+        # Return the cached file if available
+        row = self.index.execute('SELECT size FROM entries WHERE key = ?',
+                                 (key,)).fetchone()
+        if row:
+            try:
+                with self.profiler.section('cache read'), open(path) as fp:
+                    scratch = cPickle.load(fp)
+                with self.index:
+                    self.index.execute('UPDATE entries SET atime = ? '
+                                       'WHERE key = ?', (time.time(), key))
+                return scratch
+            except (EOFError, IOError, cPickle.UnpicklingError):
+                self.discard(key)
+        # Create the nested cache directory
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+        # Process the file and save in the cache. Importing kurt is slow thus
+        # the loader is only imported when a file is parsed.
+        from .loader import load_analysis_project, load_project
+        from .plugins import HairballPlugin
+        with self.profiler.section('parse'):
+            if self.mode == 'analysis':
+                scratch = load_analysis_project(filename)  # can fail
+            else:
+                scratch = load_project(filename)  # can fail
+        # Store the event graph with the project. The block stream is not
+        # stored as its opcodes are specific to this process.
+        with self.profiler.section('events'):
+            HairballPlugin.event_graph(scratch)
+        stream = scratch.__dict__.pop('hairball_stream', None)
+        tmp_path = '{}.{}-{}.tmp'.format(path, os.getpid(),
+                                         thread.get_ident())
+        try:
+            with self.profiler.section('cache write'), \
+                    os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT,
+                                      0400), 'w') as fp:
+                # open file for writing but make it immediately read-only
+                cPickle.dump(scratch, fp, cPickle.HIGHEST_PROTOCOL)
+        except (cPickle.PicklingError, TypeError):
+            os.unlink(tmp_path)
+            return scratch  # The project can't be cached
+        finally:
+            if stream is not None:
+                scratch.hairball_stream = stream
+        os.rename(tmp_path, path)  # Never expose a partially written file
+        self.add(key, os.path.getsize(path))
+        return scratch
+
+
+def cache_main(argv):
+    """The entrypoint for the `hairball cache` command."""
+    description = ('Inspect and maintain Hairball\'s cache. COMMAND is one '
+                   'of: stats (output information about the cache), prune '
+                   '(evict the least recently used entries until the cache '
+                   'fits within --max-size), and verify (reconcile the '
+                   'index with the cached files).')
+    parser = OptionParser(usage='%prog cache [options] COMMAND',
+                          description=description)
+    parser.add_option('-s', '--max-size', metavar='SIZE',
+                      help=('The size the cache should fit within, e.g., '
+                            '500M or 10G.'))
+    options, args = parser.parse_args(argv)
+    if len(args) != 1 or args[0] not in ('stats', 'prune', 'verify'):
+        parser.error('Exactly one of stats, prune or verify is required.')
+    max_size = None
+    if options.max_size:
+        try:
+            max_size = parse_size(options.max_size)
+        except ValueError as exc:
+            parser.error(str(exc))
+
+    cache = KurtCache(max_size=max_size)
+    if args[0] == 'stats':
+        stats = cache.stats()
+        print('Location: {}'.format(stats['cache_dir']))
+        print('Entries:  {}'.format(stats['entries']))
+        print('Results:  {} ({})'.format(stats['results'],
+                                         format_size(stats['results_size'])))
+        print('Size:     {}'.format(format_size(stats['size'])))
+        if stats['entries'] or stats['results']:
+            for name in ('oldest', 'newest'):
+                print('{:9} {}'.format(name.title() + ':', time.ctime(
+                    stats['{}_access'.format(name)])))
+    elif args[0] == 'prune':
+        if max_size is None:
+            parser.error('prune requires --max-size.')
+        evicted = cache.prune(max_size)
+        print('Evicted {} entries. The cache now occupies {}.'
+              .format(evicted, format_size(cache.size)))
+    else:
+        removed, added = cache.verify()
+        print('Removed {} stale and added {} unindexed entries.'
+              .format(removed, added))
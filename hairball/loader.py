@@ -0,0 +1,81 @@
+"""This module provides the loader of projects used for analysis.
+
+For formats whose scripts are stored separately from their media, e.g., the
+`project.json` member of Scratch 2.0 files, only the scripts are read and
+decoded. Kurt loads all other formats in full.
+
+Projects are read via `hairball.archives.open_file`, thus the members of
+archives are loaded like the files on disk.
+
+"""
+
+import kurt
+import os
+from kurt.scratch20 import Scratch20Plugin, ZipReader
+from .archives import MemoryFile, open_file
+from .projection import analysis_projection
+
+
+class ScriptsOnlyZipReader(ZipReader):
+
+    """A Scratch 2.0 reader that only reads the project.json member.
+
+    The costumes and sounds are skipped, and thus none of the images and
+    sounds within the archive are read or decoded.
+
+    """
+
+    def load_scriptable(self, sd, is_stage=False):
+        """Load the scriptable described by sd without its media."""
+        sd = dict((key, value) for key, value in sd.items()
+                  if key not in ('costumes', 'sounds'))
+        return super(ScriptsOnlyZipReader, self).load_scriptable(sd, is_stage)
+
+
+# Mapping of Kurt plugin classes to readers that skip the media
+SCRIPTS_ONLY_READERS = {Scratch20Plugin: ScriptsOnlyZipReader}
+
+
+def load_project(filename):
+    """Return the kurt Project of filename, which may be a MemoryFile.
+
+    Files on disk are loaded by Kurt, and otherwise the format is determined
+    by the extension of filename as Kurt would.
+
+    """
+    if not isinstance(filename, MemoryFile) and os.path.exists(filename):
+        return kurt.Project.load(filename)
+    name, extension = os.path.splitext(os.path.basename(filename))
+    plugin = kurt.plugin.Kurt.get_plugin(extension=extension)
+    if not plugin:
+        raise kurt.UnknownFormat(extension)
+    with open_file(filename) as fp:
+        project = kurt.Project.load(fp, format=plugin.name)
+    project.path = str(filename)  # Not the contents of an archive member
+    if not project.name:
+        project.name = name
+    return project
+
+
+def load_analysis_project(filename):
+    """Return an AnalysisProject containing the scripts of filename.
+
+    The scripts-only reader of the file's format is used when available, and
+    otherwise the file is loaded by Kurt. In either case the media are only
+    loaded if they are accessed.
+
+    """
+    name, extension = os.path.splitext(os.path.basename(filename))
+    plugin = kurt.plugin.Kurt.get_plugin(extension=extension)
+    reader_class = SCRIPTS_ONLY_READERS.get(type(plugin))
+    if reader_class is None:
+        return analysis_projection(load_project(filename))
+    with open_file(filename) as fp:
+        reader = reader_class(fp)
+        reader.finish()
+    project = reader.project
+    project.convert(plugin)  # Normalize exactly as kurt.Project.load would
+    project.path = str(filename)
+    if not project.name:
+        project.name = name
+    return analysis_projection(project)
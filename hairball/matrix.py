@@ -0,0 +1,209 @@
+"""This module provides a sparse matrix of counts per file and name.
+
+Plugins that count named things per file (e.g., the blocks of each type) use
+a CountMatrix to keep the counts of every file of a corpus without a dict per
+file. Names are interned into column ids, and the non-zero counts of each row
+are held in flat arrays in compressed sparse row (CSR) order. Aggregates are
+computed over the arrays with numpy when it is installed, and in python
+otherwise.
+
+Saving the matrix to an `.npz` file requires numpy. The file can be loaded
+with `scipy.sparse.load_npz`, and it also contains the label of each row
+(`rows`) and the name of each column (`columns`).
+
+"""
+
+import heapq
+from array import array
+from collections import Counter
+try:
+    import numpy
+except ImportError:
+    numpy = None  # Aggregates are computed in python
+
+
+def as_ndarray(values):
+    """Return a numpy array that shares the buffer of the array values."""
+    if not values:  # frombuffer rejects empty buffers
+        return numpy.zeros(0, dtype=values.typecode)
+    return numpy.frombuffer(values, dtype=values.typecode)
+
+
+class CountMatrix(object):
+
+    """A sparse matrix of counts whose rows are labelled and columns named.
+
+    The counts of the n-th row are in positions indptr[n] up to indptr[n + 1]
+    of `data`, and `indices` holds the column id of each. Within a row the
+    counts are sorted by column id, and columns are numbered in the order
+    their names first appear, thus merging matrices in order produces the
+    same matrix as adding their rows to a single one.
+
+    """
+
+    def __init__(self):
+        """Initialize an empty matrix."""
+        self.rows = []  # The label (e.g., filename) of each row
+        self.columns = []  # The name of each column
+        self.column_ids = {}
+        self.data = array('i')
+        self.indices = array('i')
+        self.indptr = array('i', [0])
+
+    def __len__(self):
+        """Return the number of rows."""
+        return len(self.rows)
+
+    @property
+    def shape(self):
+        """Return the number of rows and columns."""
+        return len(self.rows), len(self.columns)
+
+    def column(self, name):
+        """Return the column id of name adding a column if necessary."""
+        column = self.column_ids.get(name)
+        if column is None:
+            column = self.column_ids[name] = len(self.columns)
+            self.columns.append(name)
+        return column
+
+    def add_row(self, label, counts):
+        """Add a row of the non-zero counts of mapping counts by name.
+
+        Return the index of the row.
+
+        """
+        entries = sorted((self.column(name), count) for name, count in
+                         sorted(counts.items()) if count)
+        self.rows.append(label)
+        self.indices.extend(x for x, _ in entries)
+        self.data.extend(x for _, x in entries)
+        self.indptr.append(len(self.data))
+        return len(self.rows) - 1
+
+    def count_row(self, label, values, names):
+        """Add a row that counts the occurrences of each value in values.
+
+        :param values: An array of non-negative integers, e.g., opcodes.
+        :param names: The sequence that maps each value to its name.
+
+        Return the index of the row.
+
+        """
+        if numpy is None or not values:
+            counts = Counter(values)
+        else:
+            counts = numpy.bincount(as_ndarray(values))
+            counts = dict((x, int(counts[x])) for x in counts.nonzero()[0])
+        return self.add_row(label, dict((names[value], count) for
+                                        value, count in counts.items()))
+
+    def row(self, index):
+        """Return a Counter of the counts of the row at index by name."""
+        start, stop = self.indptr[index], self.indptr[index + 1]
+        return Counter(dict((self.columns[column], count) for column, count
+                            in zip(self.indices[start:stop],
+                                   self.data[start:stop])))
+
+    def merge(self, other):
+        """Append the rows of another CountMatrix in order."""
+        columns = [self.column(name) for name in other.columns]
+        for index, label in enumerate(other.rows):
+            start, stop = other.indptr[index], other.indptr[index + 1]
+            entries = sorted((columns[column], count) for column, count in
+                             zip(other.indices[start:stop],
+                                 other.data[start:stop]))
+            self.rows.append(label)
+            self.indices.extend(x for x, _ in entries)
+            self.data.extend(x for _, x in entries)
+            self.indptr.append(len(self.data))
+
+    def subtract(self, other):
+        """Remove the rows labelled as those of another CountMatrix.
+
+        The first row with each label of other is removed, and the remaining
+        rows keep their order. Columns are never removed, although those
+        left without counts are not part of the totals.
+
+        """
+        labels = Counter(other.rows)
+        if not labels:
+            return
+        rows, data, indices, indptr = [], array('i'), array('i'), array('i')
+        indptr.append(0)
+        for index, label in enumerate(self.rows):
+            if labels[label]:
+                labels[label] -= 1
+                continue
+            start, stop = self.indptr[index], self.indptr[index + 1]
+            rows.append(label)
+            data.extend(self.data[start:stop])
+            indices.extend(self.indices[start:stop])
+            indptr.append(len(data))
+        self.rows, self.data, self.indices, self.indptr = (rows, data,
+                                                           indices, indptr)
+
+    def totals(self):
+        """Return a Counter of the sum of the counts of each column.
+
+        Columns whose counts sum to zero, e.g., after `subtract`, are omitted.
+
+        """
+        if numpy is None or not self.data:
+            sums = [0] * len(self.columns)
+            for column, count in zip(self.indices, self.data):
+                sums[column] += count
+        else:
+            sums = numpy.bincount(
+                as_ndarray(self.indices), weights=as_ndarray(self.data),
+                minlength=len(self.columns)).astype(numpy.int64).tolist()
+        return Counter(dict((name, count) for name, count in
+                            zip(self.columns, sums) if count))
+
+    def row_totals(self):
+        """Return an array of the sum of the counts of each row."""
+        sums = array('l')
+        if numpy is None or not self.data:
+            for index in xrange(len(self.rows)):
+                sums.append(sum(self.data[self.indptr[index]:
+                                          self.indptr[index + 1]]))
+        else:
+            cumulative = numpy.concatenate(([0], numpy.cumsum(
+                as_ndarray(self.data), dtype=numpy.int64)))
+            sums.extend(numpy.diff(cumulative[as_ndarray(self.indptr)])
+                        .tolist())
+        return sums
+
+    def top(self, k, index=None):
+        """Return the k (name, count) pairs with the largest counts.
+
+        Counts are summed over every row unless the index of a row is
+        provided. Pairs are ordered by descending count, then name.
+
+        """
+        counts = self.totals() if index is None else self.row(index)
+        return heapq.nsmallest(k, counts.items(), key=lambda x: (-x[1], x[0]))
+
+    def save_npz(self, path):
+        """Save the matrix to the compressed numpy file at path."""
+        if numpy is None:
+            raise ImportError('numpy is required to save a CountMatrix')
+        numpy.savez_compressed(
+            path, format='csr', shape=numpy.array(self.shape),
+            data=as_ndarray(self.data), indices=as_ndarray(self.indices),
+            indptr=as_ndarray(self.indptr),
+            rows=numpy.array(self.rows), columns=numpy.array(self.columns))
+
+    @classmethod
+    def load_npz(cls, path):
+        """Return the CountMatrix saved to the numpy file at path."""
+        if numpy is None:
+            raise ImportError('numpy is required to load a CountMatrix')
+        loaded = numpy.load(path)
+        matrix = cls()
+        matrix.rows = loaded['rows'].tolist()
+        for name in loaded['columns'].tolist():
+            matrix.column(name)
+        for attribute in ('data', 'indices', 'indptr'):
+            setattr(matrix, attribute, array('i', loaded[attribute].tolist()))
+        return matrix
@@ -0,0 +1,104 @@
+"""This module provides sinks that stream analysis results to a file."""
+
+import csv
+import json
+import sys
+
+
+def jsonable(value):
+    """Return a JSON serializable equivalent of an analysis result.
+
+    Sets become sorted lists, kurt scripts and blocks become their textual
+    representation, ScriptRefs become objects of their attributes, sprites
+    become their names and dictionary keys become strings.
+
+    """
+    if isinstance(value, dict):
+        return dict((jsonable_key(key), jsonable(item))
+                    for key, item in value.items())
+    elif isinstance(value, (set, frozenset)):
+        return sorted(jsonable(item) for item in value)
+    elif isinstance(value, (list, tuple)):
+        return [jsonable(item) for item in value]
+    elif value is None or isinstance(value, (basestring, bool, int, long,
+                                             float)):
+        return value
+    import kurt  # Imported upon use as importing kurt is slow
+    from .plugins import ScriptRef
+    if isinstance(value, (kurt.Script, kurt.Block, kurt.Comment)):
+        return value.stringify()
+    elif isinstance(value, kurt.Scriptable):
+        return value.name
+    elif isinstance(value, ScriptRef):
+        return {'sprite': value.sprite, 'index': value.index,
+                'hash': value.hash}
+    return repr(value)
+
+
+def jsonable_key(key):
+    """Return the string used in place of key within a JSON object."""
+    key = jsonable(key)
+    if isinstance(key, bool):
+        return 'true' if key else 'false'
+    elif not isinstance(key, basestring):
+        return json.dumps(key)
+    return key
+
+
+class ResultSink(object):
+
+    """Base class for sinks that write one record per file and plugin."""
+
+    BUFFER_SIZE = 1 << 20
+
+    def __init__(self, path):
+        """Open the file at path, or stdout when path is `-`."""
+        if path == '-':
+            self.fp = sys.stdout
+        else:
+            self.fp = open(path, 'wb', self.BUFFER_SIZE)
+
+    def close(self):
+        """Flush the records and close the underlying file."""
+        if self.fp is sys.stdout:
+            self.fp.flush()
+        else:
+            self.fp.close()
+
+    def write(self, filename, plugin, result):
+        """Write the result produced by the named plugin for filename.
+
+        The result must already be JSON serializable (see `jsonable`).
+
+        """
+        raise NotImplementedError('Subclass must implement this method')
+
+
+class CSVSink(ResultSink):
+
+    """Writes records as CSV rows whose result column is encoded as JSON."""
+
+    def __init__(self, path):
+        """Open the file at path and output the header row."""
+        super(CSVSink, self).__init__(path)
+        self.writer = csv.writer(self.fp)
+        self.writer.writerow(('file', 'plugin', 'result'))
+
+    def write(self, filename, plugin, result):
+        """Write a row containing the result."""
+        self.writer.writerow((filename, plugin,
+                              json.dumps(result, sort_keys=True)))
+
+
+class NDJSONSink(ResultSink):
+
+    """Writes records as newline delimited JSON objects."""
+
+    def write(self, filename, plugin, result):
+        """Write a line containing the JSON object of the record."""
+        self.fp.write(json.dumps({'file': filename, 'plugin': plugin,
+                                  'result': result}, sort_keys=True))
+        self.fp.write('\n')
+
+
+SINKS = {'csv': CSVSink, 'ndjson': NDJSONSink}
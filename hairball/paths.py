@@ -0,0 +1,139 @@
+"""This module provides the enumeration of the files to analyze.
+
+Directories are walked with scandir, whose entries know whether they are
+directories without a stat on most file systems, and files are filtered by
+their extension as they are listed. Files are yielded as soon as their
+directory is listed, in the same sorted order as `os.walk` with sorted
+directories and files. The subdirectories of a directory can be listed in
+parallel by a pool of threads, which helps on network file systems.
+
+Paths can also be read from a file of newline or NUL separated paths, in
+which case nothing is walked.
+
+"""
+
+import os
+
+
+# The scandir function, or None to fall back to os.listdir (see get_scandir)
+_SCANDIR = []
+
+
+def get_scandir():
+    """Return the scandir function, or None when it is unavailable.
+
+    The scandir package is imported upon first use, as without its C
+    extension importing it takes a noticeable part of Hairball's startup.
+
+    """
+    if not _SCANDIR:
+        try:
+            from os import scandir
+        except ImportError:
+            try:
+                from scandir import scandir
+            except ImportError:
+                scandir = None  # Fall back to os.listdir
+        _SCANDIR.append(scandir)
+    return _SCANDIR[0]
+
+
+def scan_directory(path, extensions):
+    """Return the sorted files with one of extensions and subdirectories.
+
+    Like `os.walk`, symbolic links to directories are neither included as
+    files nor as subdirectories, and directories that cannot be listed are
+    treated as empty.
+
+    """
+    files, dirs = [], []
+    scandir = get_scandir()
+    if scandir is None:
+        try:
+            names = os.listdir(path)
+        except OSError:
+            return files, dirs
+        for name in names:
+            full_path = os.path.join(path, name)
+            if os.path.isdir(full_path):
+                if not os.path.islink(full_path):
+                    dirs.append(full_path)
+            elif os.path.splitext(name)[1] in extensions:
+                files.append(full_path)
+    else:
+        try:
+            entries = scandir(path)
+        except OSError:
+            return files, dirs
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                if not entry.is_symlink():
+                    dirs.append(entry.path)
+            elif os.path.splitext(entry.name)[1] in extensions:
+                files.append(entry.path)
+    files.sort()
+    dirs.sort()
+    return files, dirs
+
+
+def walk_files(top, extensions, pool=None):
+    """Yield the files with one of extensions within top in sorted order.
+
+    :param pool: A pool of threads (e.g., `multiprocessing.pool.ThreadPool`)
+      used to list the subdirectories of each directory in parallel. The
+      directories are listed by the calling thread when None.
+
+    """
+    def list_directory(path):
+        return scan_directory(path, extensions)
+
+    def descend(listing):
+        files, dirs = listing
+        for filename in files:
+            yield filename
+        if pool:
+            listings = pool.imap(list_directory, dirs)
+        else:
+            listings = (list_directory(x) for x in dirs)
+        for sub_listing in listings:
+            for filename in descend(sub_listing):
+                yield filename
+
+    return descend(list_directory(top))
+
+
+def read_paths(fp, separator='\n', chunk_size=1 << 16):
+    """Yield the paths separated by separator that are read from fp.
+
+    Paths are yielded as soon as they are read, thus a producer can write
+    them to a pipe as it finds them. Empty paths are skipped, as is the
+    carriage return of a path that ends a Windows line.
+
+    """
+    try:
+        fileno = fp.fileno()
+    except (AttributeError, IOError):
+        read = fp.read
+    else:
+        def read(size):  # Don't wait for a full chunk of a pipe
+            return os.read(fileno, size)
+    remainder = ''
+    while True:
+        chunk = read(chunk_size)
+        if not chunk:
+            break
+        paths = (remainder + chunk).split(separator)
+        remainder = paths.pop()
+        for path in paths:
+            if separator == '\n':
+                path = path.rstrip('\r')
+            if path:
+                yield path
+    if separator == '\n':
+        remainder = remainder.rstrip('\r')
+    if remainder:
+        yield remainder
@@ -1,7 +1,15 @@
 """This module provides the code necessary to write a Hairball plugin."""
 
+import importlib
+import inspect
 import kurt
-from collections import Counter
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter, deque
+from hashlib import sha1
+from ..profiling import NULL_PROFILER
+from ..registry import docstring_description, docstring_summary
 
 
 class HairballPlugin(object):
@@ -16,11 +24,34 @@ class HairballPlugin(object):
 
     """
 
+    # Change VERSION to invalidate the cached results of a plugin whose
+    # results depend on something other than its code
+    VERSION = None
+
+    # The import names of the modules, or of the functions and classes within
+    # modules, whose code the results of a plugin depend on besides the code
+    # of its classes, see `version_key`. Those of every base class apply.
+    DEPENDENCIES = ('hairball.plugins.OpcodeTable',
+                    'hairball.plugins.BlockStream',
+                    'hairball.plugins.AttributeRules',
+                    'hairball.plugins.EventGraph',
+                    'hairball.plugins.ScriptRef')
+
+    # Plugins should only produce output from within analyze when verbose
+    verbose = True
+
+    # Records the time spent in sections of analysis, see `timed`
+    profiler = NULL_PROFILER
+
+    # The NAME: VALUE settings provided via --plugin-option, see `setting`
+    settings = {}
+
     HAT_GREEN_FLAG = 0
     HAT_WHEN_I_RECEIVE = 1
     HAT_MOUSE = 2
     HAT_KEY = 3
     NO_HAT = 4
+    HAT_CLONE = 5
 
     BLOCKMAPPING = {
         'costume': frozenset([('switch backdrop to %s', 'absolute'),
@@ -53,16 +84,17 @@ class HairballPlugin(object):
 
         """
         # queue the block and the depth of the block
-        queue = [(block, 0) for block in block_list
-                 if isinstance(block, kurt.Block)]
+        queue = deque((block, 0) for block in block_list
+                      if isinstance(block, kurt.Block))
         while queue:
-            block, depth = queue.pop(0)
+            block, depth = queue.popleft()
             assert block.type.text
             yield block.type.text, depth, block
             for arg in block.args:
                 if hasattr(arg, '__iter__'):
-                    queue[0:0] = [(x, depth + 1) for x in arg
-                                  if isinstance(x, kurt.Block)]
+                    # Nested blocks are processed before the remaining queue
+                    queue.extendleft(reversed([(x, depth + 1) for x in arg
+                                               if isinstance(x, kurt.Block)]))
                 elif isinstance(arg, kurt.Block):
                     queue.append((arg, depth))
 
@@ -113,11 +145,101 @@ class HairballPlugin(object):
             return HairballPlugin.HAT_MOUSE
         elif script[0].type.text == 'when %s key pressed':
             return HairballPlugin.HAT_KEY
+        elif script[0].type.text == 'when I start as a clone':
+            return HairballPlugin.HAT_CLONE
         else:
             return HairballPlugin.NO_HAT
 
+    @staticmethod
+    def block_stream(scratch):
+        """Return the BlockStream of scratch building it if necessary.
+
+        The stream is built only once per project and is shared by all
+        plugins that analyze the project.
+
+        """
+        stream = getattr(scratch, 'hairball_stream', None)
+        if stream is None:
+            stream = scratch.hairball_stream = BlockStream(scratch)
+        return stream
+
     @classmethod
-    def get_broadcast_events(cls, script):
+    def event_graph(cls, scratch):
+        """Return the EventGraph of scratch building it if necessary.
+
+        Like the BlockStream, the graph is built only once per project. A
+        graph that was stored along with a cached project is reused.
+
+        """
+        stream = cls.block_stream(scratch)
+        graph = getattr(scratch, 'hairball_events', None)
+        if graph is None or graph.format != EventGraph.FORMAT or \
+                len(graph.starts) != len(stream.scripts):
+            graph = scratch.hairball_events = EventGraph(stream)
+        return graph
+
+    @classmethod
+    def script_blocks(cls, script, stream=None, names=None):
+        """Return an iterator of the blocks contained in a script.
+
+        Yields the same tuples as `iter_blocks`. When a BlockStream is provided
+        the blocks are read from the stream rather than traversing the script.
+
+        :param names: When provided only the blocks with one of these names
+          are yielded. With a BlockStream only those blocks are visited.
+
+        """
+        if stream is None:
+            blocks = cls.iter_blocks(script.blocks)
+            if names is None:
+                return blocks
+            return (x for x in blocks if x[0] in names)
+        if names is None:
+            return stream.script_blocks(script)
+        return stream.script_blocks(script, OPCODES.lookup(names))
+
+    @classmethod
+    def find_blocks(cls, scratch, names):
+        """Return an iterator of the blocks of scratch with one of names.
+
+        Yields the same tuples as iterating over a BlockStream in the same
+        order. Only the blocks with those names are visited thanks to the
+        opcode index of the project's BlockStream.
+
+        """
+        return cls.block_stream(scratch).find(OPCODES.lookup(names))
+
+    @classmethod
+    def count_blocks(cls, scratch, names):
+        """Return a Counter of the blocks of scratch with one of names."""
+        stream = cls.block_stream(scratch)
+        return Counter(dict((OPCODES.names[opcode],
+                             len(stream.index.get(opcode, ())))
+                            for opcode in OPCODES.lookup(names)))
+
+    @classmethod
+    def find_scripts(cls, scratch, names):
+        """Return the (sprite, script) pairs containing a block in names.
+
+        Pairs are in the order of the BlockStream's scripts.
+
+        """
+        return cls.block_stream(scratch).scripts_with(OPCODES.lookup(names))
+
+    @classmethod
+    def attribute_rules(cls):
+        """Return the AttributeRules compiled from the class' BLOCKMAPPING.
+
+        The rules are compiled once per class.
+
+        """
+        rules = _ATTRIBUTE_RULES.get(cls)
+        if rules is None:
+            rules = _ATTRIBUTE_RULES[cls] = AttributeRules(cls.BLOCKMAPPING)
+        return rules
+
+    @classmethod
+    def get_broadcast_events(cls, script, stream=None):
         """Return a Counter of event-names that were broadcast.
 
         The Count will contain the key True if any of the broadcast blocks
@@ -125,7 +247,12 @@ class HairballPlugin(object):
 
         """
         events = Counter()
-        for name, _, block in cls.iter_blocks(script):
+        if stream is None:
+            blocks = cls.iter_blocks(script)
+        else:  # Only visit the broadcast blocks
+            blocks = stream.script_blocks(
+                script, OPCODES.containing('broadcast %s'))
+        for name, _, block in blocks:
             if 'broadcast %s' in name:
                 if isinstance(block.args[0], kurt.Block):
                     events[True] += 1
@@ -135,56 +262,112 @@ class HairballPlugin(object):
 
     @classmethod
     def tag_reachable_scripts(cls, scratch):
-        """Tag each script with attribute reachable.
+        """Record whether each script is reachable in the project's stream.
 
-        The reachable attribute will be set false for any script that does not
-        begin with a hat block. Additionally, any script that begins with a
-        'when I receive' block whose event-name doesn't appear in a
-        corresponding broadcast block is marked as unreachable.
+        `reachable[n]` of the BlockStream is false for the n-th script when it
+        does not begin with a hat block. Additionally, any script that begins
+        with a 'when I receive' block whose event-name doesn't appear in a
+        corresponding broadcast block is marked as unreachable. The kurt
+        objects are left unmodified.
 
         """
-        if getattr(scratch, 'hairball_prepared', False):  # Only process once
-            return
-
-        reachable = set()
-        untriggered_events = {}
-        # Initial pass to find reachable and potentially reachable scripts
-        for script in cls.iter_scripts(scratch):
-            if not isinstance(script, kurt.Comment):
-                starting_type = cls.script_start_type(script)
-                if starting_type == cls.NO_HAT:
-                    script.reachable = False
-                elif starting_type == cls.HAT_WHEN_I_RECEIVE:
-                    # Value will be updated if reachable
-                    script.reachable = False
-                    message = script[0].args[0].lower()
-                    untriggered_events.setdefault(message, set()).add(script)
-                else:
-                    script.reachable = True
-                    reachable.add(script)
-        # Expand reachable states based on broadcast events
-        while reachable:
-            for event in cls.get_broadcast_events(reachable.pop()):
-                if event in untriggered_events:
-                    for script in untriggered_events.pop(event):
-                        script.reachable = True
-                        reachable.add(script)
-        scratch.hairball_prepared = True
+        stream = cls.block_stream(scratch)
+        if stream.reachable is None:  # Only process once
+            reachable = cls.event_graph(scratch).reachable()
+            stream.reachable = array('b', (x in reachable for x in
+                                           xrange(len(stream.scripts))))
 
     @property
     def description(self):
         """Attribute that returns the plugin description from its docstring."""
-        lines = []
-        for line in self.__doc__.split('\n')[2:]:
-            line = line.strip()
-            if line:
-                lines.append(line)
-        return ' '.join(lines)
+        return docstring_description(self.__doc__)
+
+    @property
+    def import_name(self):
+        """Attribute that returns the module and class name of the plugin."""
+        return '{}.{}'.format(self.__module__, self.__class__.__name__)
 
     @property
     def name(self):
         """Attribute that returns the plugin name from its docstring."""
-        return self.__doc__.split('\n')[0]
+        return docstring_summary(self.__doc__)
+
+    @classmethod
+    def version_key(cls):
+        """Return a key that identifies the version of the plugin's code.
+
+        The key is derived from VERSION, the source of the plugin class and
+        of each of its base classes, and the source of their DEPENDENCIES.
+        Thus changing the code of a plugin only invalidates the results cached
+        by that plugin, whereas changing the code its results depend on
+        invalidates those of every plugin that depends on it.
+
+        """
+        key = _VERSION_KEYS.get(cls)
+        if key is None:
+            checksum = sha1(repr(cls.VERSION))
+            dependencies = []
+            for klass in inspect.getmro(cls)[:-1]:  # Excluding object
+                checksum.update('{}.{}'.format(klass.__module__,
+                                               klass.__name__))
+                checksum.update(_source(klass))
+                for name in klass.__dict__.get('DEPENDENCIES', ()):
+                    if name not in dependencies:
+                        dependencies.append(name)
+            for name in sorted(dependencies):
+                checksum.update(name)
+                checksum.update(_source(_import_object(name)))
+            key = _VERSION_KEYS[cls] = checksum.hexdigest()
+        return key
+
+    def setting(self, name, default=None, convert=None):
+        """Return the value of the named setting provided via --plugin-option.
+
+        A setting named `ClassName.name` applies only to the plugin class
+        named ClassName and takes precedence over a setting named `name`,
+        which applies to every plugin. Returns default when neither was
+        provided, otherwise the value (a string) converted via convert when
+        provided.
+
+        """
+        for key in ('{}.{}'.format(self.__class__.__name__, name), name):
+            if key in self.settings:
+                value = self.settings[key]
+                return convert(value) if convert else value
+        return default
+
+    def result_version(self):
+        """Return the key under which the plugin's results are cached.
+
+        The key is the `version_key` of the plugin combined with the
+        settings that apply to the plugin, as they may affect its results.
+
+        """
+        prefix = self.__class__.__name__ + '.'
+        settings = sorted(x for x in self.settings.items()
+                          if '.' not in x[0] or x[0].startswith(prefix))
+        if not settings:
+            return self.version_key()
+        return sha1(self.version_key() + repr(settings)).hexdigest()
+
+    def __getstate__(self):
+        """Return the state of the plugin excluding its profiler."""
+        state = self.__dict__.copy()
+        state.pop('profiler', None)
+        return state
+
+    def timed(self, section):
+        """Return a context manager that profiles a section of analysis.
+
+        The time spent within the context is reported by --profile as the
+        phase `<import_name>: <section>`. When profiling is off the context
+        manager does nothing.
+
+        """
+        if not self.profiler.enabled:
+            return self.profiler.section(section)
+        return self.profiler.section('{}: {}'.format(self.import_name,
+                                                     section))
 
     def _process(self, scratch, filename, **kwargs):
         """Internal hook that marks reachable scripts before calling analyze.
@@ -208,6 +391,51 @@ class HairballPlugin(object):
         """
         raise NotImplementedError('Subclass must implement this method')
 
+    def restore(self, result, filename):
+        """Overwrite this function to restore a cached analysis result.
+
+        :param result: The value previously returned by `analyze` for a file
+          with identical contents.
+        :param filename: The path to the file the result belongs to.
+
+        When the result cache is in use, this function is called in place of
+        `analyze` thus plugins that accumulate state across files for use in
+        `finalize` should rebuild that state from the result.
+
+        """
+        pass
+
+    def merge(self, other):
+        """Merge the aggregate state of `other` into this plugin instance.
+
+        :param other: An instance of the same plugin class that has analyzed
+          a distinct set of files, e.g., within a worker process.
+
+        Plugins that accumulate state across files for use in `finalize`
+        should overwrite this function such that merging the instances in
+        file order produces the same state as a single serial run.
+
+        """
+        pass
+
+    def subtract(self, other):
+        """Remove the aggregate state of `other` from this plugin instance.
+
+        :param other: An instance of the same plugin class that was previously
+          merged into this one.
+
+        `--watch` keeps the aggregate of the plugins that can subtract, and
+        updates it by the files that changed rather than merging the partial
+        state of every file again. Plugins that overwrite `merge` should
+        overwrite this function when the output of `finalize` does not depend
+        on the order in which instances are merged, otherwise it raises
+        NotImplementedError.
+
+        """
+        if type(self).merge.im_func is not HairballPlugin.merge.im_func:
+            raise NotImplementedError('{} cannot subtract'.format(
+                self.import_name))
+
     def finalize(self):
         """Overwrite this function to be notified when analysis is complete.
 
@@ -216,3 +444,597 @@ class HairballPlugin(object):
 
         """
         pass
+
+
+# Cache of the version key of each plugin class
+_VERSION_KEYS = {}
+
+
+def _import_object(name):
+    """Return the module, or the object within a module, named name."""
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        module, _, attribute = name.rpartition('.')
+        if not module:
+            raise
+        return getattr(importlib.import_module(module), attribute)
+
+
+def _source(obj):
+    """Return the source code of obj, or '' when it is unavailable."""
+    try:
+        return inspect.getsource(obj)
+    except (IOError, TypeError):
+        return ''  # Only VERSION can distinguish the code of obj
+
+
+# Cache of the compiled BLOCKMAPPING of each plugin class
+_ATTRIBUTE_RULES = {}
+
+
+class OpcodeTable(object):
+
+    """An interning table that maps block names to integer opcodes.
+
+    A single table (OPCODES) is shared by every BlockStream within a process
+    thus opcodes can be compared across projects.
+
+    """
+
+    def __init__(self):
+        """Initialize an empty table."""
+        self.names = []
+        self.opcodes = {}
+        self._containing = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        """Return the number of interned block names."""
+        return len(self.names)
+
+    def intern(self, name):
+        """Return the opcode of name adding it to the table if necessary.
+
+        Names may be interned from any thread, e.g., when projects are
+        prefetched.
+
+        """
+        opcode = self.opcodes.get(name)
+        if opcode is None:
+            with self._lock:
+                opcode = self.opcodes.get(name)
+                if opcode is None:
+                    opcode = len(self.names)
+                    self.names.append(name)
+                    self.opcodes[name] = opcode
+        return opcode
+
+    def lookup(self, names):
+        """Return the frozenset of opcodes of the interned names.
+
+        Names that were never interned have no blocks thus are ignored.
+
+        """
+        if isinstance(names, basestring):
+            names = (names,)
+        return frozenset(self.opcodes[x] for x in names if x in self.opcodes)
+
+    def containing(self, text):
+        """Return the frozenset of opcodes whose name contains text."""
+        size, opcodes = self._containing.get(text, (0, frozenset()))
+        if size != len(self.names):
+            opcodes = opcodes.union(x for x in xrange(size, len(self.names))
+                                    if text in self.names[x])
+            self._containing[text] = (len(self.names), opcodes)
+        return opcodes
+
+
+OPCODES = OpcodeTable()
+
+
+class BlockStream(object):
+
+    """A flattened, array-backed representation of the blocks in a project.
+
+    The project is traversed exactly once, in the order of `iter_scripts` and
+    `iter_blocks`, upon construction. Each block is assigned a position in
+    that order and the following arrays are indexed by that position:
+
+    * opcodes: the interned (see OPCODES) name of the block
+    * depths: the depth that the block was found at
+    * parents: the position of the block whose arguments contain the block,
+      or -1 for the blocks at the top of a script
+    * siblings: the position of the next block in the same block list, or -1
+    * slots: the index of the argument of the parent that holds the block,
+      i.e., the block itself or the block list it belongs to (0 for the
+      blocks at the top of a script)
+
+    The blocks of the n-th script occupy the positions from offsets[n] up to
+    offsets[n + 1], and numbers[n] is the index of the script among the
+    scripts of its sprite. The stream can be iterated over as many times as
+    needed without traversing the project again. Once the reachable scripts
+    have been determined (see `HairballPlugin.tag_reachable_scripts`),
+    reachable[n] indicates whether the n-th script is reachable.
+
+    The `index` maps each opcode to the ascending positions of its blocks. It
+    is built upon first use, and lets queries for a few opcodes visit only
+    the matching blocks.
+
+    """
+
+    def __init__(self, scratch):
+        """Traverse the scripts of scratch and record each block."""
+        self.scripts = []
+        self.blocks = []
+        self.opcodes = array('i')
+        self.depths = array('H')
+        self.parents = array('i')
+        self.siblings = array('i')
+        self.slots = array('H')
+        self.offsets = array('i', [0])
+        self.numbers = array('i')
+        self.reachable = None
+        self._index = {}
+        self._opcode_index = None
+        scriptables = [scratch.stage] + list(scratch.sprites)
+        for sprite in scriptables:
+            number = 0
+            for script in sprite.scripts:
+                if isinstance(script, kurt.Comment):
+                    continue
+                self._index[id(script)] = len(self.scripts)
+                self.scripts.append((sprite, script))
+                self.numbers.append(number)
+                number += 1
+                self._add_script(script)
+                self.offsets.append(len(self.blocks))
+
+    def _add_script(self, script):
+        """Append the blocks of script to the arrays.
+
+        The traversal order matches that of `HairballPlugin.iter_blocks`.
+
+        """
+        # Each queued block is accompanied by its depth, its parent's position,
+        # the position of the last visited block in its block list and its
+        # slot.
+        last = [-1]
+        queue = deque((block, 0, -1, last, 0) for block in script.blocks
+                      if isinstance(block, kurt.Block))
+        while queue:
+            block, depth, parent, last, slot = queue.popleft()
+            assert block.type.text
+            position = len(self.blocks)
+            self.blocks.append(block)
+            self.opcodes.append(OPCODES.intern(block.type.text))
+            self.depths.append(depth)
+            self.parents.append(parent)
+            self.siblings.append(-1)
+            self.slots.append(slot)
+            if last is not None:
+                if last[0] >= 0:
+                    self.siblings[last[0]] = position
+                last[0] = position
+            for slot, arg in enumerate(block.args):
+                if hasattr(arg, '__iter__'):
+                    nested = [-1]
+                    queue.extendleft(reversed([
+                        (x, depth + 1, position, nested, slot) for x in arg
+                        if isinstance(x, kurt.Block)]))
+                elif isinstance(arg, kurt.Block):
+                    queue.append((arg, depth, position, None, slot))
+
+    def __iter__(self):
+        """Yield a tuple for every block in the project.
+
+        Tuples contain the block name, depth, the block itself, the sprite (or
+        stage) owning the script and the script.
+
+        """
+        names = OPCODES.names
+        for index, (sprite, script) in enumerate(self.scripts):
+            for position in xrange(self.offsets[index],
+                                   self.offsets[index + 1]):
+                yield (names[self.opcodes[position]], self.depths[position],
+                       self.blocks[position], sprite, script)
+
+    def __len__(self):
+        """Return the number of blocks in the project."""
+        return len(self.opcodes)
+
+    @property
+    def index(self):
+        """The mapping of each opcode to the array of its positions."""
+        if self._opcode_index is None:
+            index = {}
+            for position, opcode in enumerate(self.opcodes):
+                positions = index.get(opcode)
+                if positions is None:
+                    positions = index[opcode] = array('i')
+                positions.append(position)
+            self._opcode_index = index
+        return self._opcode_index
+
+    def positions(self, opcodes, start=0, stop=None):
+        """Return the ascending positions of the blocks with one of opcodes.
+
+        Only the positions from start up to stop are included.
+
+        """
+        if stop is None:
+            stop = len(self.opcodes)
+        index = self.index
+        result = []
+        for opcode in opcodes:
+            positions = index.get(opcode)
+            if positions:
+                result.extend(positions[bisect_left(positions, start):
+                                        bisect_left(positions, stop)])
+        if len(opcodes) > 1:
+            result.sort()
+        return result
+
+    def find(self, opcodes):
+        """Yield the tuples of `__iter__` for the blocks with one of opcodes.
+
+        Blocks are yielded in stream order and only they are visited.
+
+        """
+        names = OPCODES.names
+        index = 0
+        for position in self.positions(opcodes):
+            while self.offsets[index + 1] <= position:
+                index += 1
+            sprite, script = self.scripts[index]
+            yield (names[self.opcodes[position]], self.depths[position],
+                   self.blocks[position], sprite, script)
+
+    def scripts_with(self, opcodes):
+        """Return the (sprite, script) pairs containing one of opcodes."""
+        indices = set(bisect_right(self.offsets, x) - 1
+                      for x in self.positions(opcodes))
+        return [self.scripts[x] for x in sorted(indices)]
+
+    def detach(self):
+        """Release all references to the kurt objects of the project.
+
+        Only the arrays and the names of the sprites remain thus a detached
+        stream can be held long after its project has been freed. Afterwards
+        None is produced in place of each block, script and sprite.
+
+        """
+        self.sprite_names = [sprite.name for sprite, _ in self.scripts]
+        self.blocks = [None] * len(self.opcodes)
+        self.scripts = [(None, None)] * len(self.scripts)
+        self._index = {}
+
+    def script_digest(self, index):
+        """Return the structural hash of the n-th script as a hex string.
+
+        The hash covers the name and depth of each of its blocks, thus
+        literal values are ignored.
+
+        """
+        names = OPCODES.names
+        digest = sha1()
+        for position in xrange(self.offsets[index], self.offsets[index + 1]):
+            digest.update(names[self.opcodes[position]].encode('utf-8'))
+            digest.update('\0{}\0'.format(self.depths[position]))
+        return digest.hexdigest()
+
+    def script_ref(self, index):
+        """Return a ScriptRef to the n-th script."""
+        sprite = self.scripts[index][0]
+        name = self.sprite_names[index] if sprite is None else sprite.name
+        return ScriptRef(name, self.numbers[index], self.script_digest(index))
+
+    def script_range(self, script):
+        """Return the xrange of positions occupied by the blocks of script."""
+        index = self._index[id(script)]
+        return xrange(self.offsets[index], self.offsets[index + 1])
+
+    def script_blocks(self, script, opcodes=None):
+        """Yield the (name, depth, block) tuples of script.
+
+        :param opcodes: When provided only the blocks whose opcode is
+          contained in this set are yielded.
+
+        """
+        names = OPCODES.names
+        for position in self.script_positions(script, opcodes):
+            yield (names[self.opcodes[position]], self.depths[position],
+                   self.blocks[position])
+
+    def script_positions(self, script, opcodes=None):
+        """Return the ascending positions of the blocks of script.
+
+        :param opcodes: When provided only the positions of the blocks whose
+          opcode is contained in this set are returned. The index is used to
+          visit only those blocks unless there are more opcodes than blocks
+          in script.
+
+        """
+        positions = self.script_range(script)
+        if opcodes is None:
+            return positions
+        if len(opcodes) < len(positions):
+            return self.positions(opcodes, positions[0], positions[-1] + 1)
+        return [x for x in positions if self.opcodes[x] in opcodes]
+
+    def sprite_scripts(self, sprite):
+        """Return the list of non-comment scripts belonging to sprite."""
+        return [x for owner, x in self.scripts if owner is sprite]
+
+
+class AttributeRules(object):
+
+    """Rules that determine whether the attributes of a sprite are initialized.
+
+    The rules are compiled from a mapping of each attribute to the set of
+    (block name, kind) pairs of the blocks that modify it, such as
+    `HairballPlugin.BLOCKMAPPING`, where kind is either `absolute` (the block
+    sets the attribute) or `relative` (the block changes it). `resolve`
+    determines the state of every attribute in a single pass over the blocks
+    of the scripts, thus adding attributes costs no extra traversal.
+
+    An attribute is initialized when, within the initialization zone of one
+    of the scripts started by a start type (e.g., the green flag), a top level
+    absolute block sets it before it is otherwise modified, and no other such
+    script modifies it. The initialization zone of a script ends at its first
+    zone end block (e.g., `broadcast %s and wait`).
+
+    """
+
+    STATE_NOT_MODIFIED = 0
+    STATE_MODIFIED = 1
+    STATE_INITIALIZED = 2
+
+    def __init__(self, mapping, zone_end=('broadcast %s and wait',),
+                 start_types=(HairballPlugin.HAT_GREEN_FLAG,
+                              HairballPlugin.HAT_CLONE)):
+        """Compile the rules of mapping into an opcode dispatch table."""
+        self.attributes = tuple(sorted(mapping))
+        self.start_types = frozenset(start_types)
+        dispatch = {}  # opcode: {attribute: True if absolute}
+        for attribute in self.attributes:
+            for name, kind in mapping[attribute]:
+                if kind not in ('absolute', 'relative'):
+                    raise ValueError('Invalid kind {!r} for {!r}'.format(
+                        kind, name))
+                kinds = dispatch.setdefault(OPCODES.intern(name), {})
+                # Absolute takes precedence should a block be listed as both
+                kinds[attribute] = kinds.get(attribute) or kind == 'absolute'
+        # opcode: ((attribute, is absolute), ...)
+        self.dispatch = dict((opcode, tuple(sorted(kinds.items())))
+                             for opcode, kinds in dispatch.items())
+        self.zone_end = frozenset(OPCODES.intern(x) for x in zone_end)
+        self.opcodes = frozenset(self.dispatch) | self.zone_end
+
+    def kinds(self, name):
+        """Return the (attribute, kind) pairs of the blocks named name."""
+        return tuple((attribute, 'absolute' if absolute else 'relative')
+                     for attribute, absolute in
+                     self.dispatch.get(OPCODES.opcodes.get(name), ()))
+
+    def blocks(self, script, stream=None):
+        """Yield the (opcode, depth) of the blocks of script in the rules.
+
+        When the project's BlockStream is provided only those blocks are
+        visited, otherwise the script is traversed.
+
+        """
+        if stream is None:
+            for name, depth, _ in HairballPlugin.iter_blocks(script.blocks):
+                opcode = OPCODES.opcodes.get(name)
+                if opcode in self.opcodes:
+                    yield opcode, depth
+        else:
+            for position in stream.script_positions(script, self.opcodes):
+                yield stream.opcodes[position], stream.depths[position]
+
+    def resolve(self, scripts, stream=None, attributes=None):
+        """Return a mapping of each attribute to its state within scripts.
+
+        :param attributes: The attributes to resolve (default: all).
+
+        """
+        if attributes is None:
+            attributes = self.attributes
+        states = dict((x, self.STATE_NOT_MODIFIED) for x in attributes)
+        other = []
+        for script in scripts:
+            if HairballPlugin.script_start_type(script) \
+                    not in self.start_types:
+                other.append(script)
+                continue
+            pending = set(attributes)  # Not yet determined by this script
+            in_zone = True
+            for opcode, depth in self.blocks(script, stream):
+                if opcode in self.zone_end:
+                    # TODO: Follow the broadcast and wait scripts that occur
+                    # in the initialization zone
+                    in_zone = False
+                for attribute, absolute in self.dispatch.get(opcode, ()):
+                    if attribute not in pending:
+                        continue
+                    if absolute and in_zone:
+                        if depth:
+                            continue  # Conservative ignore for nested sets
+                        if states[attribute] == self.STATE_NOT_MODIFIED:
+                            states[attribute] = self.STATE_INITIALIZED
+                        else:  # Multiple initialization scripts conflict
+                            states[attribute] = self.STATE_MODIFIED
+                    else:
+                        states[attribute] = self.STATE_MODIFIED
+                    pending.discard(attribute)
+                if not pending:
+                    break
+        # Attributes that are modified by any other script are modified
+        unresolved = set(x for x in attributes
+                         if states[x] == self.STATE_NOT_MODIFIED)
+        for script in other:
+            if not unresolved:
+                break
+            for opcode, _ in self.blocks(script, stream):
+                for attribute, _ in self.dispatch.get(opcode, ()):
+                    if attribute in unresolved:
+                        states[attribute] = self.STATE_MODIFIED
+                        unresolved.discard(attribute)
+                if not unresolved:
+                    break
+        return states
+
+
+class EventGraph(object):
+
+    """The broadcast and receive events of a project.
+
+    Scripts are identified by their index within the project's BlockStream,
+    and events by their index within `events`:
+
+    * events: the name (in lowercase) of each event
+    * starts: the start type (see `HairballPlugin.script_start_type`) of
+      each script
+    * sends: the events broadcast by each script
+    * senders: the scripts that broadcast each event
+    * receivers: the scripts that receive (start upon) each event
+    * dynamic: the scripts that broadcast an event named by a reporter,
+      e.g., a variable, thus whose event is unknown
+
+    The graph is built in a single pass over the broadcast blocks found via
+    the stream's opcode index. As it holds no kurt objects, it can be pickled
+    along with a cached project.
+
+    """
+
+    # Change FORMAT whenever the attributes change to rebuild cached graphs
+    FORMAT = 1
+
+    def __init__(self, stream):
+        """Build the graph of the project represented by stream."""
+        self.format = self.FORMAT
+        self.events = []
+        self.starts = array('b')
+        self.sends = [[] for _ in stream.scripts]
+        self.senders = []
+        self.receivers = []
+        self.dynamic = set()
+        event_ids = {}
+
+        def intern(name):
+            event = event_ids.get(name)
+            if event is None:
+                event = event_ids[name] = len(self.events)
+                self.events.append(name)
+                self.senders.append([])
+                self.receivers.append([])
+            return event
+
+        for index, (_, script) in enumerate(stream.scripts):
+            start = HairballPlugin.script_start_type(script)
+            self.starts.append(start)
+            if start == HairballPlugin.HAT_WHEN_I_RECEIVE:
+                self.receivers[intern(script[0].args[0].lower())].append(
+                    index)
+        index = 0
+        for position in stream.positions(OPCODES.containing('broadcast %s')):
+            while stream.offsets[index + 1] <= position:
+                index += 1
+            argument = stream.blocks[position].args[0]
+            if isinstance(argument, kurt.Block):
+                self.dynamic.add(index)
+                continue
+            event = intern(argument.lower())
+            if event not in self.sends[index]:
+                self.sends[index].append(event)
+                self.senders[event].append(index)
+
+    def reachable(self):
+        """Return the set of the scripts that can be started.
+
+        Scripts that begin with a hat block other than `when I receive` are
+        reachable, as are the scripts receiving an event broadcast by a
+        reachable script.
+
+        """
+        reachable = set(index for index, start in enumerate(self.starts)
+                        if start not in (HairballPlugin.NO_HAT,
+                                         HairballPlugin.HAT_WHEN_I_RECEIVE))
+        pending = list(reachable)
+        triggered = set()
+        while pending:
+            for event in self.sends[pending.pop()]:
+                if event in triggered:
+                    continue
+                triggered.add(event)
+                for index in self.receivers[event]:
+                    if index not in reachable:
+                        reachable.add(index)
+                        pending.append(index)
+        return reachable
+
+
+class ScriptRef(object):
+
+    """A reference to a script by its sprite, index and structural hash.
+
+    Results refer to scripts via ScriptRefs rather than the kurt objects,
+    which would keep the entire project in memory (and in the result cache).
+    The index is that of the script among the scripts of its sprite, where
+    comments are not counted, and the hash is that of
+    `BlockStream.script_digest`.
+
+    """
+
+    __slots__ = ('sprite', 'index', 'hash')
+
+    def __init__(self, sprite, index, hash_):
+        """Initialize a reference to the index-th script of sprite."""
+        self.sprite = sprite
+        self.index = index
+        self.hash = hash_
+
+    def __eq__(self, other):
+        """Return whether other refers to the same script."""
+        return isinstance(other, ScriptRef) and \
+            self.__getstate__() == other.__getstate__()
+
+    def __ne__(self, other):
+        """Return whether other refers to a different script."""
+        return not self == other
+
+    def __hash__(self):
+        """Return the hash of the reference."""
+        return hash(self.__getstate__())
+
+    def __repr__(self):
+        """Return the representation of the reference."""
+        return 'ScriptRef({!r}, {!r}, {!r})'.format(*self.__getstate__())
+
+    def __getstate__(self):
+        """Return the (sprite, index, hash) tuple of the reference."""
+        return self.sprite, self.index, self.hash
+
+    def __setstate__(self, state):
+        """Restore the reference from a (sprite, index, hash) tuple."""
+        self.sprite, self.index, self.hash = state
+
+    def resolve(self, scratch):
+        """Return the referenced script of the kurt project scratch.
+
+        Raise LookupError when the project has no such script, or when the
+        structural hash of the script differs, e.g., as scratch is a changed
+        version of the project the reference was made for.
+
+        """
+        stream = HairballPlugin.block_stream(scratch)
+        for index, (sprite, script) in enumerate(stream.scripts):
+            if sprite.name == self.sprite and \
+                    stream.numbers[index] == self.index:
+                if stream.script_digest(index) != self.hash:
+                    raise LookupError('Script {} of {} has changed'.format(
+                        self.index, self.sprite))
+                return script
+        raise LookupError('No script {} of {}'.format(self.index,
+                                                      self.sprite))
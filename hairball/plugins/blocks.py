@@ -1,33 +1,74 @@
 """This module provides plugins for basic block statistics."""
 
 from __future__ import print_function
-from collections import Counter
-from hairball.plugins import HairballPlugin
+import sys
+from hairball.matrix import CountMatrix
+from hairball.plugins import HairballPlugin, OPCODES
 
 
 class BlockCounts(HairballPlugin):
 
-    """Plugin that keeps track of how often each block is used."""
+    """Plugin that keeps track of how often each block is used.
+
+    The counts of each file are kept as a row of a CountMatrix, thus the
+    per-file breakdown of the whole corpus is available upon completion.
+
+    Settings (see `--plugin-option`):
+
+    * matrix: the path of an `.npz` file to save the matrix to upon
+      completion (requires numpy)
+    * top: only output the K most used blocks (default: every block)
+
+    """
+
+    DEPENDENCIES = ('hairball.matrix',)
 
     def __init__(self):
         """Initialize an instance of the BlockCounts plugin."""
         super(BlockCounts, self).__init__()
-        self.blocks = Counter()
+        self.matrix = CountMatrix()
+
+    @property
+    def blocks(self):
+        """Return a Counter of the overall count of each block."""
+        return self.matrix.totals()
 
     def finalize(self):
         """Output the aggregate block count results."""
-        for name, count in sorted(self.blocks.items(), key=lambda x: x[1]):
+        blocks = self.blocks
+        top = self.setting('top', None, int)
+        if top is None:
+            counts = sorted(blocks.items(), key=lambda x: (x[1], x[0]))
+        else:
+            counts = self.matrix.top(top)[::-1]
+        for name, count in counts:
             print('{:3} {}'.format(count, name))
-        print('{:3} total'.format(sum(self.blocks.values())))
+        print('{:3} total'.format(sum(blocks.values())))
+        path = self.setting('matrix')
+        if path:
+            try:
+                self.matrix.save_npz(path)
+            except (ImportError, IOError) as exc:
+                sys.stderr.write('Cannot save the block matrix: {}\n'
+                                 .format(exc))
 
-    def analyze(self, scratch, **kwargs):
+    def restore(self, result, filename, **kwargs):
+        """Update the overall count from a cached result."""
+        self.matrix.add_row(filename, result['types'])
+
+    def merge(self, other):
+        """Merge the block counts of another BlockCounts instance."""
+        self.matrix.merge(other.matrix)
+
+    def subtract(self, other):
+        """Remove the block counts of a merged BlockCounts instance."""
+        self.matrix.subtract(other.matrix)
+
+    def analyze(self, scratch, filename, **kwargs):
         """Run and return the results from the BlockCounts plugin."""
-        file_blocks = Counter()
-        for script in self.iter_scripts(scratch):
-            for name, _, _ in self.iter_blocks(script.blocks):
-                file_blocks[name] += 1
-        self.blocks.update(file_blocks)  # Update the overall count
-        return {'types': file_blocks}
+        opcodes = self.block_stream(scratch).opcodes
+        row = self.matrix.count_row(filename, opcodes, OPCODES.names)
+        return {'types': self.matrix.row(row)}
 
 
 class DeadCode(HairballPlugin):
@@ -43,6 +84,7 @@ class DeadCode(HairballPlugin):
     def analyze(self, scratch, **kwargs):
         """Run and return the results form the DeadCode plugin.
 
+        The unreachable scripts of each sprite are referred to by ScriptRefs.
         The variable_event indicates that the Scratch file contains at least
         one instance of a broadcast event based on a variable. When
         variable_event is True, dead code scripts reported by this plugin that
@@ -51,19 +93,38 @@ class DeadCode(HairballPlugin):
 
         """
         self.total_instances += 1
+        self.tag_reachable_scripts(scratch)
+        stream = self.block_stream(scratch)
         sprites = {}
-        for sprite, script in self.iter_sprite_scripts(scratch):
-            if not script.reachable:
-                sprites.setdefault(sprite, []).append(script)
+        for index, (sprite, _) in enumerate(stream.scripts):
+            if not stream.reachable[index]:
+                sprites.setdefault(sprite.name, []).append(
+                    stream.script_ref(index))
         if sprites:
             self.dead_code_instances += 1
-            import pprint
-            pprint.pprint(sprites)
-        variable_event = any(True in self.get_broadcast_events(x) for x in
-                             self.iter_scripts(scratch))
+            if self.verbose:
+                import pprint
+                pprint.pprint(sprites)
+        variable_event = bool(self.event_graph(scratch).dynamic)
         return {'dead_code': {'sprites': sprites,
                               'variable_event': variable_event}}
 
+    def restore(self, result, **kwargs):
+        """Update the instance tallies from a cached result."""
+        self.total_instances += 1
+        if result['dead_code']['sprites']:
+            self.dead_code_instances += 1
+
+    def merge(self, other):
+        """Merge the instance tallies of another DeadCode instance."""
+        self.total_instances += other.total_instances
+        self.dead_code_instances += other.dead_code_instances
+
+    def subtract(self, other):
+        """Remove the instance tallies of a merged DeadCode instance."""
+        self.total_instances -= other.total_instances
+        self.dead_code_instances -= other.dead_code_instances
+
     def finalize(self):
         """Output the number of instances that contained dead code."""
         if self.total_instances > 1:
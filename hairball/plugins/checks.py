@@ -1,7 +1,8 @@
 """This module provides plugins used in the hairball paper."""
 
+from __future__ import print_function
 from collections import defaultdict, Counter
-from hairball.plugins import HairballPlugin
+from hairball.plugins import HairballPlugin, OPCODES
 
 
 class Animation(HairballPlugin):
@@ -23,41 +24,47 @@ class Animation(HairballPlugin):
     SIZE = frozenset(['change size by %s', 'set size to %s%%'])
     TIMING = frozenset(['wait %s secs', 'glide %s secs to x:%s y:%s'])
     ANIMATION = COSTUME | LOOP | MOTION | ROTATE | SIZE | TIMING
+    # The attributes of BLOCKMAPPING whose changes are counted
+    ATTRIBUTES = frozenset(['costume', 'orientation', 'position', 'size'])
 
-    @staticmethod
-    def check_results(tmp_):
+    def debug(self, *args):
+        """Print args when the plugin is verbose."""
+        if self.verbose:
+            print(*args)
+
+    def check_results(self, tmp_):
         """Return a 3 tuple for something."""
         # TODO: Fix this to work with more meaningful names
         if tmp_['t'] > 0:
             if tmp_['l'] > 0:
                 if tmp_['rr'] > 0 or tmp_['ra'] > 1:
-                    print 1, 3, tmp_
+                    self.debug(1, 3, tmp_)
                     return 3
                 elif tmp_['cr'] > 0 or tmp_['ca'] > 1:
-                    print 2, 3, tmp_
+                    self.debug(2, 3, tmp_)
                     return 3
                 elif tmp_['mr'] > 0 or tmp_['ma'] > 1:
-                    print 3, 2, tmp_
+                    self.debug(3, 2, tmp_)
                     return 2
             if tmp_['cr'] > 1 or tmp_['ca'] > 2:
-                print 4, 2, tmp_
+                self.debug(4, 2, tmp_)
                 return 2
             if tmp_['mr'] > 0 or tmp_['ma'] > 1:
                 if tmp_['cr'] > 0 or tmp_['ca'] > 1:
-                    print 6, 0, tmp_
+                    self.debug(6, 0, tmp_)
                     return 0
             if tmp_['rr'] > 1 or tmp_['ra'] > 2:
-                print 7, 0, tmp_
+                self.debug(7, 0, tmp_)
                 return 0
             if tmp_['sr'] > 1 or tmp_['sa'] > 2:
-                print 8, 0, tmp_
+                self.debug(8, 0, tmp_)
                 return 0
         if tmp_['l'] > 0:
             if tmp_['rr'] > 0 or tmp_['ra'] > 1:
-                print 9, 2, tmp_
+                self.debug(9, 2, tmp_)
                 return 2
             if tmp_['cr'] > 0 or tmp_['ca'] > 1:
-                print 10, 0, tmp_
+                self.debug(10, 0, tmp_)
                 return 0
         return -1
 
@@ -76,11 +83,9 @@ class Animation(HairballPlugin):
                     tmp_.clear()
                 tmp_['last'] += 1
 
-            for attribute in ('costume', 'orientation', 'position', 'size'):
-                if (name, 'relative') in self.BLOCKMAPPING[attribute]:
-                    tmp_[(attribute, 'relative')] += 1
-                elif (name, 'absolute') in self.BLOCKMAPPING[attribute]:
-                    tmp_[(attribute, 'absolute')] += 1
+            for attribute, kind in self.attribute_rules().kinds(name):
+                if attribute in self.ATTRIBUTES:
+                    tmp_[(attribute, kind)] += 1
             if name in self.TIMING:
                 tmp_['timing'] += 1
 
@@ -101,8 +106,10 @@ class Animation(HairballPlugin):
     def analyze(self, scratch, **kwargs):
         """Run and return the results from the Animation plugin."""
         results = Counter()
-        for script in self.iter_scripts(scratch):
-            gen = self.iter_blocks(script.blocks)
+        stream = self.block_stream(scratch)
+        # Scripts without animation blocks cannot contribute to the results
+        for _, script in self.find_scripts(scratch, self.ANIMATION):
+            gen = stream.script_blocks(script)
             name = 'start'
             level = None
             while name != '':
@@ -117,61 +124,47 @@ class BroadcastReceive(HairballPlugin):
 
     """Plugin that checks for proper usage of broadcast and receive blocks."""
 
-    def get_receive(self, script_list):
-        """Return a list of received events contained in script_list."""
-        events = defaultdict(set)
-        for script in script_list:
-            if self.script_start_type(script) == self.HAT_WHEN_I_RECEIVE:
-                event = script.blocks[0].args[0].lower()
-                events[event].add(script)
-        return events
-
     def analyze(self, scratch, **kwargs):
         """Run and return the results from the BroadcastReceive plugin."""
-        all_scripts = list(self.iter_scripts(scratch))
+        stream = self.block_stream(scratch)
+        graph = self.event_graph(scratch)
         results = defaultdict(set)
-        broadcast = dict((x, self.get_broadcast_events(x))  # Events by script
-                         for x in all_scripts)
-        correct = self.get_receive(all_scripts)
-        results['never broadcast'] = set(correct.keys())
-
-        for script, events in broadcast.items():
-            for event in events.keys():
-                if event is True:  # Remove dynamic broadcasts
-                    results['dynamic broadcast'].add(script.morph.name)
-                    del events[event]
-                elif event in correct:
-                    results['never broadcast'].discard(event)
-                else:
-                    results['never received'].add(event)
-
-        # remove events from correct dict that were never broadcast
-        for event in correct.keys():
-            if event in results['never broadcast']:
-                del correct[event]
+        correct = {}  # The events that are both broadcast and received
+        results['never broadcast'] = set()
+        for event, name in enumerate(graph.events):
+            if not graph.receivers[event]:
+                results['never received'].add(name)
+            elif not graph.senders[event]:
+                results['never broadcast'].add(name)
+            else:
+                correct[event] = graph.receivers[event]
+        for index in graph.dynamic:
+            results['dynamic broadcast'].add(stream.scripts[index][0].name)
 
         # Find scripts that have more than one broadcast event on any possible
         # execution path through the program
         # TODO: Permit mutually exclusive broadcasts
-        for events in broadcast.values():
+        for events in graph.sends:
             if len(events) > 1:
                 for event in events:
                     if event in correct:
-                        results['parallel broadcasts'].add(event)
+                        results['parallel broadcasts'].add(graph.events[event])
                         del correct[event]
 
         # Find events that have two (or more) receivers in which one of the
         # receivers has a "delay" block
         for event, scripts in correct.items():
             if len(scripts) > 1:
-                for script in scripts:
-                    for _, _, block in self.iter_blocks(script.blocks):
+                for index in scripts:
+                    script = stream.scripts[index][1]
+                    for _, _, block in stream.script_blocks(script):
                         if block.type.shape == 'stack':
-                            results['multiple receivers with delay'].add(event)
+                            results['multiple receivers with delay'].add(
+                                graph.events[event])
                             if event in correct:
                                 del correct[event]
 
-        results['success'] = set(correct.keys())
+        results['success'] = set(graph.events[x] for x in correct)
         return {'broadcast': results}
 
 
@@ -203,9 +196,12 @@ class SaySoundSync(HairballPlugin):
     def analyze(self, scratch, **kwargs):
         """Categorize instances of attempted say and sound synchronization."""
         errors = Counter()
-        for script in self.iter_scripts(scratch):
+        stream = self.block_stream(scratch)
+        # Every category involves a sound block thus skip the other scripts
+        for _, script in stream.scripts_with(
+                OPCODES.containing('play sound %s')):
             prev_name, prev_depth, prev_block = '', 0, script.blocks[0]
-            gen = self.iter_blocks(script.blocks)
+            gen = stream.script_blocks(script)
             for name, depth, block in gen:
                 if prev_depth == depth:
                     if prev_name in self.SAY_THINK:
@@ -25,10 +25,23 @@ class SpriteNaming(HairballPlugin):
         for name in self.list_default:
             print(name)
 
+    def restore(self, result, **kwargs):
+        """Record the default names contained in a cached result."""
+        self.total_default += len(result['default_names'])
+        self.list_default.extend(result['default_names'])
+
+    def merge(self, other):
+        """Merge the default names found by another SpriteNaming instance."""
+        self.total_default += other.total_default
+        self.list_default.extend(other.list_default)
+
     def analyze(self, scratch, **kwargs):
         """Run and return the results from the SpriteNaming plugin."""
+        names = []
         for sprite in self.iter_sprites(scratch):
             for default in self.default_names:
                 if default in sprite.name:
-                    self.total_default += 1
-                    self.list_default.append(sprite.name)
+                    names.append(sprite.name)
+        self.total_default += len(names)
+        self.list_default.extend(names)
+        return {'default_names': names}
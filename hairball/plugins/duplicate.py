@@ -1,18 +1,147 @@
 """This module provides plugins for basic duplicate code detection."""
 
 from __future__ import print_function
-from hairball.plugins import HairballPlugin
+import heapq
+import random
+import struct
+import zlib
+from array import array
+from hashlib import sha1
+from hairball.cache import parse_size
+from hairball.plugins import HairballPlugin, OPCODES
+from hairball.storage import (DEFAULT_BUDGET, ArrayStore, ShardedTable,
+                              SpillList)
+
+
+def numbered_scripts(stream):
+    """Yield (sprite, number, script) for the scripts of a BlockStream.
+
+    Scripts are numbered from 1 within each sprite (or the stage). User
+    defined scripts, i.e., the definitions of custom blocks, are skipped.
+
+    """
+    numbers = {}  # The number of scripts seen of each sprite
+    for sprite, script in stream.scripts:
+        number = numbers[id(sprite)] = numbers.get(id(sprite), 0) + 1
+        if script[0].type.text != 'define %s':
+            yield sprite, number, script
 
 
 class DuplicateScripts(HairballPlugin):
 
-    """Plugin that detects duplicate scripts within a project."""
+    """Plugin that detects duplicate scripts within and across projects.
+
+    Scripts, and the block lists nested within them (e.g., the body of a
+    loop), are identified by a structural hash that ignores literal values.
+    Those that share a hash across projects are reported as clusters of
+    duplicates. The hashes are held in a sharded table that spills to disk,
+    thus memory is bounded by the `memory` setting (default: 64M) rather than
+    by the size of the corpus. Scripts of fewer than `min_blocks` (default: 4)
+    blocks are ignored, and the largest `clusters` (default: 10) clusters are
+    listed.
+
+    """
+
+    DEPENDENCIES = ('hairball.storage',
+                    'hairball.plugins.duplicate.numbered_scripts')
 
     def __init__(self):
         """Initialize an instance of the DuplicateScripts plugin."""
         super(DuplicateScripts, self).__init__()
         self.total_duplicate = 0
-        self.list_duplicate = []
+        self.list_duplicate = None  # The stores are created upon first use
+        self.hashes = None
+        self.files = []
+
+    @staticmethod
+    def script_hashes(stream, positions, min_blocks):
+        """Return the structural hashes of a script and its nested block lists.
+
+        :param stream: The BlockStream of the project.
+        :param positions: The positions of the blocks of the script within the
+          stream (see `BlockStream.script_range`).
+
+        Returns a (digest, blocks, owner) tuple for each list of at least
+        min_blocks blocks, where owner is the name of the block the list is an
+        argument of (None for the script itself). The hash of a block combines
+        its name with the hashes of its block and block list arguments along
+        with their slots, thus literal values are ignored. The hash of a list
+        combines the hashes of its blocks, thus the hashes form a Merkle tree.
+        They are computed in a single pass over the positions in reverse,
+        which visits the arguments of each block before the block itself.
+
+        """
+        found = []
+        names = OPCODES.names
+        # The (digest, count) of the blocks of each argument of each block by
+        # slot, in reverse order, and those of the top of the script
+        arguments = {}
+        top = []
+        for position in reversed(positions):
+            name = names[stream.opcodes[position]]
+            digest = sha1(name.encode('utf-8') + '\0')
+            count = 1
+            for slot, (kind, items) in sorted(
+                    arguments.pop(position, {}).items()):
+                if kind == '[':
+                    item_digest, item_count = DuplicateScripts._list_hash(
+                        items, min_blocks, name, found)
+                else:
+                    item_digest, item_count = items[0]
+                digest.update('{}{}{}'.format(slot, kind, item_digest))
+                count += item_count
+            parent = stream.parents[position]
+            if parent < 0:
+                top.append((digest.digest(), count))
+                continue
+            kind = '[' if stream.depths[position] > stream.depths[parent] \
+                else '('
+            arguments.setdefault(parent, {}).setdefault(
+                stream.slots[position], (kind, []))[1].append(
+                    (digest.digest(), count))
+        DuplicateScripts._list_hash(top, min_blocks, None, found)
+        return found
+
+    @staticmethod
+    def _list_hash(items, min_blocks, owner, found):
+        """Return the (digest, count) of a block list given in reverse order.
+
+        The list is appended to found when it has at least min_blocks blocks.
+
+        """
+        digest = sha1('[')
+        count = 0
+        for item_digest, item_count in reversed(items):
+            digest.update(item_digest)
+            count += item_count
+        digest = digest.digest()
+        if count >= min_blocks:
+            found.append((digest, count, owner))
+        return digest, count
+
+    def _stores(self):
+        """Create the stores of the duplicates and hashes if necessary.
+
+        Half of the memory budget is allotted to each store.
+
+        """
+        if self.hashes is None:
+            budget = self.setting('memory', DEFAULT_BUDGET, parse_size) // 2
+            directory = self.setting('directory')
+            self.list_duplicate = SpillList(budget, directory)
+            self.hashes = ShardedTable(self.setting('shards', 64, int),
+                                       budget, directory)
+
+    def _record(self, filename, duplicates, hashes):
+        """Record the duplicates and hashes of the scripts of filename."""
+        self._stores()
+        self.total_duplicate += len(duplicates)
+        self.list_duplicate.extend(duplicates)
+        index = len(self.files)
+        self.files.append(filename)
+        for digest, blocks, sprite, number, owner in hashes:
+            self.hashes.add(digest.decode('hex'),
+                            (index, blocks, sprite, number, owner))
 
     def finalize(self):
         """Output the duplicate scripts detected."""
@@ -20,24 +149,324 @@ class DuplicateScripts(HairballPlugin):
             print('{} duplicate scripts found'.format(self.total_duplicate))
             for duplicate in self.list_duplicate:
                 print(duplicate)
+        if self.hashes is None:
+            return
+        limit = self.setting('clusters', 10, int)
+        largest = []  # heap of (blocks, copies, projects, digest, records)
+        clusters = copies = 0
+        for digest, records in self.hashes.groups():
+            projects = len(set(x[0] for x in records))
+            if projects < 2:
+                continue  # Duplicated only within a single project
+            clusters += 1
+            copies += len(records)
+            item = (records[0][1], len(records), projects, digest, records[:3])
+            if len(largest) < limit:
+                heapq.heappush(largest, item)
+            elif item > largest[0]:
+                heapq.heapreplace(largest, item)
+        if clusters:
+            print('{} scripts duplicated across projects ({} copies)'
+                  .format(clusters, copies))
+        for blocks, count, projects, _, records in sorted(largest,
+                                                          reverse=True):
+            print('{} blocks, {} copies in {} projects:'.format(
+                blocks, count, projects))
+            for index, _, sprite, number, owner in records:
+                where = '{} script {}'.format(sprite, number)
+                if owner:
+                    where += ' within {!r}'.format(owner)
+                print('  {}: {}'.format(self.files[index], where))
+        self.list_duplicate.close()
+        self.hashes.close()
+
+    def restore(self, result, **kwargs):
+        """Record the duplicates contained in a cached result."""
+        self._record(kwargs['filename'], result['duplicates'],
+                     result['hashes'])
+
+    def merge(self, other):
+        """Merge the duplicates found by another DuplicateScripts instance."""
+        if other.hashes is None:
+            return
+        self._stores()
+        self.total_duplicate += other.total_duplicate
+        self.list_duplicate.extend(other.list_duplicate)
+        offset = len(self.files)
+        self.files.extend(other.files)
+        for digest, record in other.hashes.items():
+            self.hashes.add(digest, (record[0] + offset,) + record[1:])
 
     def analyze(self, scratch, **kwargs):
         """Run and return the results from the DuplicateScripts plugin.
 
-        Only takes into account scripts with more than 3 blocks.
+        Only takes into account scripts with at least `min_blocks` blocks.
 
         """
+        duplicates = []
+        hashes = []
         scripts_set = set()
-        for script in self.iter_scripts(scratch):
-            if script[0].type.text == 'define %s':
-                continue  # Ignore user defined scripts
+        min_blocks = self.setting('min_blocks', 4, int)
+        stream = self.block_stream(scratch)
+        for sprite, number, script in numbered_scripts(stream):
             blocks_list = []
-            for name, _, _ in self.iter_blocks(script.blocks):
+            for name, _, _ in stream.script_blocks(script):
                 blocks_list.append(name)
             blocks_tuple = tuple(blocks_list)
             if blocks_tuple in scripts_set:
-                if len(blocks_list) > 3:
-                    self.total_duplicate += 1
-                    self.list_duplicate.append(blocks_list)
+                if len(blocks_list) >= min_blocks:
+                    duplicates.append(blocks_list)
             else:
                 scripts_set.add(blocks_tuple)
+            for digest, blocks, owner in self.script_hashes(
+                    stream, stream.script_range(script), min_blocks):
+                hashes.append([digest.encode('hex'), blocks, sprite.name,
+                               number, owner])
+        self._record(kwargs['filename'], duplicates, hashes)
+        return {'duplicates': duplicates, 'hashes': hashes}
+
+
+class NearDuplicateScripts(HairballPlugin):
+
+    """Plugin that detects scripts that are nearly duplicated across projects.
+
+    Each script is represented by the set of its shingles, i.e., the
+    sequences of `shingle` (default: 3) consecutive block names, and
+    summarized by a MinHash signature of `permutations` (default: 64)
+    values. Locality-sensitive hashing of bands of the signatures retrieves
+    the pairs of scripts whose estimated Jaccard similarity is likely at
+    least `threshold` (default: 0.8) in time roughly linear in the number of
+    scripts. Only pairs of scripts from different projects are reported, and
+    scripts of fewer than `min_blocks` (default: 4) blocks are ignored. The
+    signatures and buckets spill to disk beyond the `memory` setting
+    (default: 64M).
+
+    """
+
+    DEPENDENCIES = ('hairball.storage',
+                    'hairball.plugins.duplicate.numbered_scripts')
+
+    # Signature values are computed modulo this (Mersenne) prime
+    PRIME = (1 << 31) - 1
+
+    # The seed of the hash functions, which must be the same in every process
+    SEED = 0x5eed
+
+    def __init__(self):
+        """Initialize an instance of the NearDuplicateScripts plugin."""
+        super(NearDuplicateScripts, self).__init__()
+        self.signatures = None  # The stores are created upon first use
+        self.locations = None
+        self.buckets = None
+        self.files = []
+
+    @staticmethod
+    def bands(permutations, threshold):
+        """Return the (bands, rows) that divide a signature for threshold.
+
+        Two signatures are candidates when all rows of one of their bands are
+        equal. The pair of divisors whose similarity of steepest detection,
+        approximately (1 / bands) ** (1 / rows), is closest to threshold is
+        chosen.
+
+        """
+        return min(((bands, permutations // bands) for bands in
+                    xrange(1, permutations + 1) if permutations % bands == 0),
+                   key=lambda x: abs((1. / x[0]) ** (1. / x[1]) - threshold))
+
+    @classmethod
+    def hash_functions(cls, permutations):
+        """Return the (a, b) coefficients of the MinHash hash functions."""
+        functions = _HASH_FUNCTIONS.get(permutations)
+        if functions is None:
+            generator = random.Random(cls.SEED)
+            functions = _HASH_FUNCTIONS[permutations] = [
+                (generator.randrange(1, cls.PRIME),
+                 generator.randrange(cls.PRIME)) for _ in xrange(permutations)]
+        return functions
+
+    @staticmethod
+    def shingles(names, size):
+        """Return the set of hashes of the shingles of a block name sequence.
+
+        Sequences shorter than size have a single shingle.
+
+        """
+        encoded = [x.encode('utf-8') for x in names]
+        return set(zlib.crc32('\0'.join(encoded[i:i + size])) & 0x7fffffff
+                   for i in xrange(max(1, len(encoded) - size + 1)))
+
+    @classmethod
+    def signature(cls, shingles, permutations):
+        """Return the MinHash signature of a set of shingle hashes."""
+        prime = cls.PRIME
+        return array('I', [min((a * x + b) % prime for x in shingles)
+                           for a, b in cls.hash_functions(permutations)])
+
+    def _stores(self):
+        """Create the stores of the signatures and buckets if necessary.
+
+        Half of the memory budget is allotted to the signatures, while the
+        locations and the buckets share the rest.
+
+        """
+        if self.signatures is None:
+            budget = self.setting('memory', DEFAULT_BUDGET, parse_size) // 2
+            directory = self.setting('directory')
+            self.permutations = self.setting('permutations', 64, int)
+            self.threshold = self.setting('threshold', 0.8, float)
+            self.rows = self.bands(self.permutations, self.threshold)[1]
+            # The index of each signature's file precedes its values
+            self.signatures = ArrayStore('I', self.permutations + 1,
+                                         budget, directory)
+            self.locations = SpillList(budget // 4, directory)
+            self.buckets = ShardedTable(self.setting('shards', 64, int),
+                                        budget - budget // 4, directory)
+
+    def _add(self, file_index, location, signature):
+        """Record the signature of a script and add it to its buckets."""
+        index = self.signatures.append(array('I', [file_index]) + signature)
+        self.locations.append(location)
+        for band, start in enumerate(xrange(0, self.permutations,
+                                            self.rows)):
+            key = struct.pack('<H', band) + \
+                signature[start:start + self.rows].tostring()
+            self.buckets.add(sha1(key).digest()[:12], (index, band))
+
+    def _record(self, filename, signatures):
+        """Record the signatures of the scripts of filename."""
+        self._stores()
+        file_index = len(self.files)
+        self.files.append(filename)
+        for sprite, number, blocks, signature in signatures:
+            self._add(file_index, (sprite, number, blocks),
+                      array('I', signature))
+
+    def first_band(self, first, second):
+        """Return the first band in which two stored signatures are equal."""
+        for band, start in enumerate(xrange(1, self.permutations + 1,
+                                            self.rows)):
+            if first[start:start + self.rows] == \
+                    second[start:start + self.rows]:
+                return band
+        return None
+
+    def similar_pairs(self):
+        """Yield the (first, second, similarity) of the near-duplicates.
+
+        Each pair of scripts from different projects that share a bucket is
+        a candidate, and is yielded if the similarity estimated from their
+        signatures is at least the threshold. Pairs are considered only in
+        the first band they share. Only the first `max_bucket` (default:
+        100) scripts of a bucket are considered.
+
+        """
+        max_bucket = self.setting('max_bucket', 100, int)
+        for _, records in self.buckets.groups():
+            records = records[:max_bucket]
+            signatures = [self.signatures[x[0]] for x in records]
+            for i, (first, band) in enumerate(records):
+                for j in xrange(i + 1, len(records)):
+                    a, b = signatures[i], signatures[j]
+                    if a[0] == b[0] or self.first_band(a, b) != band:
+                        continue  # Same project or considered in a prior band
+                    similarity = sum(1 for x, y in zip(a[1:], b[1:])
+                                     if x == y) / float(self.permutations)
+                    if similarity >= self.threshold:
+                        yield first, records[j][0], similarity
+
+    def finalize(self):
+        """Output the clusters of near-duplicate scripts."""
+        if self.signatures is None:
+            return
+        try:
+            self.output_clusters()
+        finally:
+            self.signatures.close()
+            self.locations.close()
+            self.buckets.close()
+
+    def output_clusters(self):
+        """Output the largest `clusters` (default: 10) clusters of scripts.
+
+        Clusters are the connected components of the near-duplicate pairs.
+
+        """
+        parent = {}
+
+        def find(index):
+            root = index
+            while parent.get(root, root) != root:
+                root = parent[root]
+            while index != root:  # Compress the path
+                parent[index], index = root, parent.get(index, index)
+            return root
+
+        pairs = 0
+        for first, second, _ in self.similar_pairs():
+            pairs += 1
+            parent.setdefault(first, first)
+            parent.setdefault(second, second)
+            parent[find(first)] = find(second)
+        clusters = {}
+        for index in parent:
+            clusters.setdefault(find(index), []).append(index)
+        if not clusters:
+            return
+        print('{} pairs of near-duplicate scripts across projects in {} '
+              'clusters (similarity >= {})'.format(pairs, len(clusters),
+                                                   self.threshold))
+        largest = heapq.nlargest(self.setting('clusters', 10, int),
+                                 (sorted(x) for x in clusters.values()),
+                                 key=lambda x: (len(x), [-y for y in x]))
+        wanted = set(x for cluster in largest for x in cluster[:5])
+        locations = dict((index, location) for index, location in
+                         enumerate(self.locations) if index in wanted)
+        for cluster in largest:
+            print('{} similar scripts:'.format(len(cluster)))
+            for index in cluster[:5]:
+                print('  {}: {} script {} ({} blocks)'.format(
+                    self.files[self.signatures[index][0]],
+                    *locations[index]))
+
+    def restore(self, result, **kwargs):
+        """Record the signatures contained in a cached result."""
+        self._record(kwargs['filename'], result['signatures'])
+
+    def merge(self, other):
+        """Merge the signatures of another NearDuplicateScripts instance."""
+        if other.signatures is None:
+            return
+        self._stores()
+        offset = len(self.files)
+        self.files.extend(other.files)
+        for index, location in enumerate(other.locations):
+            signature = other.signatures[index]
+            self._add(signature[0] + offset, location, signature[1:])
+
+    def analyze(self, scratch, **kwargs):
+        """Run and return the results from the NearDuplicateScripts plugin.
+
+        The results contain the signature of each script along with its
+        sprite, number within the sprite and number of blocks.
+
+        """
+        self._stores()
+        size = self.setting('shingle', 3, int)
+        min_blocks = self.setting('min_blocks', 4, int)
+        stream = self.block_stream(scratch)
+        signatures = []
+        for sprite, number, script in numbered_scripts(stream):
+            names = [name for name, _, _ in stream.script_blocks(script)]
+            if len(names) < min_blocks:
+                continue
+            signature = self.signature(self.shingles(names, size),
+                                       self.permutations)
+            signatures.append([sprite.name, number, len(names),
+                               signature.tolist()])
+        self._record(kwargs['filename'], signatures)
+        return {'signatures': signatures}
+
+
+# Cache of the MinHash hash functions by number of permutations
+_HASH_FUNCTIONS = {}
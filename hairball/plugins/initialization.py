@@ -42,48 +42,21 @@ class AttributeInitialization(HairballPlugin):
         return retval
 
     @classmethod
-    def attribute_state(cls, scripts, attribute):
+    def attribute_state(cls, scripts, attribute, stream=None):
         """Return the state of the scripts for the given attribute.
 
         If there is more than one 'when green flag clicked' script and they
         both modify the attribute, then the attribute is considered to not be
         initialized.
 
+        When the project's BlockStream is provided the blocks of each script
+        are read from it rather than traversing the scripts.
+
         """
-        green_flag, other = partition_scripts(scripts, cls.HAT_GREEN_FLAG, cls.HAT_CLONE)
-        block_set = cls.BLOCKMAPPING[attribute]
-        state = cls.STATE_NOT_MODIFIED
         # TODO: Any regular broadcast blocks encountered in the initialization
-        # zone should be added to this loop for conflict checking.
-        for script in green_flag:
-            in_zone = True
-            for name, level, _ in cls.iter_blocks(script.blocks):
-                if name == 'broadcast %s and wait':
-                    # TODO: Follow the broadcast and wait scripts that occur in
-                    # the initialization zone
-                    in_zone = False
-                if (name, 'absolute') in block_set:
-                    if in_zone and level == 0:  # Success!
-                        if state == cls.STATE_NOT_MODIFIED:
-                            state = cls.STATE_INITIALIZED
-                        else:  # Multiple when green flag clicked conflict
-                            state = cls.STATE_MODIFIED
-                    elif in_zone:
-                        continue  # Conservative ignore for nested absolutes
-                    else:
-                        state = cls.STATE_MODIFIED
-                    break  # The state of the script has been determined
-                elif (name, 'relative') in block_set:
-                    state = cls.STATE_MODIFIED
-                    break
-        if state != cls.STATE_NOT_MODIFIED:
-            return state
-        # Check the other scripts to see if the attribute was ever modified
-        for script in other:
-            for name, _, _ in cls.iter_blocks(script.blocks):
-                if name in [x[0] for x in block_set]:
-                    return cls.STATE_MODIFIED
-        return cls.STATE_NOT_MODIFIED
+        # zone should be added to the rules for conflict checking.
+        return cls.attribute_rules().resolve(scripts, stream,
+                                             (attribute,))[attribute]
 
     @classmethod
     def output_results(cls, sprites):
@@ -99,19 +72,24 @@ class AttributeInitialization(HairballPlugin):
         print(' '.join(format_strs).format(**cls.attribute_result(sprites)))
 
     @classmethod
-    def sprite_changes(cls, sprite):
-        """Return a mapping of attributes to their initilization state."""
-        retval = dict((x, cls.attribute_state(sprite.scripts, x)) for x in
-                      (x for x in cls.ATTRIBUTES if x != 'background'))
-        return retval
+    def sprite_changes(cls, sprite, stream=None):
+        """Return a mapping of attributes to their initilization state.
+
+        Every attribute is resolved in a single pass over the scripts.
+
+        """
+        scripts = stream.sprite_scripts(sprite) if stream else sprite.scripts
+        attributes = tuple(x for x in cls.ATTRIBUTES if x != 'background')
+        return cls.attribute_rules().resolve(scripts, stream, attributes)
 
     def analyze(self, scratch, **kwargs):
         """Run and return the results of the AttributeInitialization plugin."""
-        changes = dict((x.name, self.sprite_changes(x)) for x in
+        stream = self.block_stream(scratch)
+        changes = dict((x.name, self.sprite_changes(x, stream)) for x in
                        scratch.sprites)
         changes['stage'] = {
-            'background': self.attribute_state(scratch.stage.scripts,
-                                               'costume')}
+            'background': self.attribute_state(
+                stream.sprite_scripts(scratch.stage), 'costume', stream)}
         # self.output_results(changes)
         return {'initialized': changes}
 
@@ -120,16 +98,25 @@ class VariableInitialization(HairballPlugin):
 
     """Plugin that checks if modified variables are properly initialized."""
 
+    DEPENDENCIES = ('hairball.plugins.initialization.partition_scripts',)
+
     STATE_NOT_MODIFIED = 0
     STATE_MODIFIED = 1
     STATE_INITIALIZED = 2
 
+    # The blocks that end the initialization zone, set and change variables
+    ZONE_BLOCKS = frozenset(['broadcast %s and wait', 'set %s effect to %s',
+                             'change %s effect by %s'])
+    MODIFY_BLOCKS = frozenset(['change %s effect by %s',
+                               'set %s effect to %s'])
+
     @classmethod
-    def variable_state(cls, scripts, variables):
+    def variable_state(cls, scripts, variables, stream=None):
         """Return the initialization state for each variable in variables.
 
         The state is determined based on the scripts passed in via the scripts
-        parameter.
+        parameter. When the project's BlockStream is provided the blocks of
+        each script are read from it rather than traversing the scripts.
 
         If there is more than one 'when green flag clicked' script and they
         both modify the attribute, then the attribute is considered to not be
@@ -142,11 +129,13 @@ class VariableInitialization(HairballPlugin):
             if state == cls.STATE_NOT_MODIFIED:
                 variables[block.args[0]] = cls.STATE_MODIFIED
 
-        green_flag, other = partition_scripts(scripts, cls.HAT_GREEN_FLAG)
+        green_flag, other = partition_scripts(scripts, cls.HAT_GREEN_FLAG,
+                                              cls.HAT_CLONE)
         variables = dict((x, cls.STATE_NOT_MODIFIED) for x in variables)
         for script in green_flag:
             in_zone = True
-            for name, level, block in cls.iter_blocks(script.blocks):
+            for name, level, block in cls.script_blocks(script, stream,
+                                                        cls.ZONE_BLOCKS):
                 if name == 'broadcast %s and wait':
                     in_zone = False
                 if name == 'set %s effect to %s':
@@ -169,18 +158,21 @@ class VariableInitialization(HairballPlugin):
                 elif name == 'change %s effect by %s':
                     conditionally_set_not_modified()
         for script in other:
-            for name, _, block in cls.iter_blocks(script.blocks):
-                if name in ('change %s effect by %s', 'set %s effect to %s'):
-                    conditionally_set_not_modified()
+            for _, _, block in cls.script_blocks(script, stream,
+                                                 cls.MODIFY_BLOCKS):
+                conditionally_set_not_modified()
         return variables
 
     def analyze(self, scratch, **kwargs):
         """Run and return the results of the VariableInitialization plugin."""
-        variables = dict((x, self.variable_state(x.scripts, x.variables))
-                         for x in scratch.sprites)
-        variables['global'] = self.variable_state(self.iter_scripts(scratch),
-                                                  scratch.stage.variables)
+        stream = self.block_stream(scratch)
+        variables = dict((x.name, self.variable_state(
+            stream.sprite_scripts(x), x.variables, stream))
+            for x in scratch.sprites)
+        variables['global'] = self.variable_state(
+            [x for _, x in stream.scripts], scratch.stage.variables, stream)
         # Output for now
-        import pprint
-        pprint.pprint(variables)
+        if self.verbose:
+            import pprint
+            pprint.pprint(variables)
         return {'variables': variables}
@@ -0,0 +1,109 @@
+"""This module provides the --prefetch stage of a single process run.
+
+While the plugins analyze one project, background threads load (read, hash
+and deserialize) the projects of the next files. At most a fixed number of
+files are loaded ahead of the one being analyzed, which bounds the memory
+held by prefetched projects.
+
+"""
+
+import sys
+import threading
+from collections import deque
+from Queue import Empty, Queue
+from .profiling import NULL_PROFILER
+
+
+class PendingLoad(object):
+
+    """The eventual result of loading the project of a file."""
+
+    def __init__(self, filename):
+        """Initialize the pending load of filename."""
+        self.filename = filename
+        self.done = threading.Event()
+        self.project = None
+        self.exc_info = None
+
+    def result(self):
+        """Wait for and return the project, re-raising any load failure."""
+        self.done.wait()
+        if self.exc_info:
+            exc_info, self.exc_info = self.exc_info, None
+            raise exc_info[0], exc_info[1], exc_info[2]
+        project, self.project = self.project, None  # Release it once used
+        return project
+
+
+class Prefetcher(object):
+
+    """Iterates over filenames while loading the projects ahead on threads.
+
+    Yields (filename, load) pairs in the order of filenames where calling
+    load returns the project of the file (or raises the exception loading it
+    raised). The next `depth` files are loaded by `depth` daemon threads.
+
+    """
+
+    def __init__(self, load, filenames, depth, profiler=NULL_PROFILER):
+        """Initialize a prefetcher that loads the files via load.
+
+        The time each thread spends loading is recorded by profiler as the
+        `prefetch load` phase.
+
+        """
+        self.load = load
+        self.filenames = iter(filenames)
+        self.depth = depth
+        self.profiler = profiler
+        self.tasks = Queue()
+        self.workers = []
+        for _ in range(depth):
+            self.workers.append(threading.Thread(target=self.work))
+            self.workers[-1].daemon = True  # Never keep the process alive
+            self.workers[-1].start()
+
+    def __iter__(self):
+        """Yield (filename, load) for each filename."""
+        pending = deque()
+        try:
+            while True:
+                # Keep depth files loading ahead of the one being analyzed
+                while len(pending) <= self.depth:
+                    filename = next(self.filenames, None)
+                    if filename is None:
+                        break
+                    pending.append(PendingLoad(filename))
+                    self.tasks.put(pending[-1])
+                if not pending:
+                    return
+                current = pending.popleft()
+                yield current.filename, current.result
+        finally:
+            self.stop()
+
+    def stop(self):
+        """Discard the queued files and wait for the threads to finish."""
+        try:
+            while True:
+                self.tasks.get_nowait()
+        except Empty:
+            pass
+        for _ in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join()
+
+    def work(self):
+        """Load the projects of the queued files until told to stop."""
+        while True:
+            pending = self.tasks.get()
+            if pending is None:
+                return
+            try:
+                with self.profiler.section('prefetch load'):
+                    pending.project = self.load(pending.filename)
+            except Exception:  # pylint: disable=W0703
+                pending.exc_info = sys.exc_info()
+            finally:
+                pending.done.set()
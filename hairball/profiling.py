@@ -0,0 +1,221 @@
+"""This module provides the instrumentation behind the --profile report.
+
+A run is divided into named phases (e.g., finding files, parsing, and the
+analysis of each plugin). The Profiler records the wall time, CPU time and
+growth of the peak memory of each phase, both in aggregate and for each file,
+and reports the slowest files. When profiling is off the NullProfiler is used
+whose sections do nothing.
+
+"""
+
+from __future__ import print_function
+import heapq
+import sys
+import thread
+import threading
+import time
+from contextlib import contextmanager
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+
+# ru_maxrss is measured in kilobytes except on OS X where it is in bytes
+MAXRSS_SCALE = 1 if sys.platform == 'darwin' else 1024
+
+
+def usage(children=False):
+    """Return the CPU time and the peak memory (bytes) of the process.
+
+    When children is True, the CPU time of terminated child processes (e.g.,
+    parallel workers) is included, as is their peak memory if it is larger.
+    The peak memory is 0 when the platform does not provide it.
+
+    """
+    if resource is None:
+        return time.clock(), 0
+    rusage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu, peak = rusage.ru_utime + rusage.ru_stime, rusage.ru_maxrss
+    if children:
+        rusage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu += rusage.ru_utime + rusage.ru_stime
+        peak = max(peak, rusage.ru_maxrss)
+    return cpu, peak * MAXRSS_SCALE
+
+
+class Profiler(object):
+
+    """Records the wall time, CPU time and memory of the phases of a run.
+
+    Sections are inclusive, thus the time of a section defined within another
+    section is also counted toward the outer one. Profilers can be pickled and
+    merged, e.g., to combine the profiles of worker processes, in which case
+    the time of each phase is the sum across the workers. The peak memory of
+    a phase is the largest growth of the process' peak memory during one of
+    its sections. Sections may be recorded from any thread, but only those
+    of the thread that entered `file` are attributed to the file.
+
+    """
+
+    enabled = True
+
+    def __init__(self, slowest=10):
+        """Initialize a profiler that reports the given number of files."""
+        self.slowest = slowest
+        self.phases = {}  # phase: [calls, wall time, CPU time, peak growth]
+        self.files = []  # heap of (wall time, filename, {phase: wall time})
+        self.file_count = 0
+        self.peak = 0
+        self.current = None
+        self.current_thread = None
+        self.start = time.time(), usage(children=True)[0]
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        """Return the state of the profiler excluding its lock."""
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        """Restore the state of the profiler."""
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def section(self, phase):
+        """Context manager that records the time spent within it as phase."""
+        wall = time.time()
+        cpu, peak = usage()
+        try:
+            yield
+        finally:
+            wall = time.time() - wall
+            end_cpu, end_peak = usage()
+            with self.lock:
+                stats = self.phases.setdefault(phase, [0, 0.0, 0.0, 0])
+                stats[0] += 1
+                stats[1] += wall
+                stats[2] += end_cpu - cpu
+                stats[3] = max(stats[3], end_peak - peak)
+                self.peak = max(self.peak, end_peak)
+                if self.current is not None and \
+                        self.current_thread == thread.get_ident():
+                    self.current[phase] = self.current.get(phase, 0.0) + wall
+
+    @contextmanager
+    def file(self, filename):
+        """Context manager that attributes the sections within to filename."""
+        wall = time.time()
+        self.current = {}
+        self.current_thread = thread.get_ident()
+        try:
+            yield
+        finally:
+            self.add_file(time.time() - wall, filename, self.current)
+            self.current = None
+
+    def add_file(self, wall, filename, phases):
+        """Record the time spent on filename keeping only the slowest."""
+        self.file_count += 1
+        if self.slowest <= 0:
+            return
+        item = (wall, filename, phases)
+        if len(self.files) < self.slowest:
+            heapq.heappush(self.files, item)
+        elif item > self.files[0]:
+            heapq.heapreplace(self.files, item)
+
+    def iterate(self, iterable, phase):
+        """Yield the items of iterable recording the time taken as phase."""
+        iterator = iter(iterable)
+        while True:
+            with self.section(phase):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def merge(self, other):
+        """Combine the phases and files recorded by other into this one."""
+        with self.lock:
+            for phase, (calls, wall, cpu, peak) in other.phases.items():
+                stats = self.phases.setdefault(phase, [0, 0.0, 0.0, 0])
+                stats[0] += calls
+                stats[1] += wall
+                stats[2] += cpu
+                stats[3] = max(stats[3], peak)
+            for item in other.files:
+                self.add_file(*item)
+            self.file_count += other.file_count - len(other.files)
+            self.peak = max(self.peak, other.peak)
+
+    def report(self, fp=None):
+        """Output the recorded phases and the slowest files to fp (stderr)."""
+        from .cache import format_size  # The cache module imports this one
+        fp = fp or sys.stderr
+        wall = time.time() - self.start[0]
+        cpu, peak = usage(children=True)
+        cpu -= self.start[1]
+        peak = max(self.peak, peak)
+        print('Profile of {} files: {:.3f}s wall, {:.3f}s CPU, {} peak '
+              'memory'.format(self.file_count, wall, cpu, format_size(peak)),
+              file=fp)
+        width = max([5] + [len(x) for x in self.phases])
+        print('{:{}}  {:>8} {:>10} {:>10} {:>10}'.format(
+            'phase', width, 'calls', 'wall s', 'cpu s', 'peak +'), file=fp)
+        for phase, (calls, p_wall, p_cpu, p_peak) in sorted(
+                self.phases.items(), key=lambda x: (-x[1][1], x[0])):
+            print('{:{}}  {:8} {:10.3f} {:10.3f} {:>10}'.format(
+                phase, width, calls, p_wall, p_cpu, format_size(p_peak)),
+                file=fp)
+        if self.files:
+            print('Slowest {} files:'.format(len(self.files)), file=fp)
+        for f_wall, filename, phases in sorted(self.files, reverse=True):
+            top = sorted(phases.items(), key=lambda x: (-x[1], x[0]))[:3]
+            print('{:10.3f}s  {} ({})'.format(
+                f_wall, filename, ', '.join('{} {:.3f}s'.format(*x)
+                                            for x in top)), file=fp)
+
+
+class NullProfiler(object):
+
+    """A profiler that records nothing, used when profiling is off."""
+
+    enabled = False
+
+    def __init__(self):
+        """Initialize the reusable section."""
+        self._section = _NullSection()
+
+    def section(self, phase):  # pylint: disable=W0613
+        """Return a context manager that does nothing."""
+        return self._section
+
+    def file(self, filename):  # pylint: disable=W0613
+        """Return a context manager that does nothing."""
+        return self._section
+
+    @staticmethod
+    def iterate(iterable, phase):  # pylint: disable=W0613
+        """Return iterable as is."""
+        return iterable
+
+
+class _NullSection(object):
+
+    """A reusable context manager that does nothing."""
+
+    def __enter__(self):
+        """Do nothing upon entering the context."""
+        pass
+
+    def __exit__(self, *exc_info):
+        """Do nothing upon exiting the context."""
+        pass
+
+
+# The profiler used when profiling is off
+NULL_PROFILER = NullProfiler()
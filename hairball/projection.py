@@ -0,0 +1,156 @@
+"""This module provides a projection of Kurt projects suitable for analysis.
+
+The projection retains everything the plugins analyze (sprites, their names,
+variables, lists and scripts) but not the media (costumes, sounds and the
+thumbnail). Media are loaded from the original file only when accessed.
+
+"""
+
+import kurt
+
+
+class LazyMedia(object):
+
+    """Descriptor for a media attribute that is loaded when first accessed.
+
+    The value is retrieved from the same attribute of the corresponding object
+    in the fully loaded original project (see `AnalysisProject.media`).
+
+    """
+
+    def __init__(self, attribute):
+        """Initialize the descriptor for attribute."""
+        self.attribute = attribute
+        self.key = '_' + attribute
+
+    def __get__(self, instance, owner):
+        """Return the value loading it from the original project if needed."""
+        if instance is None:
+            return self
+        if self.key not in instance.__dict__:
+            source = instance.media_source()
+            instance.__dict__[self.key] = getattr(source, self.attribute)
+        return instance.__dict__[self.key]
+
+    def __set__(self, instance, value):
+        """Replace the value of the attribute."""
+        instance.__dict__[self.key] = value
+
+    def reset(self, instance):
+        """Forget the value so that it is loaded upon the next access."""
+        instance.__dict__.pop(self.key, None)
+
+
+class AnalysisProject(kurt.Project):
+
+    """A kurt Project whose media are loaded from its path on demand."""
+
+    thumbnail = LazyMedia('thumbnail')
+
+    def __getstate__(self):
+        """Return the state of the project excluding all loaded media."""
+        state = self.__dict__.copy()
+        for key in ('_media', '_thumbnail'):
+            state.pop(key, None)
+        return state
+
+    @property
+    def format(self):
+        """The name of the format the original project was loaded with."""
+        return self.format_name
+
+    @property
+    def media(self):
+        """Attribute that returns the fully loaded original project."""
+        if '_media' not in self.__dict__:
+            from .loader import load_project  # The loader imports this module
+            self.__dict__['_media'] = load_project(self.path)
+        return self.__dict__['_media']
+
+    def media_source(self):
+        """Return the project the media of this project are loaded from."""
+        return self.media
+
+
+class AnalysisScriptableMixin(object):
+
+    """Mixin for scriptables whose costumes and sounds are loaded lazily."""
+
+    costumes = LazyMedia('costumes')
+    costume = LazyMedia('costume')
+    sounds = LazyMedia('sounds')
+
+    def __getstate__(self):
+        """Return the state of the scriptable excluding all loaded media."""
+        state = self.__dict__.copy()
+        for key in ('_costumes', '_costume', '_sounds'):
+            state.pop(key, None)
+        return state
+
+    def reset_media(self):
+        """Forget any media so that they are loaded upon the next access."""
+        for name in ('costumes', 'costume', 'sounds'):
+            getattr(type(self), name).reset(self)
+
+
+class AnalysisStage(AnalysisScriptableMixin, kurt.Stage):
+
+    """A kurt Stage whose costumes and sounds are loaded on demand."""
+
+    def media_source(self):
+        """Return the stage the media of this stage are loaded from."""
+        return self.project.media.stage
+
+
+class AnalysisSprite(AnalysisScriptableMixin, kurt.Sprite):
+
+    """A kurt Sprite whose costumes and sounds are loaded on demand."""
+
+    def media_source(self):
+        """Return the sprite the media of this sprite are loaded from."""
+        return self.project.media.get_sprite(self.name)
+
+
+def analysis_projection(scratch):
+    """Return an AnalysisProject sharing the non-media contents of scratch.
+
+    The scripts, variables and lists are shared rather than copied, thus
+    creating the projection is inexpensive. Watchers are shared too, but are
+    retargeted to the projected stage and sprites so that the projection does
+    not reference the original project.
+
+    """
+    project = AnalysisProject()
+    for name, value in vars(scratch).items():
+        # _original holds the undecoded file contents, including the media
+        if name not in ('_original', '_plugin', 'actors', 'sprites', 'stage',
+                        'thumbnail'):
+            setattr(project, name, value)
+    project.format_name = scratch.format
+    AnalysisProject.thumbnail.reset(project)
+
+    def project_scriptable(scriptable, projected):
+        """Copy the non-media attributes of scriptable to projected."""
+        for name, value in vars(scriptable).items():
+            if name not in ('costume', 'costumes', 'project', 'sounds'):
+                setattr(projected, name, value)
+        projected.reset_media()
+        return projected
+
+    project.stage = project_scriptable(scratch.stage, AnalysisStage(project))
+    targets = {id(scratch): project, id(scratch.stage): project.stage}
+    for sprite in scratch.sprites:
+        project.sprites.append(project_scriptable(
+            sprite, AnalysisSprite(project, sprite.name)))
+        targets[id(sprite)] = project.sprites[-1]
+    project.actors = [targets.get(id(x), x) for x in scratch.actors]
+
+    # Watchers may be reached through the actors or the variables and lists
+    watchers = [x for x in project.actors if isinstance(x, kurt.Watcher)]
+    for owner in [project, project.stage] + project.sprites:
+        for value in owner.variables.values() + owner.lists.values():
+            if isinstance(getattr(value, 'watcher', None), kurt.Watcher):
+                watchers.append(value.watcher)
+    for watcher in watchers:
+        watcher.target = targets.get(id(watcher.target), watcher.target)
+    return project
@@ -0,0 +1,236 @@
+"""This module provides the registry of the plugins that can be loaded.
+
+Plugins are found by parsing the modules of the `hairball.plugins` package and
+of the --plugin-dir directory with `ast`, thus plugins can be listed, and the
+name given to -p resolved to a module and class, without importing any plugin
+(or kurt). A class is a plugin when one of its bases is HairballPlugin or
+another plugin class. The classes found within each module are cached in a
+JSON file, such that later runs only stat the modules that did not change.
+
+Plugins of other packages (e.g., `-p package.module.Class`) are not listed,
+but the names of those on `sys.path` are resolved to their module and class.
+
+"""
+
+from __future__ import print_function
+import ast
+import errno
+import json
+import os
+import pkgutil
+from .cache import default_cache_dir
+
+
+# Change FORMAT whenever the contents of the registry cache change
+FORMAT = 1
+
+# The directory and package of the bundled plugins
+BUNDLED_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'plugins')
+BUNDLED_PACKAGE = 'hairball.plugins'
+# The name of the registry cache within the default cache directory
+CACHE_FILENAME = 'plugins.json'
+
+
+def docstring_summary(doc):
+    """Return the first line of the docstring doc."""
+    return (doc or '').split('\n')[0]
+
+
+def docstring_description(doc):
+    """Return the paragraphs of the docstring doc after its summary line."""
+    lines = []
+    for line in (doc or '').split('\n')[2:]:
+        line = line.strip()
+        if line:
+            lines.append(line)
+    return ' '.join(lines)
+
+
+def scan_module(path):
+    """Return the [name, base names, docstring] of each class of a module.
+
+    Only the classes defined at the top level of the module are included.
+    Bases imported under another name (`import ... as`) are given by their
+    original name.
+
+    """
+    with open(path, 'rb') as fp:
+        tree = ast.parse(fp.read(), path)
+    aliases = {}
+    classes = []
+    for node in tree.body:
+        if isinstance(node, ast.ImportFrom):
+            for alias in node.names:
+                if alias.asname:
+                    aliases[alias.asname] = alias.name
+        elif isinstance(node, ast.ClassDef):
+            bases = []
+            for base in node.bases:
+                if isinstance(base, ast.Name):
+                    bases.append(aliases.get(base.id, base.id))
+                elif isinstance(base, ast.Attribute):
+                    bases.append(base.attr)
+            classes.append([node.name, bases,
+                            ast.get_docstring(node, clean=False)])
+    return classes
+
+
+def find_modules(directory, package=None):
+    """Yield the (module name, path) of the python modules in directory.
+
+    Subdirectories that are packages are included recursively.
+
+    """
+    try:
+        filenames = sorted(os.listdir(directory))
+    except OSError:
+        return
+    for filename in filenames:
+        path = os.path.join(directory, filename)
+        name, extension = os.path.splitext(filename)
+        if extension == '.py' and name != '__init__':
+            yield '.'.join(filter(None, (package, name))), path
+        elif not extension and \
+                os.path.isfile(os.path.join(path, '__init__.py')):
+            name = '.'.join(filter(None, (package, filename)))
+            yield name, os.path.join(path, '__init__.py')
+            for module in find_modules(path, name):
+                yield module
+
+
+class PluginRegistry(object):
+
+    """The plugins of a plugin directory and those bundled with Hairball.
+
+    Each plugin is a dict of its `name` (what -p accepts, e.g.,
+    `blocks.DeadCode`), `module` (the module to import), `class`, `summary`
+    (the first line of its docstring) and `description`. The plugins of the
+    plugin directory come first, as they take precedence.
+
+    """
+
+    def __init__(self, plugin_dir=None, cache_path=True):
+        """Find the plugins of plugin_dir and the bundled plugins.
+
+        :param cache_path: The JSON file in which the classes of each module
+          are cached (True for CACHE_FILENAME within the default cache
+          directory, None to not cache them).
+
+        """
+        if cache_path is True:
+            cache_path = os.path.join(default_cache_dir(), CACHE_FILENAME)
+        self.plugin_dir = plugin_dir
+        self.cache_path = cache_path
+        self.plugins = []
+        modules = []  # The (name prefix, module name, classes) of each module
+        cache = self._read_cache()
+        changed = False
+        sources = [(BUNDLED_DIR, BUNDLED_PACKAGE)]
+        if plugin_dir:
+            sources.insert(0, (plugin_dir, None))
+        for directory, package in sources:
+            for module, path in find_modules(directory, package):
+                path = os.path.abspath(path)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                key = [stat.st_size, stat.st_mtime]
+                entry = cache.get(path)
+                if entry is None or entry[:2] != key:
+                    try:
+                        classes = scan_module(path)
+                    except (IOError, SyntaxError, TypeError):
+                        classes = []  # The import reports the error
+                    entry = cache[path] = key + [classes]
+                    changed = True
+                prefix = module
+                if package and module.startswith(package + '.'):
+                    prefix = module[len(package) + 1:]
+                modules.append((prefix, module, entry[2]))
+
+        # A class is a plugin when one of its bases is a plugin class
+        plugin_classes = set(['HairballPlugin'])
+        while True:
+            count = len(plugin_classes)
+            for _, _, classes in modules:
+                for name, bases, _ in classes:
+                    if plugin_classes.intersection(bases):
+                        plugin_classes.add(name)
+            if len(plugin_classes) == count:
+                break
+        for prefix, module, classes in modules:
+            for name, _, doc in classes:
+                if name in plugin_classes and name != 'HairballPlugin':
+                    self.plugins.append({
+                        'name': '{}.{}'.format(prefix, name),
+                        'module': module, 'class': name,
+                        'summary': docstring_summary(doc),
+                        'description': docstring_description(doc)})
+        if changed:
+            self._write_cache(cache)
+
+    def _read_cache(self):
+        """Return the cached classes of each module by path."""
+        if not self.cache_path:
+            return {}
+        try:
+            with open(self.cache_path) as fp:
+                data = json.load(fp)
+        except (IOError, ValueError):
+            return {}
+        if not isinstance(data, dict) or data.get('format') != FORMAT:
+            return {}
+        return data['modules']
+
+    def _write_cache(self, cache):
+        """Atomically replace the cache file, ignoring any failure."""
+        if not self.cache_path:
+            return
+        tmp_path = '{}.{}.tmp'.format(self.cache_path, os.getpid())
+        try:
+            try:
+                os.makedirs(os.path.dirname(self.cache_path))
+            except OSError as exc:
+                if exc.errno != errno.EEXIST:
+                    raise
+            with open(tmp_path, 'w') as fp:
+                json.dump({'format': FORMAT, 'modules': cache}, fp)
+            os.rename(tmp_path, self.cache_path)
+        except (IOError, OSError):
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    def find(self, name):
+        """Return the plugin named name, or None when there is none.
+
+        name is either `module.Class`, `module` for the class named as the
+        titlecase of module, or the full import name of the class. Names
+        that are not those of a listed plugin are resolved to any module
+        that can be imported, which is not verified to contain a plugin.
+
+        """
+        parts = name.split('.')
+        if len(parts) > 1:
+            module, class_name = '.'.join(parts[:-1]), parts[-1]
+        else:
+            module, class_name = parts[0], parts[0].title()
+        for plugin in self.plugins:
+            if plugin['class'] == class_name and module in (
+                    plugin['name'].rpartition('.')[0], plugin['module']):
+                return plugin
+        try:  # Importing a package is needed to find its modules
+            if pkgutil.find_loader(module) is None:
+                return None
+        except ImportError:
+            return None
+        return {'name': name, 'module': module, 'class': class_name,
+                'summary': '', 'description': ''}
+
+    def output(self):
+        """Output the name and summary of each plugin."""
+        for plugin in self.plugins:
+            print('{:40} {}'.format(plugin['name'], plugin['summary']))
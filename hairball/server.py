@@ -0,0 +1,206 @@
+"""This module provides the server run by `hairball serve`.
+
+The server keeps a Hairball instance, its plugins and its cache resident, and
+analyzes the projects submitted to it over HTTP, either on a TCP address or a
+Unix socket. Requests are handled one at a time.
+
+* `GET /plugins` returns the import names of the loaded plugins.
+* `POST /analyze?name=NAME` analyzes the project contained in the request
+  body. NAME is the project's filename, whose extension determines its
+  format.
+* `POST /analyze` with a JSON body of the form `{"projects": [...]}` analyzes
+  a batch of projects. Each project is either `{"name": NAME, "data":
+  BASE64}` to analyze the given contents, or, when the server is run with
+  `--allow-paths`, `{"path": PATH}` to analyze a file on the server.
+
+The response of `/analyze` is `{"results": [...]}` containing, in submission
+order, either `{"file": FILE, "results": {PLUGIN: RESULT, ...}}` or
+`{"file": FILE, "error": MESSAGE}` for each project. Malformed projects of a
+batch, and those given by path when paths are not allowed, result in an error
+for that project only.
+
+"""
+
+import BaseHTTPServer
+import SocketServer
+import base64
+import json
+import os
+import socket
+import stat
+import traceback
+from urlparse import parse_qs, urlparse
+from .archives import MemoryFile
+from .output import jsonable
+
+
+class AnalysisHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    """Handles the requests made to an AnalysisServer."""
+
+    server_version = 'Hairball'
+
+    def address_string(self):
+        """Return the client address for logging (none for Unix sockets)."""
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'unix'
+
+    def do_GET(self):  # pylint: disable=C0103
+        """Respond with the loaded plugins."""
+        if urlparse(self.path).path != '/plugins':
+            return self.send_error(404)
+        self.send_json({'plugins': [x.import_name for x in
+                                    self.server.hairball.plugins]})
+
+    def do_POST(self):  # pylint: disable=C0103
+        """Respond with the results of analyzing the submitted projects."""
+        url = urlparse(self.path)
+        if url.path != '/analyze':
+            return self.send_error(404)
+        try:
+            length = int(self.headers.getheader('content-length'))
+        except (TypeError, ValueError):
+            return self.send_error(411)
+        body = self.rfile.read(length)
+        name = parse_qs(url.query).get('name')
+        try:
+            if name:
+                projects = [{'name': name[0], 'data': body}]
+            else:
+                projects = json.loads(body)['projects']
+                if not isinstance(projects, list):
+                    raise ValueError('projects is not a list')
+                projects = [self.server.decode(x) for x in projects]
+        except (KeyError, TypeError, ValueError) as exc:
+            return self.send_error(400, 'Invalid request: {!r}'.format(exc))
+        self.send_json({'results': [self.server.analyze(x)
+                                    for x in projects]})
+
+    def log_message(self, *args):
+        """Log the request unless the Hairball is quiet."""
+        if not self.server.hairball.options.quiet:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, *args)
+
+    def send_json(self, data):
+        """Send data as the JSON body of a successful response."""
+        body = json.dumps(data, sort_keys=True)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class AnalysisServer(BaseHTTPServer.HTTPServer):
+
+    """An HTTP server that analyzes projects with the plugins of a Hairball.
+
+    Each project is analyzed by fresh instances of the plugins, thus results
+    do not accumulate across requests. Submitted contents are analyzed as
+    MemoryFiles, which the cache keys by the checksum of their contents.
+
+    """
+
+    def __init__(self, hairball, address, handler=AnalysisHandler):
+        """Initialize the server of hairball listening on address."""
+        BaseHTTPServer.HTTPServer.__init__(self, address, handler)
+        self.hairball = hairball
+        for plugin in hairball.plugins:
+            plugin.verbose = False  # There is no console to print to
+
+    @staticmethod
+    def create(hairball, address=('127.0.0.1', 8000), socket_path=None):
+        """Return a server listening on address or on socket_path."""
+        if socket_path:
+            return UnixAnalysisServer(hairball, socket_path)
+        return AnalysisServer(hairball, address)
+
+    @staticmethod
+    def decode(project):
+        """Return a project of a JSON batch with its base64 data decoded.
+
+        Projects whose data is not valid base64 are returned unchanged, thus
+        `analyze` reports them as malformed.
+
+        """
+        if isinstance(project, dict) and \
+                isinstance(project.get('data'), basestring):
+            try:
+                return dict(project, data=base64.b64decode(project['data']))
+            except (TypeError, ValueError):
+                pass
+        return project
+
+    def analyze(self, project):
+        """Return the response item for a project of a batch.
+
+        A project is either `{'path': PATH}`, which is accepted only with
+        --allow-paths, or `{'name': NAME, 'data': CONTENTS}`. An error item is
+        returned for a project that is malformed.
+
+        """
+        if not isinstance(project, dict):
+            return {'file': None, 'error': 'The project is not an object'}
+        if 'path' in project:
+            filename = label = project['path']
+            if not getattr(self.hairball.options, 'allow_paths', False):
+                return {'file': label, 'error': 'Paths are not allowed by '
+                        'the server (see --allow-paths)'}
+            if not isinstance(label, basestring):
+                return {'file': label, 'error': 'The path is not a string'}
+        else:
+            label = project.get('name')
+            if not isinstance(label, basestring):
+                return {'file': label, 'error': 'The name is not a string'}
+            if not isinstance(project.get('data'), str):
+                return {'file': label, 'error': 'The data is missing or is '
+                        'not base64 encoded'}
+            name = label.encode('utf-8') if isinstance(label, unicode) \
+                else label
+            filename = MemoryFile(name, project['data'])
+        if os.path.splitext(filename)[1] not in self.hairball.extensions:
+            return {'file': label, 'error': 'Unsupported file extension'}
+        plugins = self.hairball.fresh_plugins()
+        try:
+            with self.hairball.profiler.file(filename):
+                results = self.hairball.analyze(filename, plugins)
+        except Exception as exc:  # pylint: disable=W0703
+            traceback.print_exc()
+            return {'file': label, 'error': '{}: {}'.format(
+                type(exc).__name__, exc)}
+        if results is None:
+            return {'file': label, 'error': 'The file could not be loaded'}
+        return {'file': label, 'results': dict(
+            (plugin.import_name, jsonable(result))
+            for plugin, result in zip(plugins, results))}
+
+
+class UnixAnalysisServer(AnalysisServer):
+
+    """An AnalysisServer listening on a Unix socket."""
+
+    address_family = socket.AF_UNIX
+
+    def __init__(self, hairball, path, handler=AnalysisHandler):
+        """Initialize the server listening on the Unix socket at path."""
+        try:  # Remove the socket left behind by a previous server
+            if stat.S_ISSOCK(os.stat(path).st_mode):
+                os.unlink(path)
+        except OSError:
+            pass
+        AnalysisServer.__init__(self, hairball, path, handler)
+
+    def server_bind(self):
+        """Bind to the socket without the host lookup of HTTPServer."""
+        SocketServer.TCPServer.server_bind(self)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+    def server_close(self):
+        """Close and remove the socket."""
+        AnalysisServer.server_close(self)
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
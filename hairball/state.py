@@ -0,0 +1,158 @@
+"""This module provides the partial-state files of sharded runs.
+
+A run with `--save-state FILE` writes the partial state of its plugins for
+each file it analyzes, i.e., the fresh plugin instances that analyzed only
+that file, along with the position of the file among every file found.
+`hairball merge` combines the state files of the shards of a run by merging
+these instances in order of position, exactly as a parallel run merges the
+instances returned by its workers, thus the results output by the plugins'
+`finalize` methods match those of a single run over every file.
+
+A state file is a sequence of pickles: a header followed by one record per
+file in ascending order of position. The file is written next to its final
+path and only renamed into place upon completion. cPickle is imported upon
+first use, as every run of Hairball imports this module.
+
+"""
+
+import heapq
+import os
+import sys
+from optparse import OptionParser
+
+
+# Change FORMAT whenever the contents of state files change
+FORMAT = 1
+
+
+def parse_shard(text):
+    """Return the (index, count) tuple of a shard given as `i/N`.
+
+    Shards are numbered from 1 to N. Raise ValueError when text is invalid.
+
+    """
+    index, slash, count = text.partition('/')
+    if not slash or not index.isdigit() or not count.isdigit() or \
+            not 1 <= int(index) <= int(count):
+        raise ValueError('Invalid shard (expected i/N with 1 <= i <= N): {}'
+                         .format(text))
+    return int(index), int(count)
+
+
+class StateWriter(object):
+
+    """Writes the partial state of the plugins of a run to a state file."""
+
+    def __init__(self, path, plugins, shard=(1, 1)):
+        """Create the state file of the shard of a run using plugins.
+
+        :param plugins: Fresh instances of the plugins of the run, which are
+          the instances that `hairball merge` merges the partial states into.
+
+        """
+        import cPickle
+        self.path = path
+        self.tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        self.fp = open(self.tmp_path, 'wb')
+        cPickle.dump({'format': FORMAT, 'shard': shard,
+                      'versions': plugin_versions(plugins),
+                      'plugins': plugins},
+                     self.fp, cPickle.HIGHEST_PROTOCOL)
+
+    def write(self, position, filename, partials):
+        """Write the plugin instances that analyzed the file at position."""
+        import cPickle
+        cPickle.dump((position, filename, partials), self.fp,
+                     cPickle.HIGHEST_PROTOCOL)
+
+    def close(self):
+        """Complete the state file by moving it into place."""
+        self.fp.close()
+        os.rename(self.tmp_path, self.path)
+
+
+def plugin_versions(plugins):
+    """Return the import name and result version of each plugin."""
+    return [(x.import_name, x.result_version()) for x in plugins]
+
+
+def read_state(path):
+    """Return the header and an iterator over the records of a state file."""
+    import cPickle
+    fp = open(path, 'rb')
+    try:
+        header = cPickle.load(fp)
+    except (EOFError, cPickle.UnpicklingError):
+        fp.close()
+        raise ValueError('{} is not a Hairball state file'.format(path))
+    if not isinstance(header, dict) or header.get('format') != FORMAT:
+        fp.close()
+        raise ValueError('{} is not a Hairball state file of format {}'
+                         .format(path, FORMAT))
+
+    def records():
+        with fp:
+            while True:
+                try:
+                    yield cPickle.load(fp)
+                except EOFError:
+                    return
+    return header, records()
+
+
+def merge_states(paths):
+    """Return the plugins with the partial states of every file merged.
+
+    Raise ValueError unless the state files are those of every shard of a
+    run with the same plugins and settings.
+
+    """
+    headers, streams = [], []
+    for path in paths:
+        header, records = read_state(path)
+        headers.append(header)
+        streams.append(records)
+    versions = headers[0]['versions']
+    for path, header in zip(paths, headers):
+        if header['versions'] != versions:
+            raise ValueError('{} was produced by different plugins or '
+                             'settings than {}'.format(path, paths[0]))
+    count = headers[0]['shard'][1]
+    shards = sorted(x['shard'] for x in headers)
+    if shards != [(x, count) for x in xrange(1, count + 1)]:
+        raise ValueError('Expected the state of each of the shards 1/{0} to '
+                         '{0}/{0} once, not: {1}'.format(count, ', '.join(
+                             '{}/{}'.format(*x) for x in shards)))
+    plugins = headers[0]['plugins']
+    for _, _, partials in heapq.merge(*streams):
+        for plugin, partial in zip(plugins, partials):
+            plugin.merge(partial)
+    return plugins
+
+
+def merge_main(argv):
+    """The entrypoint for the `hairball merge` command."""
+    description = ('Combine the state files written via --save-state by the '
+                   'shards of a run, and output the aggregate results of '
+                   'the plugins as a single run over every file would.')
+    parser = OptionParser(usage='%prog merge [options] STATE...',
+                          description=description)
+    parser.add_option('-d', '--plugin-dir', metavar='DIR',
+                      help=('Specify the path to the directory containing '
+                            'plugins that was used by the run.'))
+    options, args = parser.parse_args(argv)
+    if not args:
+        parser.error('At least one STATE file is required.')
+    if options.plugin_dir:
+        if not os.path.isdir(options.plugin_dir):
+            parser.error('{} is not a directory'.format(options.plugin_dir))
+        sys.path.append(options.plugin_dir)
+    try:
+        plugins = merge_states(args)
+    except (IOError, ValueError) as exc:
+        parser.error(str(exc))
+    except (AttributeError, ImportError) as exc:
+        parser.error('Cannot load the plugins of the run ({}). Is '
+                     '--plugin-dir needed?'.format(exc))
+    for plugin in plugins:
+        plugin.finalize()
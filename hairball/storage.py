@@ -0,0 +1,343 @@
+"""This module provides record stores that spill to disk beyond a budget.
+
+Plugins that accumulate records across an entire corpus (e.g., a hash of
+every script) use these stores such that their memory stays within a budget
+regardless of the size of the corpus. Records are marshalled, thus must be
+built from the basic types, and those that do not fit within the budget are
+appended to files within a temporary directory. The files are removed by
+`close`, or when the store is garbage collected.
+
+Stores can be pickled, e.g., to send the records found by a worker process
+to its parent, in which case all of their records are included.
+
+"""
+
+import marshal
+import os
+import shutil
+import tempfile
+import zlib
+from array import array
+from collections import Counter
+
+
+# The default number of bytes of records held in memory by a store
+DEFAULT_BUDGET = 64 * 1024 * 1024
+
+# The approximate memory used to hold a marshalled record beyond its length
+RECORD_OVERHEAD = 40
+
+
+def read_records(path):
+    """Yield the records that were marshalled to the file at path."""
+    with open(path, 'rb') as fp:
+        while True:
+            try:
+                yield marshal.load(fp)
+            except EOFError:
+                return
+
+
+class SpillList(object):
+
+    """An append-only sequence of records that spills to disk.
+
+    Iterating over the list yields the records in the order they were added.
+
+    """
+
+    def __init__(self, budget=DEFAULT_BUDGET, directory=None):
+        """Initialize an empty list that holds up to budget bytes in memory.
+
+        :param directory: The directory in which to create the spill file
+          (default: the system's temporary directory).
+
+        """
+        self.budget = budget
+        self.directory = directory
+        self.path = None
+        self.count = 0
+        self._buffer = []
+        self._size = 0
+
+    def __del__(self):
+        """Remove the spill file."""
+        self.close()
+
+    def __getstate__(self):
+        """Return the settings and every record of the list."""
+        return {'budget': self.budget, 'directory': self.directory,
+                'records': list(self)}
+
+    def __setstate__(self, state):
+        """Restore the list spilling its records as needed."""
+        self.__init__(state['budget'], state['directory'])
+        self.extend(state['records'])
+
+    def __iter__(self):
+        """Yield the records in the order they were added."""
+        if self.path:
+            for record in read_records(self.path):
+                yield record
+        for data in self._buffer:
+            yield marshal.loads(data)
+
+    def __len__(self):
+        """Return the number of records."""
+        return self.count
+
+    def append(self, record):
+        """Add record to the end of the list."""
+        data = marshal.dumps(record)
+        self._buffer.append(data)
+        self._size += len(data) + RECORD_OVERHEAD
+        self.count += 1
+        if self._size > self.budget:
+            self.spill()
+
+    def extend(self, records):
+        """Add each record to the end of the list."""
+        for record in records:
+            self.append(record)
+
+    def spill(self):
+        """Append the records held in memory to the spill file."""
+        if self.path is None:
+            handle, self.path = tempfile.mkstemp(
+                prefix='hairball-', suffix='.spill', dir=self.directory)
+            os.close(handle)
+        with open(self.path, 'ab') as fp:
+            fp.write(''.join(self._buffer))
+        self._buffer = []
+        self._size = 0
+
+    def close(self):
+        """Discard the records and remove the spill file."""
+        if self.path:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+        self.path = None
+        self.count = 0
+        self._buffer = []
+        self._size = 0
+
+
+class ShardedTable(object):
+
+    """A multimap from string keys to records that spills to disk.
+
+    Entries are partitioned into shards by the CRC32 of their key. Once the
+    entries held in memory exceed the budget, they are appended to one file
+    per shard. `groups` reads one shard at a time, thus finding the keys with
+    multiple records needs memory proportional to a single shard.
+
+    """
+
+    def __init__(self, shards=64, budget=DEFAULT_BUDGET, directory=None):
+        """Initialize an empty table that holds up to budget bytes in memory.
+
+        :param directory: The directory in which to create the directory of
+          shard files (default: the system's temporary directory).
+
+        """
+        self.shards = shards
+        self.budget = budget
+        self.directory = directory
+        self.path = None
+        self.count = 0
+        self._buffers = [[] for _ in xrange(shards)]
+        self._size = 0
+
+    def __del__(self):
+        """Remove the shard files."""
+        self.close()
+
+    def __getstate__(self):
+        """Return the settings and every entry of the table."""
+        return {'shards': self.shards, 'budget': self.budget,
+                'directory': self.directory, 'entries': list(self.items())}
+
+    def __setstate__(self, state):
+        """Restore the table spilling its entries as needed."""
+        self.__init__(state['shards'], state['budget'], state['directory'])
+        for key, record in state['entries']:
+            self.add(key, record)
+
+    def __len__(self):
+        """Return the number of entries."""
+        return self.count
+
+    def add(self, key, record):
+        """Add an entry that maps the string key to record."""
+        data = marshal.dumps((key, record))
+        self._buffers[zlib.crc32(key) % self.shards].append(data)
+        self._size += len(data) + RECORD_OVERHEAD
+        self.count += 1
+        if self._size > self.budget:
+            self.spill()
+
+    def spill(self):
+        """Append the entries held in memory to the files of their shards."""
+        if self.path is None:
+            self.path = tempfile.mkdtemp(prefix='hairball-',
+                                         dir=self.directory)
+        for shard, buffer_ in enumerate(self._buffers):
+            if buffer_:
+                with open(self._shard_path(shard), 'ab') as fp:
+                    fp.write(''.join(buffer_))
+        self._buffers = [[] for _ in xrange(self.shards)]
+        self._size = 0
+
+    def _shard_path(self, shard):
+        """Return the path of the file of shard."""
+        return os.path.join(self.path, '{:05}'.format(shard))
+
+    def shard_items(self, shard):
+        """Yield the (key, record) entries of shard in the order added."""
+        if self.path and os.path.exists(self._shard_path(shard)):
+            for entry in read_records(self._shard_path(shard)):
+                yield entry
+        for data in self._buffers[shard]:
+            yield marshal.loads(data)
+
+    def items(self):
+        """Yield every (key, record) entry shard by shard."""
+        for shard in xrange(self.shards):
+            for entry in self.shard_items(shard):
+                yield entry
+
+    def groups(self, min_count=2):
+        """Yield (key, records) for the keys with at least min_count records.
+
+        Keys are yielded shard by shard, and in sorted order within a shard.
+        Records are in the order they were added. Each shard is read twice:
+        once to count its keys and once to collect the records of the keys
+        with enough of them.
+
+        """
+        for shard in xrange(self.shards):
+            counts = Counter(key for key, _ in self.shard_items(shard))
+            wanted = set(key for key, count in counts.iteritems()
+                         if count >= min_count)
+            del counts
+            if not wanted:
+                continue
+            groups = {}
+            for key, record in self.shard_items(shard):
+                if key in wanted:
+                    groups.setdefault(key, []).append(record)
+            for key in sorted(groups):
+                yield key, groups[key]
+
+    def close(self):
+        """Discard the entries and remove the shard files."""
+        if self.path:
+            shutil.rmtree(self.path, ignore_errors=True)
+        self.path = None
+        self.count = 0
+        self._buffers = [[] for _ in xrange(self.shards)]
+        self._size = 0
+
+
+class ArrayStore(object):
+
+    """A sequence of equally long arrays of integers that spills to disk.
+
+    Unlike the other stores, arrays can be accessed by their index, which is
+    returned by `append`. The arrays that were spilled are read back from
+    their file.
+
+    """
+
+    def __init__(self, typecode, length, budget=DEFAULT_BUDGET,
+                 directory=None):
+        """Initialize an empty store of arrays of length typecode items.
+
+        :param directory: The directory in which to create the spill file
+          (default: the system's temporary directory).
+
+        """
+        self.typecode = typecode
+        self.length = length
+        self.budget = budget
+        self.directory = directory
+        self.path = None
+        self.spilled = 0  # The number of arrays in the spill file
+        self._buffer = array(typecode)
+        self._reader = None
+
+    def __del__(self):
+        """Remove the spill file."""
+        self.close()
+
+    def __getstate__(self):
+        """Return the settings and every array of the store."""
+        state = dict((x, getattr(self, x)) for x in
+                     ('typecode', 'length', 'budget', 'directory'))
+        state['arrays'] = [self[x] for x in xrange(len(self))]
+        return state
+
+    def __setstate__(self, state):
+        """Restore the store spilling its arrays as needed."""
+        self.__init__(state['typecode'], state['length'], state['budget'],
+                      state['directory'])
+        for values in state['arrays']:
+            self.append(values)
+
+    def __getitem__(self, index):
+        """Return the array at index."""
+        if not 0 <= index < len(self):
+            raise IndexError('ArrayStore index out of range')
+        if index >= self.spilled:
+            start = (index - self.spilled) * self.length
+            return self._buffer[start:start + self.length]
+        if self._reader is None:
+            self._reader = open(self.path, 'rb')
+        values = array(self.typecode)
+        self._reader.seek(index * self.length * values.itemsize)
+        values.fromfile(self._reader, self.length)
+        return values
+
+    def __len__(self):
+        """Return the number of arrays."""
+        return self.spilled + len(self._buffer) // self.length
+
+    def append(self, values):
+        """Add the array values and return its index."""
+        if len(values) != self.length:
+            raise ValueError('Expected {} values'.format(self.length))
+        index = len(self)
+        self._buffer.extend(values)
+        if len(self._buffer) * self._buffer.itemsize > self.budget:
+            self.spill()
+        return index
+
+    def spill(self):
+        """Append the arrays held in memory to the spill file."""
+        if self.path is None:
+            handle, self.path = tempfile.mkstemp(
+                prefix='hairball-', suffix='.spill', dir=self.directory)
+            os.close(handle)
+        if self._reader:
+            self._reader.close()
+            self._reader = None
+        with open(self.path, 'ab') as fp:
+            self._buffer.tofile(fp)
+        self.spilled = len(self)
+        self._buffer = array(self.typecode)
+
+    def close(self):
+        """Discard the arrays and remove the spill file."""
+        if self._reader:
+            self._reader.close()
+            self._reader = None
+        if self.path:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+        self.path = None
+        self.spilled = 0
+        self._buffer = array(self.typecode)
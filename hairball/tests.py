@@ -0,0 +1,785 @@
+"""The unit tests of Hairball, run via `python setup.py test`."""
+
+# pylint: disable=W0212
+
+import importlib
+import kurt
+import linecache
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import unittest
+import zipfile
+from collections import Counter, defaultdict
+from StringIO import StringIO
+from benchmarks.generate import generate_corpus, generate_project
+from . import Hairball, main, parse_arguments
+from .loader import load_analysis_project, load_project
+from .plugins import OPCODES, HairballPlugin
+from .plugins.blocks import BlockCounts, DeadCode
+from .plugins.checks import BroadcastReceive
+from .plugins.duplicate import DuplicateScripts
+from .plugins.initialization import AttributeInitialization, partition_scripts
+from .cache import KurtCache
+from .registry import PluginRegistry
+from .server import AnalysisServer
+from .watch import Watcher
+
+
+# The Scratch 1.4 project used by the tests
+TEST_PROJECT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            os.pardir, 'test', 'tmp.sb')
+
+
+def make_project(*scripts):
+    """Return a project with a sprite named Cat that has scripts.
+
+    Each script is given as a list of the arguments of its blocks, e.g.,
+    `[('whenGreenFlag',), ('broadcast:', 'go')]`.
+
+    """
+    project = kurt.Project()
+    sprite = kurt.Sprite(project, 'Cat')
+    project.sprites.append(sprite)
+    for blocks in scripts:
+        sprite.scripts.append(kurt.Script([kurt.Block(*x) for x in blocks]))
+    return project
+
+
+def fixture_projects():
+    """Return the projects that results are compared against the baseline on.
+
+    Besides the test project and generated projects, a hand written project
+    covers each way an attribute can be initialized or not.
+
+    """
+    projects = [kurt.Project.load(TEST_PROJECT), make_project(
+        [('whenGreenFlag',), ('lookLike:', 'costume1'),
+         ('doForever', [kurt.Block('setSizeTo:', 50)]), ('setSizeTo:', 100),
+         ('gotoX:y:', 0, 0), ('doBroadcastAndWait', 'start'),
+         ('heading:', 90), ('broadcast:', kurt.Block('answer'))],
+        [('whenGreenFlag',), ('gotoX:y:', 10, 10), ('show',)],
+        [('whenIReceive', 'start'), ('nextCostume',),
+         ('wait:elapsed:from:', 1)],
+        [('whenClicked',), ('hide',), ('broadcast:', 'start')],
+        [('whenIReceive', 'never'), ('say:', 'Hello!')],
+        [('forward:', 10), ('broadcast:', 'never')])]
+    for seed in range(8):
+        projects.append(generate_project(seed, sprites=3, scripts=4,
+                                         length=6, depth=2, fanout=2))
+    return projects
+
+
+class BroadcastReceiveTest(unittest.TestCase):
+
+    """Tests of the BroadcastReceive plugin."""
+
+    def test_dynamic_broadcast(self):
+        project = make_project(
+            [('whenGreenFlag',), ('broadcast:', kurt.Block('answer'))],
+            [('whenGreenFlag',), ('broadcast:', 'go')],
+            [('whenIReceive', 'go'), ('forward:', 10)])
+        results = BroadcastReceive()._process(
+            project, filename='cat.sb')['broadcast']
+        self.assertEqual(set(['Cat']), results['dynamic broadcast'])
+        self.assertEqual(set(['go']), results['success'])
+
+
+class BlockCountsTest(unittest.TestCase):
+
+    """Tests of the BlockCounts plugin."""
+
+    def test_matrix_matches_baseline(self):
+        plugin, halves = BlockCounts(), [BlockCounts(), BlockCounts()]
+        restored, total = BlockCounts(), Counter()
+        for i, project in enumerate(fixture_projects()):
+            expected = Counter()  # Counted per script as before the matrix
+            for script in HairballPlugin.iter_scripts(project):
+                for name, _, _ in HairballPlugin.iter_blocks(script.blocks):
+                    expected[name] += 1
+            total.update(expected)
+            filename = '{}.sb2'.format(i)
+            result = plugin._process(project, filename=filename)
+            self.assertEqual(expected, result['types'])
+            halves[i % 2]._process(project, filename=filename)
+            restored.restore(result, filename=filename)
+        self.assertEqual(total, plugin.blocks)
+        self.assertEqual(total, restored.blocks)
+        halves[0].merge(halves[1])
+        self.assertEqual(total, halves[0].blocks)
+        halves[0].subtract(halves[1])
+        self.assertEqual(total - halves[1].blocks, halves[0].blocks)
+
+
+class EventGraphTest(unittest.TestCase):
+
+    """Tests of the results derived from the broadcast EventGraph."""
+
+    @staticmethod
+    def baseline_events(script):
+        """Return the Counter of events broadcast by script as before."""
+        events = Counter()
+        for name, _, block in HairballPlugin.iter_blocks(script.blocks):
+            if 'broadcast %s' in name:
+                if isinstance(block.args[0], kurt.Block):
+                    events[True] += 1
+                else:
+                    events[block.args[0].lower()] += 1
+        return events
+
+    def baseline_reachable(self, scripts):
+        """Return whether each script is reachable as computed before.
+
+        Scripts are expanded one at a time from the scripts reachable via a
+        hat block through the broadcasts they contain.
+
+        """
+        reachable = [False] * len(scripts)
+        pending, untriggered = set(), {}
+        for index, script in enumerate(scripts):
+            start = HairballPlugin.script_start_type(script)
+            if start == HairballPlugin.HAT_WHEN_I_RECEIVE:
+                untriggered.setdefault(script[0].args[0].lower(),
+                                       set()).add(index)
+            elif start != HairballPlugin.NO_HAT:
+                reachable[index] = True
+                pending.add(index)
+        while pending:
+            for event in self.baseline_events(scripts[pending.pop()]):
+                for index in untriggered.pop(event, ()):
+                    reachable[index] = True
+                    pending.add(index)
+        return reachable
+
+    def baseline_broadcast(self, project):
+        """Return the BroadcastReceive results as computed before."""
+        owners, scripts = zip(*HairballPlugin.iter_sprite_scripts(project))
+        results = defaultdict(set)
+        broadcast = [self.baseline_events(x) for x in scripts]
+        correct = defaultdict(set)
+        for index, script in enumerate(scripts):
+            start = HairballPlugin.script_start_type(script)
+            if start == HairballPlugin.HAT_WHEN_I_RECEIVE:
+                correct[script[0].args[0].lower()].add(index)
+        results['never broadcast'] = set(correct)
+        for index, events in enumerate(broadcast):
+            for event in events.keys():
+                if event is True:
+                    results['dynamic broadcast'].add(owners[index])
+                    del events[event]
+                elif event in correct:
+                    results['never broadcast'].discard(event)
+                else:
+                    results['never received'].add(event)
+        for event in results['never broadcast']:
+            del correct[event]
+        for events in broadcast:
+            if len(events) > 1:
+                for event in events:
+                    if event in correct:
+                        results['parallel broadcasts'].add(event)
+                        del correct[event]
+        for event, indexes in correct.items():
+            if len(indexes) > 1:
+                for index in indexes:
+                    for _, _, block in HairballPlugin.iter_blocks(
+                            scripts[index].blocks):
+                        if block.type.shape == 'stack':
+                            results['multiple receivers with delay'].add(
+                                event)
+                            correct.pop(event, None)
+        results['success'] = set(correct)
+        return results
+
+    def test_graph_matches_baseline(self):
+        unreachable = dynamic = 0
+        plugin = DeadCode()
+        plugin.verbose = False
+        for project in fixture_projects():
+            owners, scripts = zip(*HairballPlugin.iter_sprite_scripts(
+                project))
+            stream = HairballPlugin.block_stream(project)
+            self.assertEqual(scripts, tuple(x[1] for x in stream.scripts))
+            results = plugin._process(project, filename='project.sb2')
+            reachable = self.baseline_reachable(scripts)
+            self.assertEqual(reachable, list(map(bool, stream.reachable)))
+            unreachable += reachable.count(False)
+            # The dead code is referred to by sprite and index
+            expected = [(x, owners[:i].count(x)) for i, x in
+                        enumerate(owners) if not reachable[i]]
+            self.assertEqual(sorted(expected), sorted(
+                (x.sprite, x.index) for refs in
+                results['dead_code']['sprites'].values() for x in refs))
+            self.assertEqual(any(True in self.baseline_events(x)
+                                 for x in scripts),
+                             results['dead_code']['variable_event'])
+            dynamic += results['dead_code']['variable_event']
+            expected = self.baseline_broadcast(project)
+            results = BroadcastReceive()._process(
+                project, filename='project.sb2')['broadcast']
+            self.assertEqual(dict(x for x in expected.items() if x[1]),
+                             dict(x for x in results.items() if x[1]))
+        self.assertTrue(unreachable)
+        self.assertTrue(dynamic)
+
+
+class DuplicateScriptsTest(unittest.TestCase):
+
+    """Tests of the DuplicateScripts plugin."""
+
+    @staticmethod
+    def script_hashes(project, min_blocks=1):
+        """Return the hashes of the first script of the Cat sprite."""
+        stream = HairballPlugin.block_stream(project)
+        return DuplicateScripts.script_hashes(stream, stream.script_range(
+            project.sprites[0].scripts[0]), min_blocks)
+
+    def test_hashes_ignore_literal_values(self):
+        hashes = [self.script_hashes(make_project([
+            ('whenGreenFlag',), ('doRepeat', count, [
+                kurt.Block('forward:', steps), kurt.Block('turnRight:', 15)]),
+            ('gotoX:y:', kurt.Block('xpos'), 0)])) for count, steps in
+            ((10, 5), (3, 7))]
+        self.assertEqual([(2, 'repeat %s%s'), (6, None)],
+                         [x[1:] for x in hashes[0]])
+        self.assertEqual(hashes[0], hashes[1])
+        # The slot of a block argument is part of the hash
+        swapped = self.script_hashes(make_project([
+            ('whenGreenFlag',), ('doRepeat', 10, [
+                kurt.Block('forward:', 5), kurt.Block('turnRight:', 15)]),
+            ('gotoX:y:', 0, kurt.Block('xpos'))]))
+        self.assertEqual(hashes[0][0], swapped[0])  # The loop bodies
+        self.assertNotEqual(hashes[0][1], swapped[1])
+
+    def test_deeply_nested_script(self):
+        depth = sys.getrecursionlimit() * 2
+        body = [kurt.Block('forward:', 10)]
+        for _ in xrange(depth - 1):
+            body = [kurt.Block('doForever', body)]
+        hashes = self.script_hashes(make_project([('doForever', body)]), 2)
+        self.assertEqual(depth, len(hashes))
+        self.assertEqual((depth + 1, None), hashes[-1][1:])
+
+
+class AttributeInitializationTest(unittest.TestCase):
+
+    """Tests of the AttributeInitialization plugin."""
+
+    @staticmethod
+    def baseline_state(scripts, attribute):
+        """Return the state of attribute as computed prior to AttributeRules.
+
+        Each script is traversed once per attribute.
+
+        """
+        cls = AttributeInitialization
+        green_flag, other = partition_scripts(scripts, cls.HAT_GREEN_FLAG,
+                                              cls.HAT_CLONE)
+        block_set = cls.BLOCKMAPPING[attribute]
+        state = cls.STATE_NOT_MODIFIED
+        for script in green_flag:
+            in_zone = True
+            for name, level, _ in cls.iter_blocks(script.blocks):
+                if name == 'broadcast %s and wait':
+                    in_zone = False
+                if (name, 'absolute') in block_set:
+                    if in_zone and level == 0:
+                        if state == cls.STATE_NOT_MODIFIED:
+                            state = cls.STATE_INITIALIZED
+                        else:
+                            state = cls.STATE_MODIFIED
+                    elif in_zone:
+                        continue
+                    else:
+                        state = cls.STATE_MODIFIED
+                    break
+                elif (name, 'relative') in block_set:
+                    state = cls.STATE_MODIFIED
+                    break
+        if state != cls.STATE_NOT_MODIFIED:
+            return state
+        for script in other:
+            for name, _, _ in cls.iter_blocks(script.blocks):
+                if name in [x[0] for x in block_set]:
+                    return cls.STATE_MODIFIED
+        return cls.STATE_NOT_MODIFIED
+
+    @staticmethod
+    def baseline_result(sprites):
+        """Return whether each attribute was initialized as before."""
+        cls = AttributeInitialization
+        retval = dict((x, True) for x in cls.ATTRIBUTES)
+        for properties in sprites.values():
+            for attribute, state in properties.items():
+                retval[attribute] &= state != cls.STATE_MODIFIED
+        return retval
+
+    def test_rules_match_baseline(self):
+        cls = AttributeInitialization
+        attributes = [x for x in cls.ATTRIBUTES if x != 'background']
+        states = set()
+        for project in fixture_projects():
+            stream = HairballPlugin.block_stream(project)
+            changes = {}
+            for sprite in project.sprites:
+                changes[sprite.name] = dict(
+                    (x, self.baseline_state(sprite.scripts, x))
+                    for x in attributes)
+                self.assertEqual(changes[sprite.name],
+                                 cls.sprite_changes(sprite))
+                self.assertEqual(changes[sprite.name],
+                                 cls.sprite_changes(sprite, stream))
+                states.update(changes[sprite.name].values())
+            changes['stage'] = {'background': self.baseline_state(
+                project.stage.scripts, 'costume')}
+            self.assertEqual(changes['stage']['background'],
+                             cls.attribute_state(project.stage.scripts,
+                                                 'costume'))
+            results = cls()._process(project, filename='project.sb2')
+            self.assertEqual({'initialized': changes}, results)
+            self.assertEqual(self.baseline_result(changes),
+                             cls.attribute_result(results['initialized']))
+        self.assertEqual(set([cls.STATE_NOT_MODIFIED, cls.STATE_MODIFIED,
+                              cls.STATE_INITIALIZED]), states)
+
+
+class BlockStreamTest(unittest.TestCase):
+
+    """Tests of the BlockStream."""
+
+    def test_opcodes_beyond_unsigned_short(self):
+        for i in xrange(len(OPCODES), 1 << 16):
+            OPCODES.intern('custom block {}'.format(i))
+        project = make_project([('whenGreenFlag',),
+                                ('think:duration:elapsed:from:', 'hm', 2)])
+        stream = HairballPlugin.block_stream(project)
+        self.assertLessEqual(1 << 16, max(stream.opcodes))
+        self.assertEqual(['when @greenFlag clicked', 'think %s for %s secs'],
+                         [x[0] for x in stream])
+
+
+class ScriptRefTest(unittest.TestCase):
+
+    """Tests of ScriptRef."""
+
+    def test_resolve(self):
+        scripts = ([('whenGreenFlag',), ('forward:', 10)],
+                   [('whenIReceive', 'go'), ('turnRight:', 15)])
+        project = make_project(*scripts)
+        ref = HairballPlugin.block_stream(project).script_ref(1)
+        self.assertIs(project.sprites[0].scripts[1], ref.resolve(project))
+        # Literal values are not part of the structure
+        changed = make_project(scripts[0], [('whenIReceive', 'stop'),
+                                            ('turnRight:', 90)])
+        self.assertIs(changed.sprites[0].scripts[1], ref.resolve(changed))
+
+    def test_resolve_changed_script(self):
+        project = make_project([('whenGreenFlag',), ('forward:', 10)],
+                               [('whenIReceive', 'go'), ('turnRight:', 15)])
+        ref = HairballPlugin.block_stream(project).script_ref(1)
+        changed = make_project([('whenGreenFlag',), ('forward:', 10)],
+                               [('whenIReceive', 'go'), ('turnLeft:', 15)])
+        self.assertRaises(LookupError, ref.resolve, changed)
+        self.assertRaises(LookupError, ref.resolve, make_project())
+
+
+class AnalysisLoaderTest(unittest.TestCase):
+
+    """Tests that the analysis loader agrees with Kurt's loader."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp(prefix='hairball-test-')
+        cls.path = os.path.join(cls.directory, 'tmp.sb2')
+        kurt.Project.load(TEST_PROJECT).save(cls.path)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def test_bundled_plugin_results(self):
+        full = load_project(self.path)
+        analysis = load_analysis_project(self.path)
+        for entry in PluginRegistry(cache_path=None).plugins:
+            plugin_class = getattr(importlib.import_module(entry['module']),
+                                   entry['class'])
+            results = []
+            for project in (full, analysis):
+                plugin = plugin_class()
+                plugin.verbose = False
+                results.append(plugin._process(project, filename=self.path))
+            self.assertEqual(results[0], results[1], entry['name'])
+
+
+class KurtCacheTest(unittest.TestCase):
+
+    """Tests of the KurtCache."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='hairball-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_results_count_toward_budget(self):
+        cache = KurtCache(self.directory)
+        cache.save_result('a', 'plugin', '1', 'x' * 1000)
+        size = cache.size
+        self.assertLess(1000, size)
+        cache.save_result('a', 'plugin', '2', 'x' * 10)  # Replaces the first
+        cache.save_result('b', 'plugin', '1', 'x' * 1000)
+        self.assertLess(size, cache.size)
+        self.assertGreater(size + 1000, cache.size)
+        stats = cache.stats()
+        self.assertEqual((2, cache.size), (stats['results'],
+                                           stats['results_size']))
+        self.assertEqual(True, cache.load_result('a', 'plugin', '2')[0])
+        # The least recently used result is evicted first
+        self.assertEqual(1, cache.prune(cache.size - 1))
+        self.assertEqual(False, cache.load_result('b', 'plugin', '1')[0])
+        self.assertEqual(True, cache.load_result('a', 'plugin', '2')[0])
+        budget = KurtCache(self.directory, max_size=0)
+        budget.save_result('c', 'plugin', '1', 'x')
+        self.assertEqual((0, 0), (budget.size, budget.stats()['results']))
+
+    def test_prune_stops_once_within_budget(self):
+        cache = KurtCache(self.directory)
+        cache.PRUNE_BATCH = 3  # Eviction spans several batches
+        for i in range(20):
+            cache.save_result(str(i), 'plugin', '1', 'x' * 100)
+        cache.add('entry', 1000)
+        size = cache.size
+        cache.max_size = size
+        # A result at budget evicts just as many of the oldest as needed
+        cache.save_result('new', 'plugin', '1', 'x' * 450)
+        remaining = [str(i) for i in range(20)
+                     if cache.load_result(str(i), 'plugin', '1')[0]]
+        self.assertEqual([str(i) for i in range(5, 20)], remaining)
+        self.assertLessEqual(cache.size, size)
+        self.assertEqual(True, cache.load_result('new', 'plugin', '1')[0])
+        self.assertEqual(1, cache.stats()['entries'])
+        self.assertEqual(0, cache.prune(size))
+
+    def test_results_of_old_indexes_are_dropped(self):
+        import sqlite3
+        db = sqlite3.connect(os.path.join(self.directory,
+                                          KurtCache.INDEX_FILENAME))
+        db.execute('CREATE TABLE results (key TEXT NOT NULL, plugin TEXT NOT '
+                   'NULL, version TEXT NOT NULL, result BLOB NOT NULL, '
+                   'PRIMARY KEY (key, plugin))')
+        db.execute("INSERT INTO results VALUES ('a', 'plugin', '1', 'N.')")
+        db.commit()
+        db.close()
+        cache = KurtCache(self.directory)
+        self.assertEqual((False, None), cache.load_result('a', 'plugin', '1'))
+        cache.save_result('a', 'plugin', '1', None)
+        self.assertEqual((True, None), cache.load_result('a', 'plugin', '1'))
+        self.assertEqual(cache.stats()['results_size'], cache.size)
+
+
+class VersionKeyTest(unittest.TestCase):
+
+    """Tests of the version keys of the cached results of plugins."""
+
+    PLUGINS = """from hairball.plugins import HairballPlugin
+
+
+class First(HairballPlugin):
+
+    DEPENDENCIES = ('hairball_test_helper.helper',)
+
+    def analyze(self, scratch, **kwargs):
+        return {{}}
+
+
+class Second(HairballPlugin):
+
+    def analyze(self, scratch, **kwargs):
+        return {{'second': {}}}
+"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='hairball-test-')
+        self.write('hairball_test_helper.py', 'def helper():\n    pass\n')
+        self.write('hairball_test_plugins.py', self.PLUGINS.format(1))
+        sys.path.insert(0, self.directory)
+        self.module = importlib.import_module('hairball_test_plugins')
+
+    def tearDown(self):
+        sys.path.remove(self.directory)
+        for name in ('hairball_test_helper', 'hairball_test_plugins'):
+            del sys.modules[name]
+        shutil.rmtree(self.directory)
+
+    def write(self, filename, source):
+        with open(os.path.join(self.directory, filename), 'w') as fp:
+            fp.write(source)
+
+    def version(self):
+        """Return the current result version of the First plugin."""
+        from .plugins import _VERSION_KEYS
+        _VERSION_KEYS.clear()
+        linecache.checkcache()  # Read the rewritten modules
+        return self.module.First().result_version()
+
+    def test_dependency_changes_invalidate_results(self):
+        cache = KurtCache(self.directory)
+        cache.save_result('key', 'First', self.version(), {})
+        self.assertEqual(True, cache.load_result('key', 'First',
+                                                 self.version())[0])
+        # Another plugin of the same module changing has no effect
+        self.write('hairball_test_plugins.py', self.PLUGINS.format(22))
+        self.assertEqual(True, cache.load_result('key', 'First',
+                                                 self.version())[0])
+        self.write('hairball_test_helper.py',
+                   'def helper():\n    return 1\n')
+        self.assertEqual(False, cache.load_result('key', 'First',
+                                                  self.version())[0])
+
+
+class PluginRegistryTest(unittest.TestCase):
+
+    """Tests of the PluginRegistry."""
+
+    def test_find(self):
+        registry = PluginRegistry(cache_path=None)
+        for name in ('blocks.BlockCounts',
+                     'hairball.plugins.blocks.BlockCounts'):
+            self.assertEqual('blocks.BlockCounts',
+                             registry.find(name)['name'], name)
+        # Modules that are not listed are found on sys.path
+        plugin = registry.find('hairball.tests.PluginRegistryTest')
+        self.assertEqual(('hairball.tests', 'PluginRegistryTest'),
+                         (plugin['module'], plugin['class']))
+        self.assertIsNone(registry.find('hairball.missing.Plugin'))
+        self.assertIsNone(registry.find('missing'))
+
+
+class RunTest(unittest.TestCase):
+
+    """Tests that every way of running Hairball produces the same results.
+
+    The output of the plugins upon completion and the results written via
+    --output are compared with those of a single process run.
+
+    """
+
+    PLUGINS = ('blocks.BlockCounts', 'blocks.DeadCode',
+               'checks.BroadcastReceive', 'convention.SpriteNaming',
+               'duplicate.DuplicateScripts', 'duplicate.NearDuplicateScripts',
+               'initialization.AttributeInitialization')
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp(prefix='hairball-test-')
+        cls.corpus = os.path.join(cls.directory, 'corpus')
+        generate_corpus(cls.corpus, 6, sprites=3, scripts=4, length=6,
+                        depth=2, fanout=2)
+        shutil.copy(TEST_PROJECT, cls.corpus)
+        cls.expected = cls.analyze(cls.corpus)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    @staticmethod
+    def run_hairball(*args):
+        """Return the output of the hairball command run with args."""
+        argv, stdout = sys.argv, sys.stdout
+        sys.argv, sys.stdout = ['hairball'] + list(args), StringIO()
+        try:
+            main()
+            return sys.stdout.getvalue()
+        finally:
+            sys.argv, sys.stdout = argv, stdout
+
+    @classmethod
+    def analyze(cls, *args):
+        """Return the output and the sorted --output lines of a run."""
+        path = tempfile.mktemp(suffix='.ndjson', dir=cls.directory)
+        arguments = ['-q', '-S', '-C', '-o', path]
+        for plugin in cls.PLUGINS:
+            arguments.extend(('-p', plugin))
+        output = cls.run_hairball(*(arguments + list(args)))
+        with open(path) as fp:
+            return output, sorted(fp)
+
+    def test_expected_output(self):
+        output, results = self.expected
+        self.assertIn('1059 total', output)
+        self.assertIn('7 of 7 instances contained dead code.', output)
+        self.assertIn('11 duplicate scripts found', output)
+        self.assertEqual(7 * len(self.PLUGINS), len(results))
+
+    def test_jobs(self):
+        self.assertEqual(self.expected, self.analyze('-j', '3', self.corpus))
+        self.assertEqual(self.expected, self.analyze(
+            '-j', '2', '--prefetch', '2', self.corpus))
+
+    def test_shards_merge(self):
+        for jobs in ('1', '2'):
+            states, results = [], []
+            for shard in range(1, 4):
+                states.append(tempfile.mktemp(suffix='.state',
+                                              dir=self.directory))
+                shard_results = self.analyze(
+                    '-j', jobs, '--shard', '{}/3'.format(shard),
+                    '--save-state', states[-1], self.corpus)[1]
+                self.assertTrue(shard_results)  # Each shard has files
+                results.extend(shard_results)
+            self.assertEqual(self.expected[0],
+                             self.run_hairball('merge', *states))
+            self.assertEqual(self.expected[1], sorted(results))
+
+    def test_archives(self):
+        names = sorted(os.listdir(self.corpus))
+        for extension in ('.zip', '.tar.gz'):
+            archive = os.path.join(self.directory, 'corpus' + extension)
+            if extension == '.zip':
+                with zipfile.ZipFile(archive, 'w') as fp:
+                    for name in names:
+                        fp.write(os.path.join(self.corpus, name), name)
+            else:
+                with tarfile.open(archive, 'w:gz') as fp:
+                    for name in names:
+                        fp.add(os.path.join(self.corpus, name), name)
+            for arguments in ((), ('-j', '2')):
+                output, results = self.analyze(*(arguments + (archive,)))
+                # Members are named by the path within the archive
+                self.assertEqual(self.expected, (
+                    output.replace(archive, self.corpus),
+                    sorted(x.replace(archive, self.corpus) for x in results)))
+
+
+class AnalysisServerTest(unittest.TestCase):
+
+    """Tests of the analysis server."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='hairball-test-')
+        options, paths = parse_arguments(['-q', '-p', 'blocks.BlockCounts'],
+                                         server=True)
+        cache = KurtCache(os.path.join(self.directory, 'cache'))
+        hairball = Hairball(options, paths, cache=cache)
+        hairball.initialize_plugins()
+        self.server = AnalysisServer(hairball, ('127.0.0.1', 0))
+
+    def tearDown(self):
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def test_uploads_are_keyed_by_contents(self):
+        contents = []
+        for project in (kurt.Project.load(TEST_PROJECT), make_project(
+                [('whenGreenFlag',), ('forward:', 10)])):
+            path = os.path.join(self.directory, 'project.sb2')
+            project.save(path)
+            with open(path, 'rb') as fp:
+                contents.append(fp.read())
+        for data, blocks in ((contents[0], 19), (contents[1], 2),
+                             (contents[0], 19)):
+            item = self.server.analyze({'name': u'project.sb2',
+                                        'data': data})
+            counts = item['results']['hairball.plugins.blocks.BlockCounts']
+            self.assertEqual(blocks, sum(counts['types'].values()))
+
+    def test_malformed_projects(self):
+        for project, error in (
+                ({'path': TEST_PROJECT}, 'Paths are not allowed'),
+                ({'name': 'a.sb2'}, 'The data is missing'),
+                ({'name': 'a.sb2', 'data': u'not base64!'},
+                 'The data is missing'),
+                ({'name': 3, 'data': ''}, 'The name is not a string'),
+                ([TEST_PROJECT], 'The project is not an object')):
+            item = self.server.analyze(self.server.decode(project))
+            self.assertTrue(item['error'].startswith(error), item)
+        self.server.hairball.options.allow_paths = True
+        item = self.server.analyze({'path': [TEST_PROJECT]})
+        self.assertEqual('The path is not a string', item['error'])
+        item = self.server.analyze({'path': TEST_PROJECT})
+        self.assertEqual(TEST_PROJECT, item['file'])
+        self.assertIn('results', item)
+
+
+class WatcherTest(unittest.TestCase):
+
+    """Tests of the --watch mode."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='hairball-test-')
+        self.corpus = os.path.join(self.directory, 'corpus')
+        os.mkdir(self.corpus)
+        for i in range(8):
+            self.add_file(i)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def add_file(self, number):
+        shutil.copy(TEST_PROJECT, os.path.join(self.corpus,
+                                               '{}.sb'.format(number)))
+
+    def watcher(self, manifest):
+        """Return a watcher of the corpus using manifest."""
+        options, paths = parse_arguments([
+            '-q', '-S', '-C', '-w', '--manifest', manifest,
+            '-p', 'blocks.BlockCounts', '-p', 'blocks.DeadCode',
+            '-p', 'convention.SpriteNaming',
+            '-p', 'duplicate.DuplicateScripts', self.corpus])
+        hairball = Hairball(options, paths, cache=False)
+        hairball.initialize_plugins()
+        watcher = Watcher(hairball, options.manifest)
+        watcher.BLOCK_SIZE = 2
+        return watcher
+
+    def report(self, watcher):
+        """Return the output of a poll of watcher."""
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            watcher.poll()
+            return sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+    def full_report(self):
+        """Return the report of a watcher with a new manifest."""
+        path = tempfile.mktemp(suffix='.sqlite', dir=self.directory)
+        return self.report(self.watcher(path))
+
+    def test_incremental_reports_match_full_reports(self):
+        manifest = os.path.join(self.directory, 'a.sqlite')
+        watcher = self.watcher(manifest)
+        self.report(watcher)
+        blocks = len(watcher.manifest.blocks)
+        os.remove(os.path.join(self.corpus, '3.sb'))
+        self.add_file(10)
+        self.add_file(11)
+        merged = []
+        merge_block = watcher.merge_block
+        watcher.merge_block = lambda *args: merged.append(args) or \
+            merge_block(*args)
+        incremental = self.report(watcher)
+        full = self.full_report()
+        self.assertIn('171 total', full)
+        self.assertIn('9 of 9 instances', full)
+        self.assertEqual(full, incremental)
+        self.assertLess(len(merged), blocks)
+        # The resident aggregate is only updated by the changed files
+        self.assertIsNotNone(watcher.aggregate[0])
+        self.assertIsNone(watcher.aggregate[3])
+        os.remove(os.path.join(self.corpus, '10.sb'))
+        path = os.path.join(self.corpus, 'cat.sb2')
+        make_project([('whenGreenFlag',), ('forward:', 10)]).save(path)
+        self.assertEqual(self.full_report(), self.report(watcher))
+        kurt.Project.load(TEST_PROJECT).save(path)  # Modified
+        self.assertEqual(self.full_report(), self.report(watcher))
+        # A restarted watcher reads the partials of the blocks it stored
+        self.add_file(12)
+        self.assertEqual(self.full_report(),
+                         self.report(self.watcher(manifest)))
+
+
+if __name__ == '__main__':
+    unittest.main()
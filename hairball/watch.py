@@ -0,0 +1,462 @@
+"""This module provides the --watch mode of Hairball.
+
+A Manifest records the modification time and listing of every directory, and
+the stat of every file, that was found within the watched paths. Polling only
+lists the directories whose modification time changed and only analyzes the
+files whose stat changed, thus unchanged files are never read.
+
+Each analyzed file is run against fresh instances of the plugins. Those
+instances (partials) are persisted in the manifest, and the aggregate results
+are computed by merging them in file order, exactly as the results of a
+parallel run are. The files are grouped into blocks whose boundaries depend
+only on the files' paths, and the merged partials of each block are persisted
+in the manifest as well, thus a change only merges the partials of the files
+of the blocks it touches.
+
+The aggregate of the plugins that can `subtract` is kept across polls, and is
+updated by subtracting the previous partials of the changed and removed files
+and merging the new ones. The aggregate of the other plugins is merged again
+from the partials of the blocks upon each report, one block at a time.
+
+"""
+
+from __future__ import print_function
+import cPickle
+import os
+import sqlite3
+import stat
+import sys
+import time
+import zlib
+from hashlib import sha1
+from .output import jsonable
+
+
+def file_stat(stat_result):
+    """Return the (size, mtime_ns, inode) of a stat result."""
+    return (stat_result.st_size,
+            getattr(stat_result, 'st_mtime_ns',
+                    int(stat_result.st_mtime * 1e9)),
+            stat_result.st_ino)
+
+
+class Manifest(object):
+
+    """The state of the watched paths as of the last poll.
+
+    The manifest is an sqlite database, and only the entries that changed
+    are written. The entries of directories and the stats of files are held
+    in memory, keyed by path:
+
+    * dirs: (mtime_ns, names of matching files, names of subdirectories)
+    * files: (size, mtime_ns, inode)
+    * blocks: the ids of the blocks whose partials are stored
+
+    whereas the partials of each file (the plugin instances that analyzed the
+    file, or None if it could not be loaded) and of each block are only read
+    when needed.
+
+    """
+
+    # Incremented when the tables of the manifest change
+    FORMAT = 2
+
+    def __init__(self, path, plugins):
+        """Open the manifest at path, which tracks the given plugin versions.
+
+        The manifest starts over when it was written for other plugins or is
+        unusable.
+
+        """
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.db = self._connect(path)
+        versions = cPickle.dumps((self.FORMAT, plugins),
+                                 cPickle.HIGHEST_PROTOCOL)
+        try:
+            row = self.db.execute('SELECT value FROM meta WHERE key = '
+                                  '"plugins"').fetchone()
+        except sqlite3.DatabaseError:
+            row = None
+        if not row or str(row[0]) != versions:
+            self.db.close()
+            os.remove(path)
+            self.db = self._connect(path)
+            with self.db:
+                self.db.executescript("""
+CREATE TABLE meta (key TEXT PRIMARY KEY, value BLOB NOT NULL);
+CREATE TABLE dirs (path TEXT PRIMARY KEY, entry BLOB NOT NULL);
+CREATE TABLE files (path TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    inode INTEGER NOT NULL,
+                    partials BLOB);
+CREATE TABLE blocks (id TEXT PRIMARY KEY, partials BLOB NOT NULL);""")
+                self.db.execute('INSERT INTO meta VALUES ("plugins", ?)',
+                                (sqlite3.Binary(versions),))
+        self.dirs = {}
+        for path, entry in self.db.execute('SELECT path, entry FROM dirs'):
+            self.dirs[path] = cPickle.loads(str(entry))
+        self.files = {}
+        for row in self.db.execute('SELECT path, size, mtime_ns, inode '
+                                   'FROM files'):
+            self.files[row[0]] = tuple(row[1:])
+        self.blocks = set(x[0] for x in self.db.execute('SELECT id FROM '
+                                                        'blocks'))
+
+    @staticmethod
+    def _connect(path):
+        """Return a connection to the database at path."""
+        db = sqlite3.connect(path)
+        db.text_factory = str
+        return db
+
+    def set_dir(self, path, entry):
+        """Record the entry of the directory at path."""
+        self.dirs[path] = entry
+        self.db.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?)', (
+            path, sqlite3.Binary(cPickle.dumps(entry,
+                                               cPickle.HIGHEST_PROTOCOL))))
+
+    def remove_dir(self, path):
+        """Forget the directory at path."""
+        del self.dirs[path]
+        self.db.execute('DELETE FROM dirs WHERE path = ?', (path,))
+
+    def set_file(self, filename, file_stat_, partials):
+        """Record the stat and partials of filename."""
+        self.files[filename] = file_stat_
+        data = None
+        if partials is not None:
+            data = sqlite3.Binary(cPickle.dumps(partials,
+                                                cPickle.HIGHEST_PROTOCOL))
+        self.db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)',
+                        (filename,) + tuple(file_stat_) + (data,))
+
+    def remove(self, filename):
+        """Forget filename."""
+        self.files.pop(filename, None)
+        self.db.execute('DELETE FROM files WHERE path = ?', (filename,))
+
+    def partials(self, filenames):
+        """Return the partials of each of filenames by filename."""
+        found = {}
+        for filename in filenames:
+            row = self.db.execute('SELECT partials FROM files WHERE '
+                                  'path = ?', (filename,)).fetchone()
+            if row and row[0] is not None:
+                found[filename] = cPickle.loads(str(row[0]))
+        return found
+
+    def block_partials(self, block_id):
+        """Return the stored partials of the block with block_id."""
+        row = self.db.execute('SELECT partials FROM blocks WHERE id = ?',
+                              (block_id,)).fetchone()
+        return cPickle.loads(str(row[0]))
+
+    def set_block(self, block_id, partials):
+        """Record the merged partials of the block with block_id."""
+        self.blocks.add(block_id)
+        self.db.execute('INSERT OR REPLACE INTO blocks VALUES (?, ?)', (
+            block_id, sqlite3.Binary(cPickle.dumps(
+                partials, cPickle.HIGHEST_PROTOCOL))))
+
+    def remove_block(self, block_id):
+        """Forget the block with block_id."""
+        self.blocks.discard(block_id)
+        self.db.execute('DELETE FROM blocks WHERE id = ?', (block_id,))
+
+    def commit(self):
+        """Write the changes made since the last commit."""
+        self.db.commit()
+
+
+class Watcher(object):
+
+    """Repeatedly analyzes the files of a Hairball that were added or changed.
+
+    After the first poll, and each poll that found changes, the plugins'
+    aggregate results are output via their finalize methods.
+
+    """
+
+    # The expected number of files within a block (see `iter_blocks`)
+    BLOCK_SIZE = 64
+    # Directories modified this recently are always listed as a change within
+    # the same timestamp resolution would otherwise go unnoticed
+    RECENT = 2
+
+    def __init__(self, hairball, manifest_path=None, interval=2.0):
+        """Initialize a watcher of the paths of hairball."""
+        self.hairball = hairball
+        self.interval = interval
+        self.paths = list(hairball.paths)
+        versions = [(x.import_name, x.result_version())
+                    for x in hairball.plugins]
+        if not manifest_path:
+            manifest_path = self.default_manifest_path(
+                [os.path.abspath(x) for x in self.paths],
+                hairball.cache.cache_dir if hairball.cache else None)
+        self.manifest_path = manifest_path
+        self.manifest = Manifest(manifest_path, versions)
+        # The aggregate of the plugins that can subtract, which is None for
+        # the others and until the first report
+        self.aggregate = None
+        self.reported = False
+
+    @staticmethod
+    def default_manifest_path(paths, cache_dir=None):
+        """Return the path of the manifest for the given watched paths."""
+        if not cache_dir:
+            from .cache import default_cache_dir
+            cache_dir = default_cache_dir()
+        digest = sha1('\0'.join(sorted(paths))).hexdigest()
+        return os.path.join(cache_dir, 'watch', digest + '.sqlite')
+
+    def scan(self):
+        """Return the ordered list of files and those added or changed.
+
+        Files are listed in the order `Hairball.hairball_files` finds them.
+
+        """
+        found, changed, visited = [], [], set()
+        recent = (time.time() - self.RECENT) * 1e9
+        extensions = self.hairball.extensions
+
+        def check_file(path, stat_result):
+            found.append(path)
+            if self.manifest.files.get(path) != file_stat(stat_result):
+                changed.append((path, file_stat(stat_result)))
+
+        def scan_directory(path, dir_stat):
+            visited.add(path)
+            mtime = file_stat(dir_stat)[1]
+            entry = self.manifest.dirs.get(path)
+            if entry is None or entry[0] != mtime or mtime >= recent:
+                files, dirs = [], []
+                try:
+                    names = sorted(os.listdir(path))
+                except OSError:
+                    names = []
+                for name in names:
+                    full_path = os.path.join(path, name)
+                    try:
+                        mode = os.stat(full_path).st_mode
+                    except OSError:
+                        continue
+                    if stat.S_ISDIR(mode):
+                        if not os.path.islink(full_path):  # As os.walk
+                            dirs.append(name)
+                    elif os.path.splitext(name)[1] in extensions:
+                        files.append(name)
+                entry = (mtime, files, dirs)
+                self.manifest.set_dir(path, entry)
+            for name in entry[1]:
+                filename = os.path.join(path, name)
+                try:
+                    check_file(filename, os.stat(filename))
+                except OSError:
+                    pass  # Removed since the directory was listed
+            for name in entry[2]:
+                subdirectory = os.path.join(path, name)
+                try:
+                    scan_directory(subdirectory, os.stat(subdirectory))
+                except OSError:
+                    pass
+
+        for path in self.paths:
+            try:
+                stat_result = os.stat(path)
+            except OSError:
+                continue
+            if stat.S_ISDIR(stat_result.st_mode):
+                scan_directory(path, stat_result)
+            elif os.path.splitext(path)[1] in extensions:
+                check_file(path, stat_result)
+        # Forget the directories that no longer exist
+        for path in set(self.manifest.dirs) - visited:
+            self.manifest.remove_dir(path)
+        return found, changed
+
+    def poll(self, pool=None):
+        """Analyze the added and changed files and forget removed ones.
+
+        Returns the number of files that were analyzed or removed.
+
+        """
+        found, changed = self.scan()
+        removed = set(self.manifest.files) - set(found)
+        previous = {}  # The partials to subtract from the aggregate
+        if self.aggregate is not None and \
+                any(x is not None for x in self.aggregate):
+            previous = self.manifest.partials(
+                [x[0] for x in changed if x[0] in self.manifest.files] +
+                list(removed))
+        for filename in removed:
+            self.manifest.remove(filename)
+
+        stats = dict(changed)
+        analyzed = {}  # The partials of the files analyzed by this poll
+        for (filename, output, errors, partials,
+             records) in self.analyze([x[0] for x in changed], pool):
+            if not self.hairball.options.quiet:
+                print(filename)
+            sys.stdout.write(output)
+            sys.stderr.write(errors)
+            self.manifest.set_file(filename, stats[filename], partials)
+            analyzed[filename] = partials
+            if self.hairball.sink and records is not None:
+                self.hairball.write_results(filename, records)
+        if changed or removed or not self.reported:
+            self.report(found, analyzed, previous)
+        self.manifest.commit()
+        return len(changed) + len(removed)
+
+    def analyze(self, filenames, pool=None):
+        """Yield the analysis of each file as `_worker_process` returns it.
+
+        Output is captured only when a pool of workers is used.
+
+        """
+        if pool:
+            from . import _worker_process
+            for item in pool.imap(_worker_process, filenames):
+                yield item[:5]
+                if item[5]:
+                    self.hairball.profiler.merge(item[5])
+            return
+        for filename in filenames:
+            plugins = self.hairball.fresh_plugins()
+            with self.hairball.profiler.file(filename):
+                results = self.hairball.analyze(filename, plugins)
+            records = None
+            if results is not None and self.hairball.options.output:
+                records = [jsonable(x) for x in results]
+            yield (filename, '', '', plugins if results is not None
+                   else None, records)
+
+    def iter_blocks(self, found):
+        """Yield the tuple of the files of each block of found files.
+
+        A file ends its block when the checksum of its path is a multiple of
+        BLOCK_SIZE, thus adding or removing a file only changes its block.
+
+        """
+        block = []
+        for filename in found:
+            block.append(filename)
+            if zlib.crc32(filename) % self.BLOCK_SIZE == 0:
+                yield tuple(block)
+                block = []
+        if block:
+            yield tuple(block)
+
+    def merge_block(self, block, analyzed):
+        """Return fresh plugins with the partials of the files of block merged.
+
+        :param analyzed: The partials of the files analyzed by this poll,
+          which are not read from the manifest again.
+
+        """
+        plugins = self.hairball.fresh_plugins()
+        stored = self.manifest.partials(x for x in block if x not in analyzed)
+        for filename in block:
+            partials = analyzed.get(filename, stored.get(filename))
+            if partials is None:
+                continue
+            for plugin, partial in zip(plugins, partials):
+                plugin.merge(partial)
+        return plugins
+
+    @staticmethod
+    def block_id(block):
+        """Return the id of the block of files, the sha1sum of their paths."""
+        return sha1('\0'.join(block)).hexdigest()
+
+    def resident_aggregate(self):
+        """Return the aggregate of the plugins that can subtract.
+
+        The position of each plugin that cannot subtract holds None.
+
+        """
+        aggregate = self.hairball.fresh_plugins()
+        for i, (plugin, other) in enumerate(zip(
+                aggregate, self.hairball.fresh_plugins())):
+            try:
+                plugin.subtract(other)
+            except NotImplementedError:
+                aggregate[i] = None
+        return aggregate
+
+    def report(self, found, analyzed, previous=None):
+        """Output the aggregate results of the plugins over found files.
+
+        Only the blocks that contain files that were analyzed, added or
+        removed since the last report are merged again. The partials of the
+        other blocks are only read for the plugins that cannot subtract, and
+        for every plugin upon the first report.
+
+        :param previous: The partials of the files that were analyzed again or
+          removed as of the last report, which are subtracted from the
+          resident aggregate.
+
+        """
+        fresh = self.hairball.fresh_plugins()
+        if self.aggregate is None:  # Every plugin is merged from the blocks
+            self.aggregate = self.resident_aggregate()
+            merged = [y if x is None else None
+                      for x, y in zip(self.aggregate, fresh)]
+            targets = [y if x is None else x
+                       for x, y in zip(self.aggregate, fresh)]
+        else:
+            for i, plugin in enumerate(self.aggregate):
+                if plugin is None:
+                    continue
+                for partials in (previous or {}).values():
+                    if partials is not None:
+                        plugin.subtract(partials[i])
+                for filename in sorted(analyzed):
+                    if analyzed[filename] is not None:
+                        plugin.merge(analyzed[filename][i])
+            merged = targets = [y if x is None else None
+                                for x, y in zip(self.aggregate, fresh)]
+        stale = set(self.manifest.blocks)
+        for block in self.iter_blocks(found):
+            block_id = self.block_id(block)
+            stale.discard(block_id)
+            if block_id not in self.manifest.blocks or \
+                    any(x in analyzed for x in block):
+                partials = self.merge_block(block, analyzed)
+                self.manifest.set_block(block_id, partials)
+            elif any(x is not None for x in targets):
+                partials = self.manifest.block_partials(block_id)
+            else:
+                continue
+            for plugin, partial in zip(targets, partials):
+                if plugin is not None:
+                    plugin.merge(partial)
+        for block_id in stale:
+            self.manifest.remove_block(block_id)
+        if not self.hairball.options.quiet:
+            print('Results as of {} ({} files):'.format(time.ctime(),
+                                                        len(found)))
+        for plugin, other in zip(self.aggregate, merged):
+            (other if plugin is None else plugin).finalize()
+        sys.stdout.flush()
+        self.reported = True
+
+    def run(self, pool=None):
+        """Poll for changes every interval seconds until interrupted.
+
+        The manifest is committed upon interruption so that the files
+        analyzed by an unfinished poll are not analyzed again.
+
+        """
+        try:
+            while True:
+                started = time.time()
+                self.poll(pool)
+                time.sleep(max(0, self.interval - (time.time() - started)))
+        except KeyboardInterrupt:
+            self.manifest.commit()
@@ -25,6 +25,7 @@ setup(name=PACKAGE_NAME,
       description=('Hairball is a plugin-able framework useful for static '
                    'analysis of Scratch projects.'),
       entry_points={'console_scripts': ['hairball = hairball:main']},
+      extras_require={'numpy': ['numpy'], 'scandir': ['scandir>=1.5']},
       install_requires=['appdirs>=1.2.0', 'kurt>=2.0.5'],
       keywords='scratch static-analysis',
       license='Simplified BSD License',